@@ -0,0 +1,54 @@
+"""user-006: память на 10k карточек — словари с тегами и множеством ключевых слов против Card.
+
+    python bench/cards_memory.py
+"""
+
+import gc
+import json
+import tracemalloc
+
+from common import load_bot, make_deck
+
+bot = load_bot()
+
+COUNT = 10_000
+payload = json.dumps(make_deck(COUNT, category="Романтика", age="12+"))
+
+
+def as_dicts(items):
+    # прежнее представление: словарь со строковыми ключами, список тегов и множество слов
+    cards = []
+    for raw in items:
+        card = {
+            "id": str(raw["id"]).strip(),
+            "type": str(raw["type"]).strip(),
+            "category": str(raw["category"]),
+            "age": str(raw["age"]),
+            "tags": list(raw["tags"]),
+            "text": str(raw["text"]).strip(),
+        }
+        card["keywords"] = bot.extract_keywords(card["text"])
+        cards.append(card)
+    return cards
+
+
+def as_cards(items):
+    return [bot.card_from_dict(raw) for raw in items]
+
+
+def measure(build):
+    build(json.loads(payload)["items"])  # прогрев словаря ключевых слов
+    items = json.loads(payload)["items"]
+    gc.collect()
+    tracemalloc.start()
+    cards = build(items)
+    gc.collect()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del cards
+    return size
+
+
+for label, build in (("словари", as_dicts), ("Card", as_cards)):
+    size = measure(build)
+    print(f"{label:8} {size / COUNT:6.0f} Б/карточку, {size / 1024 / 1024:5.2f} МиБ на {COUNT} карточек")
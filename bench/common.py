@@ -0,0 +1,40 @@
+"""Общее для бенчмарков: загрузка bot.py без токена, журнала и файла состояния.
+
+Каждый скрипт запускается из корня репозитория, например:
+    python bench/keywords.py
+Скрипты с параметром --baseline сравнивают текущий bot.py с другой ревизией:
+    git show <ревизия>:bot.py > /tmp/bot_old.py
+    python bench/cards_memory.py --baseline /tmp/bot_old.py
+"""
+
+import importlib.util
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def load_bot(path=None, name="bot"):
+    os.environ.setdefault("BOT_TOKEN", "123456:bench")
+    os.environ.setdefault("STATE_DB_PATH", "")
+    os.environ.setdefault("JOURNAL_DIR", "")
+    spec = importlib.util.spec_from_file_location(name, path or os.path.join(ROOT, "bot.py"))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module  # dataclasses ищут свой модуль в sys.modules
+    spec.loader.exec_module(module)
+    return module
+
+
+def make_deck(count, *, prefix="bench", category="Лёгкое", age="0+"):
+    """Синтетическая колода в формате /import_deck."""
+    items = []
+    for i in range(count):
+        items.append({
+            "id": f"{prefix}-{i}",
+            "type": "truth" if i % 2 else "dare",
+            "category": category,
+            "age": age,
+            "tags": ["bench"],
+            "text": f"Карточка номер {i} про слово{i % 97} и фразу{i % 13} тестирование",
+        })
+    return {"meta": {"lang": "ru", "version": 1}, "items": items}
@@ -0,0 +1,44 @@
+"""user-013: память на одну игру (4 игрока, счёт, активный ход) по tracemalloc.
+
+    python bench/game_memory.py
+    git show 18716a3~1:bot.py > /tmp/bot_old.py
+    python bench/game_memory.py --baseline /tmp/bot_old.py
+"""
+
+import argparse
+import gc
+import tracemalloc
+
+from common import load_bot
+
+GAMES = 10_000
+
+
+def make_game(bot, chat_id):
+    game = bot.ChatGame(chat_id=chat_id, host_id=1)
+    for user_id in range(1, 5):
+        bot.register_player(game, user_id, f"Игрок{user_id}")
+    game.scores = {user_id: user_id - 1 for user_id in range(1, 5)}
+    game.current_turn = bot.Turn(player_id=1, type="truth", card_id="x", message_id=5)
+    return game
+
+
+def measure(bot):
+    make_game(bot, 0)
+    gc.collect()
+    tracemalloc.start()
+    games = [make_game(bot, chat_id) for chat_id in range(GAMES)]
+    gc.collect()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del games
+    return size / GAMES
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--baseline", help="другой bot.py для сравнения")
+args = parser.parse_args()
+
+print(f"текущий bot.py: {measure(load_bot()):6.0f} Б/игру")
+if args.baseline:
+    print(f"{args.baseline}: {measure(load_bot(args.baseline, 'bot_baseline')):6.0f} Б/игру")
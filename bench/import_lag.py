@@ -0,0 +1,117 @@
+"""user-010: задержка цикла событий во время потокового импорта колоды из файла.
+
+    python bench/import_lag.py                  # сборщик мусора по умолчанию
+    python bench/import_lag.py --gc freeze      # gc.collect() + gc.freeze() перед импортом
+    python bench/import_lag.py --gc thresholds  # freeze и пороги 10000, 20, 20
+
+Файл на 50 000 карточек отдаётся кусками по 64 КБ, как bot.session.stream_content.
+Параллельно тикер раз в 5 мс замеряет, насколько позже он проснулся, —
+это и есть задержка, которую видят остальные апдейты. run_bot делает то же,
+что --gc freeze; поднятые пороги давали поверх заморозки лишь несколько мс
+и в бот не вошли.
+"""
+
+import argparse
+import asyncio
+import gc
+import json
+import random
+import time
+import types
+
+from common import load_bot
+
+CARDS = 50_000
+CHUNK = 64 * 1024
+TICK = 0.005
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--gc", choices=("default", "freeze", "thresholds"), default="default")
+args = parser.parse_args()
+
+bot = load_bot()
+random.seed(2)
+words = [f"слово{i}" for i in range(5000)]
+data = json.dumps({
+    "meta": {"lang": "ru", "version": 1},
+    "items": [
+        {
+            "id": f"lag-{i}", "type": "truth" if i % 2 else "dare", "category": "Лёгкое", "age": "0+",
+            "tags": ["bench"], "text": " ".join(random.sample(words, 5)),
+        }
+        for i in range(CARDS)
+    ],
+}, ensure_ascii=False).encode("utf-8")
+
+
+class Reply:
+    async def edit_text(self, text, **kwargs):
+        self.text = text
+
+
+class DocumentMessage:
+    """Сообщение с файлом колоды: ответы бота складываются в replies."""
+
+    def __init__(self, chat_id, user_id):
+        self.chat = types.SimpleNamespace(id=chat_id)
+        self.from_user = types.SimpleNamespace(id=user_id, full_name="Хост")
+        self.document = types.SimpleNamespace(file_name="deck.json", file_size=len(data), file_id="deck")
+        self.reply_to_message = None
+        self.text = None
+        self.replies = []
+
+    async def answer(self, text, **kwargs):
+        reply = Reply()
+        reply.text = text
+        self.replies.append(reply)
+        return reply
+
+
+async def get_file(file_id):
+    return types.SimpleNamespace(file_path="deck.json")
+
+
+async def stream_content(url, chunk_size=CHUNK, **kwargs):
+    for start in range(0, len(data), chunk_size):
+        # сеть отдаёт кусок не мгновенно
+        await asyncio.sleep(0.001)
+        yield data[start:start + chunk_size]
+
+
+async def main():
+    bot.bot.get_file = get_file
+    bot.bot.session.stream_content = stream_content
+    game = bot.ChatGame(chat_id=9, host_id=7)
+    bot.register_player(game, 7, "Хост")
+    bot.GAMES[9] = game
+    lags = []
+    done = False
+
+    async def ticker():
+        while not done:
+            started = time.perf_counter()
+            await asyncio.sleep(TICK)
+            lags.append(time.perf_counter() - started - TICK)
+
+    ticks = asyncio.create_task(ticker())
+    message = DocumentMessage(9, 7)
+    started = time.perf_counter()
+    await bot.cmd_import_deck(message)
+    total = time.perf_counter() - started
+    done = True
+    await ticks
+    lags.sort()
+    print(message.replies[-1].text.splitlines()[0])
+    print(
+        f"gc={args.gc}: импорт {total:.2f} с, тиков {len(lags)}, задержка "
+        f"p50 {lags[len(lags) // 2] * 1e3:.1f} мс, p99 {lags[int(len(lags) * 0.99)] * 1e3:.1f} мс, "
+        f"max {lags[-1] * 1e3:.1f} мс"
+    )
+
+
+if args.gc != "default":
+    gc.collect()
+    gc.freeze()
+if args.gc == "thresholds":
+    gc.set_threshold(10_000, 20, 20)
+asyncio.run(main())
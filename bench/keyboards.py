@@ -0,0 +1,75 @@
+"""user-025: сборка inline-клавиатур — готовые и мемоизированные против сборки pydantic.
+
+    python bench/keyboards.py
+    git show 6b1d6c0~1:bot.py > /tmp/bot_old.py
+    python bench/keyboards.py --baseline /tmp/bot_old.py
+
+С --baseline сначала проверяется, что обе версии выдают одинаковые клавиатуры
+во всех меню и сочетаниях настроек, затем печатается время одной сборки.
+"""
+
+import argparse
+import itertools
+import time
+
+from common import load_bot
+
+PLAYERS = 8
+
+
+def make_game(bot):
+    game = bot.ChatGame(chat_id=-1, host_id=1)
+    for i in range(PLAYERS):
+        bot.register_player(game, i + 1, f"Игрок {i}")
+    return game
+
+
+def keyboards(bot, game):
+    """Все клавиатуры, которые строит бот, в одном порядке для обеих версий."""
+    yield bot.lobby_keyboard(game)
+    for flag in (False, True):
+        yield bot.turn_choice_keyboard(game, flag)
+        yield bot.start_menu_keyboard(flag)
+    for for_host, allow_reroll in itertools.product((False, True), repeat=2):
+        yield bot.task_keyboard(game, for_host, allow_reroll)
+    for points, penalty, timer, age in itertools.product((False, True), (0, -1), bot.TIMER_OPTIONS, bot.AGE_LEVELS):
+        game.settings.points = points
+        game.settings.skip_penalty = penalty
+        game.settings.timer = timer
+        game.settings.age_level = age
+        for menu in ("root", "timer", "age", "category", "other"):
+            yield bot.build_settings_keyboard(game, menu)
+    for menu in ("root", "rename", "reorder", "delete"):
+        yield bot.build_player_menu_keyboard(game, menu)
+
+
+def timed(label, fn, rounds=20_000):
+    started = time.perf_counter()
+    for _ in range(rounds):
+        fn()
+    print(f"{label:36} {(time.perf_counter() - started) / rounds * 1e6:7.2f} мкс")
+
+
+def measure(bot, title):
+    game = make_game(bot)
+    print(title)
+    timed("lobby_keyboard", lambda: bot.lobby_keyboard(game))
+    timed("task_keyboard", lambda: bot.task_keyboard(game, True, True))
+    timed("настройки: категории", lambda: bot.build_settings_keyboard(game, "category"))
+    timed(f"меню игроков: порядок, {PLAYERS} игроков", lambda: bot.build_player_menu_keyboard(game, "reorder"), 5_000)
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--baseline", help="другой bot.py для сравнения")
+args = parser.parse_args()
+
+bot = load_bot()
+if args.baseline:
+    baseline = load_bot(args.baseline, "bot_baseline")
+    current = [keyboard.model_dump() for keyboard in keyboards(bot, make_game(bot))]
+    old = [keyboard.model_dump() for keyboard in keyboards(baseline, make_game(baseline))]
+    assert current == old, "клавиатуры различаются"
+    print(f"клавиатуры совпадают: {len(current)}")
+measure(bot, "текущий bot.py:")
+if args.baseline:
+    measure(baseline, f"{args.baseline}:")
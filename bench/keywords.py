@@ -0,0 +1,80 @@
+"""user-003: стоимость проверки похожести карточек — множества строк против битовой маски.
+
+    python bench/keywords.py
+"""
+
+import random
+import sys
+import time
+
+from common import load_bot
+
+bot = load_bot()
+
+CHECKS = 200_000
+
+random.seed(0)
+letters = "абвгдежзиклмнопрстуфхцчшщэюя"
+words = ["".join(random.choice(letters) for _ in range(random.randint(5, 9))) for _ in range(30_000)]
+texts = [" ".join(random.choice(words) for _ in range(random.randint(8, 14))) for _ in range(20_000)]
+texts += [card.text for card in bot.DEFAULT_DECK]
+
+keyword_sets = [frozenset(bot.extract_keywords(text)) for text in texts]
+signatures = [bot.keyword_signature(text) for text in texts]
+order = [random.randrange(len(texts)) for _ in range(CHECKS)]
+
+
+def run_sets():
+    last, hits = keyword_sets[0], 0
+    for i in order:
+        current = keyword_sets[i]
+        if last and current and (current & last):
+            hits += 1
+        last = current
+    return hits
+
+
+def run_signatures():
+    last, hits, overlap = signatures[0], 0, bot.signatures_overlap
+    for i in order:
+        current = signatures[i]
+        if overlap(current, last):
+            hits += 1
+        last = current
+    return hits
+
+
+def run_empty():
+    # тот же обход без сравнения — вычитается как накладные расходы цикла
+    last = signatures[0]
+    for i in order:
+        last = signatures[i]
+    return last
+
+
+def per_check(fn):
+    best = min(timed(fn) for _ in range(3))
+    return best / CHECKS * 1e9
+
+
+def timed(fn):
+    started = time.perf_counter()
+    fn()
+    return time.perf_counter() - started
+
+
+assert run_sets() == run_signatures(), "маска должна давать те же совпадения"
+overhead = per_check(run_empty)
+print(f"карточек {len(texts)}, словарь {len(bot.KEYWORD_VOCABULARY)} слов, проверок {CHECKS}")
+print(f"множества строк:   {per_check(run_sets) - overhead:6.0f} нс/проверку")
+print(f"битовая маска:     {per_check(run_signatures) - overhead:6.0f} нс/проверку")
+
+game = bot.ChatGame(chat_id=1, host_id=1)
+draws = 20_000
+started = time.perf_counter()
+for n in range(draws):
+    bot.pick_card(game, bot.CARD_TYPES[n % 2])
+print(f"pick_card целиком: {(time.perf_counter() - started) / draws * 1e6:6.1f} мкс/раздачу (стоковая колода)")
+sizes_sets = sum(sys.getsizeof(s) for s in keyword_sets) / len(keyword_sets)
+sizes_sigs = sum(sys.getsizeof(s) + sys.getsizeof(s[0]) + sys.getsizeof(s[1]) for s in signatures) / len(signatures)
+print(f"память на карточку: множество {sizes_sets:.0f} Б, сигнатура {sizes_sigs:.0f} Б (без самих строк)")
@@ -0,0 +1,146 @@
+"""user-017: пропускная способность шардов (SHARD_WORKERS) на синтетических апдейтах.
+
+    python bench/sharding.py            # 1, 2, 4 и 8 воркеров
+    python bench/sharding.py 1 4
+
+1000 чатов: /newgame и по 9 переключений настройки в каждом; Bot API подменён
+сессией без сети, лимиты отправки сняты. Воркер пишет время первого апдейта,
+конца и затраченное CPU — если CPU на воркер близко к общему времени, обработка
+упирается в процессор и воркеры ускоряют её, пока их не больше ядер. На одном
+ядре рост не ожидается.
+"""
+
+import asyncio
+import datetime
+import glob
+import json
+import os
+import sys
+import tempfile
+import time
+
+from common import load_bot
+
+from aiogram.client.session.base import BaseSession
+from aiogram.methods import SendMessage
+from aiogram.types import Chat, Message
+
+bot = load_bot()
+
+CHATS = 1000
+TOGGLES = 9
+BATCH = 100
+RESULTS = os.path.join(tempfile.gettempdir(), "bench-sharding")
+
+
+class OfflineSession(BaseSession):
+    """Отвечает на запросы Bot API сразу, без сети."""
+
+    def __init__(self):
+        super().__init__()
+        self.sent = 0
+
+    async def make_request(self, bot_, method, timeout=None):
+        if isinstance(method, SendMessage):
+            self.sent += 1
+            return Message(
+                message_id=self.sent,
+                date=datetime.datetime.now(),
+                chat=Chat(id=method.chat_id, type="group"),
+                text=method.text,
+            ).as_(bot_)
+        return True
+
+    async def close(self):
+        pass
+
+    async def stream_content(self, *args, **kwargs):
+        yield b""
+
+
+class TimedPipe:
+    """Pipe воркера, запоминающий время первого апдейта."""
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.first = None
+
+    def fileno(self):
+        return self.conn.fileno()
+
+    def recv_bytes(self):
+        data = self.conn.recv_bytes()
+        if self.first is None:
+            self.first = time.time()
+        return data
+
+
+def worker(conn):
+    bot.bot.session = OfflineSession()
+    bot.SPINNER_STEPS = 0
+    # меряем обработку апдейтов, а не лимиты Telegram
+    unlimited = 1e9
+    bot.OUTBOUND = bot.OutboundLimiter(
+        global_rate=unlimited, global_burst=unlimited, chat_rate=unlimited, chat_burst=unlimited,
+        group_per_minute=unlimited, group_burst=unlimited,
+    )
+    pipe = TimedPipe(conn)
+    cpu = time.process_time()
+    asyncio.run(bot.run_bot(bot.consume_shard_updates(pipe)))
+    with open(os.path.join(RESULTS, f"{bot.SHARD_INDEX}.json"), "w") as fh:
+        json.dump({"first": pipe.first, "end": time.time(), "cpu": time.process_time() - cpu}, fh)
+
+
+def user(user_id):
+    return {"id": user_id, "is_bot": False, "first_name": f"U{user_id}"}
+
+
+def make_updates():
+    updates = []
+    chats = [-1_000_000 - i for i in range(CHATS)]
+    for chat_id in chats:
+        updates.append({
+            "update_id": len(updates) + 1,
+            "message": {
+                "message_id": 1, "date": 0, "chat": {"id": chat_id, "type": "group"}, "from": user(1),
+                "text": "/newgame", "entities": [{"type": "bot_command", "offset": 0, "length": 8}],
+            },
+        })
+    for _ in range(TOGGLES):
+        for chat_id in chats:
+            update_id = len(updates) + 1
+            updates.append({
+                "update_id": update_id,
+                "callback_query": {
+                    "id": str(update_id), "from": user(1), "chat_instance": "bench", "data": "st:toggle:points",
+                    "message": {"message_id": 5, "date": 0, "chat": {"id": chat_id, "type": "group"}, "text": "s"},
+                },
+            })
+    return updates
+
+
+def run(workers, updates):
+    os.makedirs(RESULTS, exist_ok=True)
+    for path in glob.glob(os.path.join(RESULTS, "*.json")):
+        os.remove(path)
+    # воркер читает число шардов из окружения при импорте bot.py
+    os.environ["SHARD_WORKERS"] = str(workers)
+    router = bot.ShardRouter(workers, target=worker)
+    for start in range(0, len(updates), BATCH):
+        router.route(updates[start:start + BATCH])
+    router.close(timeout=600)
+    stats = [json.load(open(path)) for path in glob.glob(os.path.join(RESULTS, "*.json"))]
+    assert len(stats) == workers, stats
+    span = max(s["end"] for s in stats) - min(s["first"] for s in stats)
+    cpu = max(s["cpu"] for s in stats)
+    print(
+        f"воркеров {workers}: {len(updates)} апдейтов за {span:.2f} с -> {len(updates) / span:.0f} апд/с, "
+        f"CPU самого загруженного воркера {cpu:.2f} с"
+    )
+
+
+if __name__ == "__main__":
+    print(f"ядер: {os.cpu_count()}")
+    updates = make_updates()
+    for workers in [int(arg) for arg in sys.argv[1:]] or [1, 2, 4, 8]:
+        run(workers, updates)
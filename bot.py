@@ -7,12 +7,14 @@ Truth-or-Dare Telegram Bot — SINGLE FILE (aiogram 3.x)
 - Игра в группах и личке, несколько чатов одновременно
 - Инлайн-управление: Правда/Действие/Пропуск/Завершить
 - Таймер хода (0/20/30/45/60 сек.), автопропуск/штраф
-- Очки, /score, удобное лобби с сохранением состава между партиями
+- Очки, /score, рекорды чата и общий зачёт /top, удобное лобби с сохранением состава между партиями
 - Категории (Лёгкое, Друзья, Романтика, Жесть), возрастные уровни (0+/6+/12+/16+/18+)
 - Настройки: /settings или кнопка — выбор категорий, возраста, таймера, очков, штрафа
 - Мини-"спиннер" для выбора следующего игрока и единая панель прогресса
 - Импорт пользовательской колоды одной командой: /import_deck {JSON}
-  (формат см. ниже)
+  (формат см. ниже) или файлом .json/.ndjson с подписью /import_deck
+- Большие стоковые колоды: python bot.py build-deck deck.json deck.tdeck
+  и STOCK_DECK_PATH=deck.tdeck — колода читается через mmap без разбора JSON
 
 🔐 Безопасность:
 - Токен берётся из ENV-переменной BOT_TOKEN. НИКОГДА не хардкодьте токен в код.
@@ -44,38 +46,161 @@ from dotenv import load_dotenv
 
 load_dotenv()
 import asyncio
+import bisect
+import codecs
+import contextlib
+import contextvars
+import functools
+import gc
+import hashlib
+import heapq
+import itertools
 import json
+import logging
+import multiprocessing
 import html
+import mmap
 import random
 import re
+import socket
+import sqlite3
+import struct
+import sys
+import threading
 import time
-from dataclasses import dataclass, field
-from typing import Dict, List, Optional, Sequence, Set, Tuple
+import urllib.parse
+import weakref
+from abc import ABC, abstractmethod
+from array import array
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass, field
+from typing import Deque, Dict, FrozenSet, Iterable, List, Optional, Sequence, Set, Tuple
 
 from aiogram import Bot, Dispatcher, F
-from aiogram.exceptions import TelegramBadRequest
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import (
+    TelegramBadRequest,
+    TelegramNetworkError,
+    TelegramRetryAfter,
+    TelegramServerError,
+)
+from aiogram.methods import DeleteMessage
 from aiogram.filters import Command, CommandStart
 from aiogram.types import (
     Message,
     CallbackQuery,
+    Document,
     InlineKeyboardMarkup,
     InlineKeyboardButton,
+    Update,
 )
 
+logger = logging.getLogger(__name__)
+
 # ===========================
 # CONFIG
 # ===========================
 
+# python bot.py build-deck deck.json deck.tdeck — собрать бинарную колоду без запуска бота
+BUILD_DECK_MODE = __name__ == "__main__" and sys.argv[1:2] == ["build-deck"]
+
 BOT_TOKEN = os.getenv("BOT_TOKEN", "").strip()
-if not BOT_TOKEN:
+if not BOT_TOKEN and not BUILD_DECK_MODE:
     raise SystemExit(
         "❌ BOT_TOKEN не найден. Установите переменную окружения, например:\n"
         "BOT_TOKEN=123:ABC python bot.py"
     )
 
+# Скомпилированная стоковая колода (.tdeck); если задана, заменяет встроенную
+STOCK_DECK_PATH = os.getenv("STOCK_DECK_PATH", "").strip()
+
+# Хранилище состояния игр: sqlite, memory или redis. Redis позволяет нескольким
+# репликам бота обслуживать одни и те же чаты за общим webhook
+STATE_BACKEND = os.getenv("STATE_BACKEND", "sqlite").strip()
+if STATE_BACKEND not in ("sqlite", "memory", "redis"):
+    raise SystemExit("❌ STATE_BACKEND должен быть sqlite, memory или redis.")
+# Файл SQLite с состоянием игр; пустое значение — хранить только в памяти
+STATE_DB_PATH = os.getenv("STATE_DB_PATH", "state.sqlite3").strip()
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0").strip()
+REDIS_PREFIX = os.getenv("REDIS_PREFIX", "tod:")
+# Таймаут сокета Redis: зависший сервер не должен держать поток хранилища вечно
+REDIS_TIMEOUT = float(os.getenv("REDIS_TIMEOUT", "5"))
+STATE_FLUSH_INTERVAL = 2.0
+# Сколько игр держать в памяти и через сколько секунд простоя выгружать игру в базу
+GAME_CACHE_LIMIT = int(os.getenv("GAME_CACHE_LIMIT", "5000"))
+GAME_IDLE_TIMEOUT = float(os.getenv("GAME_IDLE_TIMEOUT", "1800"))
+# Игры, которых касались недавно, не выгружаются даже сверх лимита
+GAME_EVICT_MIN_IDLE = 60.0
+
+# Шардирование: SHARD_WORKERS > 0 — фронт-процесс принимает апдейты и раздаёт
+# их воркерам по chat_id; SHARD_INDEX выставляется фронтом в окружении воркера
+SHARD_WORKERS = int(os.getenv("SHARD_WORKERS", "0"))
+SHARD_INDEX = os.getenv("SHARD_INDEX")
+if SHARD_INDEX is not None and SHARD_WORKERS <= 0:
+    raise SystemExit("❌ SHARD_INDEX задан без SHARD_WORKERS: воркер шарда запускается фронтом с SHARD_WORKERS > 0.")
+if SHARD_INDEX is not None and not (SHARD_INDEX.isdigit() and int(SHARD_INDEX) < SHARD_WORKERS):
+    raise SystemExit(f"❌ SHARD_INDEX должен быть числом от 0 до {SHARD_WORKERS - 1}.")
+IS_SHARD_FRONT = SHARD_WORKERS > 0 and SHARD_INDEX is None
+# Приём апдейтов фронтом: polling или webhook
+SHARD_INTAKE = os.getenv("SHARD_INTAKE", "polling").strip()
+if SHARD_INTAKE not in ("polling", "webhook"):
+    raise SystemExit("❌ SHARD_INTAKE должен быть polling или webhook.")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").strip()
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook").strip()
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0").strip()
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "").strip()
+if IS_SHARD_FRONT and SHARD_INTAKE == "webhook" and not WEBHOOK_URL:
+    raise SystemExit("❌ Для приёма через webhook задайте WEBHOOK_URL.")
+
+# Каталог журнала событий игр; пустое значение — журнал не ведётся.
+# У каждого шарда свой подкаталог: номера сегментов ведёт один процесс
+JOURNAL_DIR = os.getenv("JOURNAL_DIR", "journal").strip()
+if JOURNAL_DIR and SHARD_INDEX is not None:
+    JOURNAL_DIR = os.path.join(JOURNAL_DIR, f"shard-{SHARD_INDEX}")
+JOURNAL_FLUSH_INTERVAL = 0.25
+JOURNAL_SEGMENT_BYTES = 4 * 1024 * 1024
+# Сколько закрытых сегментов копить до сворачивания их в снимок
+JOURNAL_COMPACT_SEGMENTS = 8
+# Файл колоды моложе стольких секунд свёртка не удаляет, даже если ссылок на него нет
+JOURNAL_DECK_GRACE = 600.0
+
+# Сколько мест показывать в табло партии и в рекордах; кэш рекордов
+# сверяется с хранилищем не реже раза в LEADERBOARD_TTL секунд
+SCOREBOARD_SIZE = 10
+LEADERBOARD_TTL = 30.0
+# Сколько последних раундов помнит игра и сколько показывает /history по умолчанию
+HISTORY_SIZE = 50
+HISTORY_DEFAULT_LIMIT = 10
+
 # Тайминги анимации спиннера
 SPINNER_STEPS = 10
 SPINNER_DELAY = 0.12
+# Не чаще одной правки панели за столько секунд на чат: промежуточные кадры,
+# не успевшие уйти, заменяются последним
+PANEL_EDIT_INTERVAL = float(os.getenv("PANEL_EDIT_INTERVAL", "1.0"))
+
+# Повтор правок сообщений: сколько попыток всего, первая пауза после сетевого
+# сбоя (дальше удваивается) и дольше скольких секунд flood control не ждём
+EDIT_RETRY_ATTEMPTS = 4
+EDIT_RETRY_BACKOFF = 0.5
+EDIT_RETRY_MAX_WAIT = 60.0
+
+# Общий бюджет исходящих запросов к Bot API (token bucket: скорость + ёмкость).
+# Ёмкость + скорость × окно укладываются в лимиты Telegram: 30 сообщений в секунду
+# на бота, около одного в секунду на чат и 20 в минуту на группу. Воркеры шардов
+# делят глобальную скорость поровну
+OUTBOUND_GLOBAL_RATE = float(os.getenv("OUTBOUND_GLOBAL_RATE", "25"))
+OUTBOUND_GLOBAL_BURST = 5
+OUTBOUND_CHAT_RATE = 1.0
+OUTBOUND_CHAT_BURST = 1
+OUTBOUND_GROUP_PER_MINUTE = float(os.getenv("OUTBOUND_GROUP_PER_MINUTE", "16"))
+OUTBOUND_GROUP_BURST = 4
+# Сверх стольких корзин по чатам полные (простаивающие) выбрасываются
+OUTBOUND_BUCKET_LIMIT = 4096
+# Сколько вариантов меню настроек и меню игроков держать готовыми
+KEYBOARD_CACHE_SIZE = 512
 SAFETY_NOTE = " Только по добровольному согласию, без вреда здоровью. Можно пропустить без штрафа."
 KEYWORD_PATTERN = re.compile(r"[a-zA-Zа-яА-ЯёЁ0-9]+")
 
@@ -677,11 +802,27 @@ def apply_safety_note(deck: List[Dict]):
 
 apply_safety_note(DEFAULT_DECK)
 
+CARD_TYPES: Sequence[str] = ("truth", "dare")
 TIMER_OPTIONS: Sequence[int] = (0, 20, 30, 45, 60)
 DEFAULT_TIMER_SECONDS = 30
 DEFAULT_AGE_LEVEL = "16+"
 DEFAULT_CATEGORY_KEY = "Лёгкое"
 DEFAULT_CATEGORY_SET: Set[str] = {DEFAULT_CATEGORY_KEY}
+DEFAULT_CATEGORIES: FrozenSet[str] = frozenset(DEFAULT_CATEGORY_SET)
+# Колоды до этого размера перемешиваем целиком, большие — лениво (сеть Фейстеля)
+EAGER_SHUFFLE_LIMIT = 2048
+SHUFFLE_ROUNDS = 6
+# Потоковый импорт колоды из файла
+DECK_FILE_EXTENSIONS: Tuple[str, ...] = (".json", ".ndjson", ".jsonl")
+DECK_MAX_FILE_BYTES = 20 * 1024 * 1024  # лимит getFile в Bot API
+DECK_MAX_ITEM_CHARS = 64 * 1024
+DECK_IMPORT_CHUNK = 64 * 1024
+DECK_IMPORT_BATCH = 2000
+DECK_PROGRESS_INTERVAL = 1.5
+# Пачки от этого размера разбираются и проверяются в потоке, а не в цикле событий
+DECK_OFFLOAD_MIN_ITEMS = 200
+# Сколько вариантов фильтра (тип, возраст, категории) держим в индексе колоды игры
+DECK_INDEX_LIMIT = 4
 SELECTED_MARK = "✅"
 UNSELECTED_MARK = "▫️"
 MAX_NAME_LENGTH = 32
@@ -718,6 +859,7 @@ MESSAGES = {
     "NO_PLAYERS_END": "🏁 Игра остановлена: игроков не осталось.",
     "CARD_REROLL_NO_OPTIONS": "Других карточек не осталось — остаёмся на этой.",
     "CARD_REROLL_OK": "Новая карточка готова!",
+    "DECK_IMPORT_BUSY": "⏳ Импорт колоды в этом чате уже идёт, дождитесь его завершения.",
 }
 
 
@@ -755,20 +897,25 @@ def _candidate_with_suffix(base: str, suffix_index: int) -> str:
     return f"{core}{suffix}"
 
 
+def is_name_taken(game: "ChatGame", name: str, *, exclude_id: Optional[int] = None) -> bool:
+    key = name.casefold()
+    count = game.player_names.get(key, 0)
+    if count and exclude_id is not None:
+        excluded = game.players_by_id.get(exclude_id)
+        if excluded is not None and excluded.name.casefold() == key:
+            count -= 1
+    return count > 0
+
+
 def ensure_unique_name(
     game: "ChatGame", base_name: str, *, exclude_id: Optional[int] = None
 ) -> str:
     desired = base_name or DEFAULT_PLAYER_NAME
-    existing = {
-        p.name.casefold()
-        for p in getattr(game, "players", [])
-        if exclude_id is None or p.user_id != exclude_id
-    }
-    if desired.casefold() not in existing:
+    if not is_name_taken(game, desired, exclude_id=exclude_id):
         return desired
     for suffix_index in range(2, 200):
         candidate = _candidate_with_suffix(desired, suffix_index)
-        if candidate.casefold() not in existing:
+        if not is_name_taken(game, candidate, exclude_id=exclude_id):
             return candidate
     # крайний случай — добавим порядковый номер, сохранив длину
     fallback = _candidate_with_suffix(desired, random.randint(200, 999))
@@ -803,51 +950,647 @@ def extract_keywords(text: str, *, limit: int = 6) -> Set[str]:
             break
     return set(keywords)
 
+
+# Сигнатура карточки: (свёрнутая битовая маска, отсортированные id слов из словаря)
+KeywordSignature = Tuple[int, Tuple[int, ...]]
+EMPTY_SIGNATURE: KeywordSignature = (0, ())
+KEYWORD_MASK_BITS = 256
+KEYWORD_VOCABULARY: Dict[str, int] = {}
+
+
+# next() у счётчика атомарен под GIL — словарь пополняется и из потока импорта колод
+_KEYWORD_IDS = itertools.count()
+
+
+def intern_keyword(word: str) -> int:
+    keyword_id = KEYWORD_VOCABULARY.get(word)
+    if keyword_id is None:
+        keyword_id = KEYWORD_VOCABULARY.setdefault(word, next(_KEYWORD_IDS))
+    return keyword_id
+
+
+def keyword_signature(text: str) -> KeywordSignature:
+    ids = tuple(sorted(intern_keyword(word) for word in extract_keywords(text)))
+    return keyword_mask(ids), ids
+
+
+def keyword_mask(ids: Iterable[int]) -> int:
+    mask = 0
+    for keyword_id in ids:
+        mask |= 1 << (keyword_id % KEYWORD_MASK_BITS)
+    return mask
+
+
+def signatures_overlap(first: KeywordSignature, second: KeywordSignature) -> bool:
+    """Есть ли общие ключевые слова: AND масок, id сверяем только при совпадении битов."""
+    if not first[0] & second[0]:
+        return False
+    other_ids = second[1]
+    return any(keyword_id in other_ids for keyword_id in first[1])
+
+
+# Коды типов, возрастов и категорий — индексы в этих кортежах
+AGE_KEYS: Tuple[str, ...] = tuple(AGE_LEVELS)
+CATEGORY_KEYS: Tuple[str, ...] = tuple(CATEGORY_INFO)
+CARD_TYPE_CODES: Dict[str, int] = {key: code for code, key in enumerate(CARD_TYPES)}
+AGE_CODES: Dict[str, int] = {key: code for code, key in enumerate(AGE_KEYS)}
+CATEGORY_CODES: Dict[str, int] = {key: code for code, key in enumerate(CATEGORY_KEYS)}
+
+
+@dataclass(frozen=True, slots=True)
+class Card:
+    """Компактная карточка: тип, возраст и категория хранятся кодами."""
+    id: str
+    type_code: int
+    age_code: int
+    category_code: int
+    text: str
+    tags: Tuple[str, ...]
+    keyword_mask: int
+    keyword_ids: Tuple[int, ...]
+
+    @property
+    def type(self) -> str:
+        return CARD_TYPES[self.type_code]
+
+    @property
+    def age(self) -> str:
+        return AGE_KEYS[self.age_code]
+
+    @property
+    def category(self) -> str:
+        return CATEGORY_KEYS[self.category_code]
+
+    @property
+    def keywords(self) -> KeywordSignature:
+        return self.keyword_mask, self.keyword_ids
+
+
+def card_from_dict(raw: Dict) -> Card:
+    """Упаковать проверенную карточку; сигнатура ключевых слов считается здесь один раз."""
+    text = raw.get("text", "")
+    tags = raw.get("tags") or ()
+    keyword_mask, keyword_ids = keyword_signature(text)
+    return Card(
+        id=raw["id"],
+        type_code=CARD_TYPE_CODES[raw["type"]],
+        age_code=AGE_CODES[raw["age"]],
+        category_code=CATEGORY_CODES[raw["category"]],
+        text=text,
+        tags=tuple(sys.intern(str(tag)) for tag in tags),
+        keyword_mask=keyword_mask,
+        keyword_ids=keyword_ids,
+    )
+
+
+DEFAULT_DECK: List[Card] = [card_from_dict(raw) for raw in DEFAULT_DECK]
+
+# (тип, возраст, категория) -> карточки; из корзин собираются отфильтрованные колоды
+DeckBucketKey = Tuple[str, str, str]
+
+
+def add_to_buckets(buckets: Dict[DeckBucketKey, List[Card]], cards: Sequence[Card]):
+    for card in cards:
+        buckets.setdefault((card.type, card.age, card.category), []).append(card)
+
+
+DEFAULT_DECK_BUCKETS: Dict[DeckBucketKey, List[Card]] = {}
+add_to_buckets(DEFAULT_DECK_BUCKETS, DEFAULT_DECK)
+DEFAULT_DECK_IDS: FrozenSet[str] = frozenset(card.id for card in DEFAULT_DECK)
+DEFAULT_DECK_BY_ID: Dict[str, Card] = {card.id: card for card in DEFAULT_DECK}
+
+# ===========================
+# СКОМПИЛИРОВАННЫЕ КОЛОДЫ
+# ===========================
+#
+# Формат .tdeck (little-endian): заголовок, JSON с метаданными и таблицами кодов,
+# записи карточек фиксированной длины, индекс id (позиции, отсортированные по id),
+# словарь ключевых слов, id ключевых слов карточек, корзины (тип, возраст, категория)
+# со списками позиций и общий блок строк. Файл открывается через mmap:
+# тексты читаются по смещению только для выданных карточек, страницы файла
+# общие для всех процессов бота.
+
+DECK_MAGIC = b"TODDECK1"
+DECK_HEADER = struct.Struct("<8s11I")
+DECK_RECORD = struct.Struct("<4B8I")
+DECK_BUCKET = struct.Struct("<4B2I")
+DECK_SPAN = struct.Struct("<2I")
+TAG_SEPARATOR = "\x1f"
+
+
+class DeckFormatError(ValueError):
+    """Файл колоды не удалось разобрать."""
+
+
+def normalize_deck_item(raw: object) -> Optional[Dict]:
+    """Проверить и нормализовать карточку импорта; None — карточка отклонена."""
+    if not isinstance(raw, dict):
+        return None
+    if not all(key in raw for key in ("id", "type", "category", "age", "text")):
+        return None
+
+    card_id = str(raw["id"]).strip()
+    card_type = str(raw["type"]).strip()
+    category = raw["category"]
+    age = raw["age"]
+    text = str(raw["text"]).strip()
+
+    if (
+        not card_id
+        or card_type not in {"truth", "dare"}
+        or not isinstance(category, str)
+        or category not in CATEGORY_INFO
+        or not isinstance(age, str)
+        or age not in AGE_LEVELS
+        or not text
+    ):
+        return None
+
+    tags = raw.get("tags")
+    card = {
+        "id": card_id,
+        "type": card_type,
+        "category": category,
+        "age": age,
+        "tags": tags if isinstance(tags, list) else [],
+        "text": text,
+    }
+    apply_safety_note([card])
+    return card
+
+
+def compile_deck(payload: Dict, path: str) -> Tuple[int, int]:
+    """Собрать .tdeck из JSON {"meta", "items"}; возвращает (записано, пропущено)."""
+    items = payload.get("items")
+    if not isinstance(items, list):
+        raise DeckFormatError("поле items должно быть списком")
+
+    cards: List[Dict] = []
+    seen_ids: Set[str] = set()
+    skipped = 0
+    for raw in items:
+        card = normalize_deck_item(raw)
+        if card is None or card["id"] in seen_ids:
+            skipped += 1
+            continue
+        seen_ids.add(card["id"])
+        cards.append(card)
+
+    strings = bytearray()
+
+    def put(value: str) -> Tuple[int, int]:
+        data = value.encode("utf-8")
+        offset = len(strings)
+        strings.extend(data)
+        return offset, len(data)
+
+    vocabulary: Dict[str, int] = {}
+    records = bytearray()
+    keyword_ids = array("I")
+    buckets: Dict[Tuple[int, int, int], List[int]] = {}
+    for position, card in enumerate(cards):
+        codes = (
+            CARD_TYPE_CODES[card["type"]],
+            AGE_CODES[card["age"]],
+            CATEGORY_CODES[card["category"]],
+        )
+        local_ids = sorted(
+            vocabulary.setdefault(word, len(vocabulary))
+            for word in sorted(extract_keywords(card["text"]))
+        )
+        records += DECK_RECORD.pack(
+            *codes, 0,
+            *put(card["id"]),
+            *put(card["text"]),
+            *put(TAG_SEPARATOR.join(str(tag) for tag in card["tags"])),
+            len(keyword_ids), len(local_ids),
+        )
+        keyword_ids.extend(local_ids)
+        buckets.setdefault(codes, []).append(position)
+
+    id_index = array("I", sorted(range(len(cards)), key=lambda i: cards[i]["id"].encode("utf-8")))
+    vocabulary_spans = bytearray()
+    for word in vocabulary:
+        vocabulary_spans += DECK_SPAN.pack(*put(word))
+    bucket_table = bytearray()
+    bucket_positions = array("I")
+    for codes in sorted(buckets):
+        positions = buckets[codes]
+        bucket_table += DECK_BUCKET.pack(*codes, 0, len(bucket_positions), len(positions))
+        bucket_positions.extend(positions)
+    if sys.byteorder != "little":
+        for table in (keyword_ids, id_index, bucket_positions):
+            table.byteswap()
+
+    meta = json.dumps(
+        {
+            "meta": payload.get("meta") or {},
+            "types": list(CARD_TYPES),
+            "ages": list(AGE_KEYS),
+            "categories": list(CATEGORY_KEYS),
+        },
+        ensure_ascii=False,
+    ).encode("utf-8")
+    sections = [meta, bytes(records), id_index.tobytes(), bytes(vocabulary_spans),
+                keyword_ids.tobytes(), bytes(bucket_table) + bucket_positions.tobytes(), bytes(strings)]
+    offsets: List[int] = []
+    offset = DECK_HEADER.size
+    for data in sections:
+        offsets.append(offset)
+        offset += len(data)
+    header = DECK_HEADER.pack(
+        DECK_MAGIC, len(cards), len(vocabulary), len(buckets),
+        offsets[0], len(meta), *offsets[1:],
+    )
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as out:
+        out.write(header)
+        for data in sections:
+            out.write(data)
+    os.replace(tmp_path, path)
+    return len(cards), skipped
+
+
+class CompiledDeck:
+    """Колода из .tdeck в mmap: карточки собираются по позиции только при обращении."""
+
+    def __init__(self, path: str):
+        if sys.byteorder != "little":
+            raise DeckFormatError("формат .tdeck поддерживается только на little-endian")
+        with open(path, "rb") as source:
+            self.data = mmap.mmap(source.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self.data) < DECK_HEADER.size:
+            raise DeckFormatError("файл колоды повреждён")
+        (
+            magic, self.size, vocabulary_size, bucket_count, meta_offset, meta_size,
+            self.records_offset, id_index_offset, vocabulary_offset, keywords_offset,
+            buckets_offset, self.strings_offset,
+        ) = DECK_HEADER.unpack_from(self.data)
+        if magic != DECK_MAGIC:
+            raise DeckFormatError("это не файл .tdeck или другая версия формата")
+        meta = json.loads(self.data[meta_offset:meta_offset + meta_size])
+        if (
+            meta.get("types") != list(CARD_TYPES)
+            or meta.get("ages") != list(AGE_KEYS)
+            or meta.get("categories") != list(CATEGORY_KEYS)
+        ):
+            raise DeckFormatError("колода собрана под другие типы, возрасты или категории — пересоберите её")
+        self.meta: Dict = meta.get("meta") or {}
+        view = memoryview(self.data)
+        self.id_index = view[id_index_offset:id_index_offset + 4 * self.size].cast("I")
+        self.vocabulary_offset = vocabulary_offset
+        self.keyword_table = view[keywords_offset:buckets_offset].cast("I")
+        # локальные id ключевых слов файла -> id словаря процесса, заполняется по мере чтения
+        self.keyword_remap: List[int] = [-1] * vocabulary_size
+        self.buckets: Dict[DeckBucketKey, memoryview] = {}
+        positions_offset = buckets_offset + DECK_BUCKET.size * bucket_count
+        for number in range(bucket_count):
+            type_code, age_code, category_code, _, start, count = DECK_BUCKET.unpack_from(
+                self.data, buckets_offset + DECK_BUCKET.size * number
+            )
+            begin = positions_offset + 4 * start
+            key = (CARD_TYPES[type_code], AGE_KEYS[age_code], CATEGORY_KEYS[category_code])
+            self.buckets[key] = view[begin:begin + 4 * count]
+
+    def __len__(self) -> int:
+        return self.size
+
+    def _string(self, offset: int, length: int) -> str:
+        start = self.strings_offset + offset
+        return str(self.data[start:start + length], "utf-8")
+
+    def _record(self, position: int) -> Tuple[int, ...]:
+        return DECK_RECORD.unpack_from(self.data, self.records_offset + DECK_RECORD.size * position)
+
+    def card_id(self, position: int) -> str:
+        record = self._record(position)
+        return self._string(record[4], record[5])
+
+    def codes(self, position: int) -> Tuple[int, int, int]:
+        record = self._record(position)
+        return record[0], record[1], record[2]
+
+    def find(self, card_id: str) -> Optional[int]:
+        """Позиция карточки по id: двоичный поиск по индексу в файле."""
+        target = card_id.encode("utf-8")
+        low, high = 0, self.size
+        while low < high:
+            middle = (low + high) // 2
+            position = self.id_index[middle]
+            record = self._record(position)
+            start = self.strings_offset + record[4]
+            current = self.data[start:start + record[5]]
+            if current == target:
+                return position
+            if current < target:
+                low = middle + 1
+            else:
+                high = middle
+        return None
+
+    def _keyword_id(self, local_id: int) -> int:
+        keyword_id = self.keyword_remap[local_id]
+        if keyword_id < 0:
+            offset, length = DECK_SPAN.unpack_from(
+                self.data, self.vocabulary_offset + DECK_SPAN.size * local_id
+            )
+            keyword_id = intern_keyword(self._string(offset, length))
+            self.keyword_remap[local_id] = keyword_id
+        return keyword_id
+
+    def card(self, position: int) -> Card:
+        (
+            type_code, age_code, category_code, _,
+            id_offset, id_size, text_offset, text_size, tags_offset, tags_size,
+            keywords_start, keywords_count,
+        ) = self._record(position)
+        tags = self._string(tags_offset, tags_size)
+        keyword_ids = tuple(sorted(
+            self._keyword_id(local_id)
+            for local_id in self.keyword_table[keywords_start:keywords_start + keywords_count]
+        ))
+        return Card(
+            id=self._string(id_offset, id_size),
+            type_code=type_code,
+            age_code=age_code,
+            category_code=category_code,
+            text=self._string(text_offset, text_size),
+            tags=tuple(sys.intern(tag) for tag in tags.split(TAG_SEPARATOR)) if tags else (),
+            keyword_mask=keyword_mask(keyword_ids),
+            keyword_ids=keyword_ids,
+        )
+
+
+def build_deck_cli(args: List[str]) -> int:
+    if len(args) != 2:
+        print("Использование: python bot.py build-deck deck.json deck.tdeck")
+        return 2
+    source, target = args
+    try:
+        with open(source, encoding="utf-8-sig") as fh:
+            payload = json.load(fh)
+        if not isinstance(payload, dict):
+            raise DeckFormatError("ожидался объект {\"meta\": ..., \"items\": [...]}")
+        written, skipped = compile_deck(payload, target)
+    except (OSError, ValueError) as exc:
+        print(f"❌ Не удалось собрать колоду: {exc}")
+        return 1
+    print(f"✅ {target}: карточек {written}, пропущено {skipped}")
+    return 0
+
+
+if BUILD_DECK_MODE:
+    raise SystemExit(build_deck_cli(sys.argv[2:]))
+
+STOCK_DECK: Optional[CompiledDeck] = CompiledDeck(STOCK_DECK_PATH) if STOCK_DECK_PATH else None
+
 # ===========================
 # ИГРОВЫЕ СТРУКТУРЫ
 # ===========================
 
-@dataclass
+@dataclass(slots=True)
 class Player:
     user_id: int
     name: str
     is_virtual: bool = False
 
-@dataclass
+@dataclass(slots=True)
 class Turn:
     player_id: int
     type: Optional[str] = None            # "truth" | "dare"
     card_id: Optional[str] = None
     message_id: Optional[int] = None      # сообщение с выбором/заданием
     rerolled: bool = False
+    started_at: float = 0.0               # time.time() начала хода или показа карточки
 
 @dataclass
+class CardPool:
+    """Отфильтрованная часть колоды: порядок карточек и доступ по id.
+
+    Карточки скомпилированной колоды идут первыми и хранятся позициями в файле.
+    """
+    cards: List[Card] = field(default_factory=list)
+    by_id: Dict[str, Card] = field(default_factory=dict)
+    compiled: Optional[CompiledDeck] = None
+    positions: array = field(default_factory=lambda: array("I"))
+    compiled_codes: FrozenSet[Tuple[int, int, int]] = frozenset()
+
+    def add(self, card: Card):
+        card_id = card.id
+        if card_id in self.by_id:
+            return
+        self.by_id[card_id] = card
+        self.cards.append(card)
+
+    def add_buckets(self, buckets: Dict[DeckBucketKey, List[Card]], keys: Sequence[DeckBucketKey]):
+        for key in keys:
+            for card in buckets.get(key, ()):
+                self.add(card)
+
+    def extended(self, buckets: Dict[DeckBucketKey, List[Card]], keys: Sequence[DeckBucketKey]) -> "CardPool":
+        """Копия с карточками ещё одной колоды в конце; сама колода может быть общей."""
+        pool = CardPool(
+            cards=list(self.cards),
+            by_id=dict(self.by_id),
+            compiled=self.compiled,
+            # позиции скомпилированной колоды после сборки не меняются
+            positions=self.positions,
+            compiled_codes=self.compiled_codes,
+        )
+        pool.add_buckets(buckets, keys)
+        return pool
+
+    def add_compiled(self, deck: CompiledDeck, keys: Sequence[DeckBucketKey]):
+        self.compiled = deck
+        for key in keys:
+            bucket = deck.buckets.get(key)
+            if bucket is not None:
+                self.positions.frombytes(bucket)
+        self.compiled_codes = frozenset(
+            (CARD_TYPE_CODES[kind], AGE_CODES[age], CATEGORY_CODES[category])
+            for kind, age, category in keys
+        )
+
+    def card_id_at(self, index: int) -> str:
+        if index < len(self.positions):
+            return self.compiled.card_id(self.positions[index])
+        return self.cards[index - len(self.positions)].id
+
+    def get(self, card_id: str) -> Optional[Card]:
+        card = self.by_id.get(card_id)
+        if card is None and self.compiled is not None:
+            position = self.compiled.find(card_id)
+            if position is not None and self.compiled.codes(position) in self.compiled_codes:
+                card = self.compiled.card(position)
+        return card
+
+    def __iter__(self):
+        for position in self.positions:
+            yield self.compiled.card(position)
+        yield from self.cards
+
+    def __len__(self) -> int:
+        return len(self.positions) + len(self.cards)
+
+
+@dataclass
+class LazyShuffle:
+    """Ленивая случайная перестановка 0..size-1.
+
+    Небольшие колоды перемешиваем честно и целиком (компактный массив индексов),
+    большие — сетью Фейстеля с cycle walking: следующая позиция считается по запросу,
+    и память не зависит от размера колоды.
+    """
+    size: int
+    keys: Tuple[int, ...] = ()
+    half_bits: int = 0
+    cursor: int = 0
+    order: Optional[array] = None
+
+    @classmethod
+    def create(cls, size: int) -> "LazyShuffle":
+        if size <= EAGER_SHUFFLE_LIMIT:
+            order = array("I", range(size))
+            random.shuffle(order)
+            return cls(size=size, order=order)
+        bits = (size - 1).bit_length()
+        keys = tuple(random.getrandbits(64) for _ in range(SHUFFLE_ROUNDS))
+        return cls(size=size, keys=keys, half_bits=(bits + 1) // 2)
+
+    @property
+    def remaining(self) -> int:
+        return self.size - self.cursor
+
+    def _permute(self, value: int) -> int:
+        mask = (1 << self.half_bits) - 1
+        left, right = value >> self.half_bits, value & mask
+        for key in self.keys:
+            left, right = right, left ^ (hash((key, right)) & mask)
+        return (left << self.half_bits) | right
+
+    def next_index(self) -> Optional[int]:
+        if self.cursor >= self.size:
+            return None
+        if self.order is not None:
+            value = self.order[self.cursor]
+        else:
+            value = self._permute(self.cursor)
+            # домен сети — степень двойки, лишние значения проходим дальше по циклу
+            while value >= self.size:
+                value = self._permute(value)
+        self.cursor += 1
+        return value
+
+
+@dataclass(slots=True)
+class DealQueue:
+    """Очередь раздачи: сверху — ленивая перестановка колоды, снизу — отложенные карточки.
+
+    Все операции O(1); у нижней части правый край ближе к верху колоды.
+    """
+    shuffle: Optional[LazyShuffle] = None
+    items: Deque[str] = field(default_factory=deque)
+    members: Set[str] = field(default_factory=set)
+
+    def __len__(self) -> int:
+        remaining = self.shuffle.remaining if self.shuffle else 0
+        return remaining + len(self.items)
+
+    def start_cycle(self, size: int):
+        self.shuffle = LazyShuffle.create(size)
+
+    def push_bottom(self, card_id: str):
+        if card_id in self.members:
+            return
+        self.members.add(card_id)
+        self.items.appendleft(card_id)
+
+    def pop(self, pool: "CardPool") -> Optional[str]:
+        while self.shuffle is not None:
+            index = self.shuffle.next_index()
+            if index is None:
+                self.shuffle = None
+            elif index < len(pool):
+                return pool.card_id_at(index)
+        if not self.items:
+            return None
+        card_id = self.items.pop()
+        self.members.discard(card_id)
+        return card_id
+
+
+@dataclass(eq=False)
+class SharedDeck:
+    """Импортированная колода: неизменяемая и общая для всех чатов с тем же содержимым."""
+    digest: str
+    cards: Tuple[Card, ...]
+    ids: FrozenSet[str]
+    buckets: Dict[DeckBucketKey, List[Card]]
+    refs: int = 0
+
+
+# (тип, допустимые возрасты, категории) -> отфильтрованная колода
+DeckIndexKey = Tuple[str, FrozenSet[str], FrozenSet[str]]
+
+
+@dataclass(slots=True)
+class GameSettings:
+    """Настройки партии: значения проверяются при загрузке, а не при каждом чтении."""
+    timer: int = DEFAULT_TIMER_SECONDS
+    points: bool = True
+    skip_penalty: int = 0  # 0 или -1
+    age_level: str = DEFAULT_AGE_LEVEL
+    categories: FrozenSet[str] = DEFAULT_CATEGORIES
+
+    @classmethod
+    def from_dict(cls, raw: Dict) -> "GameSettings":
+        """Собрать из сохранённого словаря; старое поле category переносится в categories."""
+        settings = cls()
+        if raw.get("timer") in TIMER_OPTIONS:
+            settings.timer = raw["timer"]
+        settings.points = bool(raw.get("points", True))
+        settings.skip_penalty = -1 if raw.get("skip_penalty") == -1 else 0
+        if raw.get("age_level") in AGE_LEVELS:
+            settings.age_level = raw["age_level"]
+        categories = raw.get("categories")
+        if categories is None and "category" in raw:
+            categories = [raw["category"]]
+        if isinstance(categories, (list, tuple, set, frozenset)):
+            valid = frozenset(c for c in categories if isinstance(c, str) and c in CATEGORY_INFO)
+            if valid:
+                settings.categories = valid
+        return settings
+
+    def to_dict(self) -> Dict:
+        return {
+            "timer": self.timer,
+            "points": self.points,
+            "skip_penalty": self.skip_penalty,
+            "age_level": self.age_level,
+            "categories": sorted(self.categories),
+        }
+
+
+@dataclass(slots=True)
 class ChatGame:
     chat_id: int
     host_id: int
     players: List[Player] = field(default_factory=list)
+    # индексы по players; меняются только через register/drop/rename_player
+    players_by_id: Dict[int, Player] = field(default_factory=dict)
+    player_names: Dict[str, int] = field(default_factory=dict)  # casefold(имя) -> сколько игроков
     current_idx: int = -1
     in_progress: bool = False
     scores: Dict[int, int] = field(default_factory=dict)
-    used_ids: Set[str] = field(default_factory=set)
-    settings: Dict = field(
-        default_factory=lambda: {
-            "timer": DEFAULT_TIMER_SECONDS,
-            "points": True,
-            "skip_penalty": 0,
-            "age_level": DEFAULT_AGE_LEVEL,
-            "categories": set(DEFAULT_CATEGORY_SET),
-        }
-    )
+    dealt_in_cycle: int = 0  # сколько карточек роздано с последнего перемешивания
+    settings: GameSettings = field(default_factory=GameSettings)
     current_turn: Optional[Turn] = None
     timer_task: Optional[asyncio.Task] = None
-    extra_deck: List[Dict] = field(default_factory=list)  # пользовательские элементы
-    deck_cache: Dict[str, List[str]] = field(
-        default_factory=lambda: {"truth": [], "dare": []}
-    )
-    last_keywords: Dict[str, Set[str]] = field(
-        default_factory=lambda: {"truth": set(), "dare": set()}
-    )
+    extra_decks: List[SharedDeck] = field(default_factory=list)  # пользовательские колоды
+    deck_index: Dict[DeckIndexKey, CardPool] = field(default_factory=dict)
+    # очереди и сигнатуры создаются при первой раздаче карточки этого типа
+    deck_cache: Dict[str, DealQueue] = field(default_factory=dict)
+    last_keywords: Dict[str, KeywordSignature] = field(default_factory=dict)
     lobby_message_id: Optional[int] = None
     settings_message_id: Optional[int] = None
     panel_message_id: Optional[int] = None
@@ -855,6 +1598,18 @@ class ChatGame:
     virtual_counter: int = 0
     player_menu_message_id: Optional[int] = None
     player_menu_state: str = "root"
+    last_active: float = field(default_factory=time.monotonic)
+    # версия сохранённого состояния, от которого отталкивается эта копия; 0 — ещё не сохранялась
+    version: int = 0
+    # хэш последнего записанного состояния: совпал — сохранять нечего
+    saved_digest: bytes = b""
+    # топ scores для табло; None — собрать заново при следующем показе
+    ranking: Optional["TopK"] = None
+    # создаётся с первым сыгранным раундом
+    history: Optional["RoundHistory"] = None
+    # lobby/panel/settings/player_menu -> (message_id, render_key) последней отрисовки;
+    # не сохраняется: после перезапуска первая правка просто уйдёт в Telegram
+    rendered: Dict[str, Tuple[int, int]] = field(default_factory=dict)
 
     def current_player(self) -> Optional[Player]:
         if not self.players:
@@ -864,70 +1619,379 @@ class ChatGame:
         return self.players[self.current_idx % len(self.players)]
 
 
-@dataclass
+@dataclass(slots=True)
 class PendingPlayerAddition:
     chat_id: int
     host_id: int
     message_id: Optional[int] = None
+    expires_at: float = 0.0
 
 
-@dataclass
+@dataclass(slots=True)
 class PendingPlayerRename:
     chat_id: int
     host_id: int
     player_id: int
+    message_id: Optional[int] = None
+    expires_at: float = 0.0
+
+
+@dataclass(slots=True)
+class ChatPending:
+    """Эфемерное состояние одного чата; ключ во вложенных словарях — user_id."""
+    additions: Dict[int, PendingPlayerAddition] = field(default_factory=dict)
+    renames: Dict[int, PendingPlayerRename] = field(default_factory=dict)
+    end_confirmations: Dict[int, float] = field(default_factory=dict)  # user_id -> срок
+
+    def is_empty(self) -> bool:
+        return not (self.additions or self.renames or self.end_confirmations)
+
+
+class TimingWheel:
+    """Колесо таймеров: постановка за O(1), за тик разбирается один слот.
+
+    Слот может вернуть ключ раньше срока (срок дальше одного оборота колеса или
+    продлён) — вызывающий сверяет настоящий срок и при необходимости ставит ключ заново.
+    """
+
+    def __init__(self, tick: float, size: int):
+        self.tick = tick
+        self.slots: List[Set[Tuple]] = [set() for _ in range(size)]
+        self.cursor = int(time.monotonic() / tick)
+
+    def schedule(self, key: Tuple, deadline: float):
+        position = max(int(deadline / self.tick) + 1, self.cursor + 1)
+        self.slots[position % len(self.slots)].add(key)
+
+    def advance(self, now: float) -> List[Tuple]:
+        target = int(now / self.tick)
+        # после долгой паузы достаточно одного полного оборота
+        self.cursor = max(self.cursor, target - len(self.slots))
+        due: List[Tuple] = []
+        while self.cursor < target:
+            self.cursor += 1
+            slot = self.slots[self.cursor % len(self.slots)]
+            due.extend(slot)
+            slot.clear()
+        return due
+
+
+HISTORY_OUTCOMES: Sequence[str] = ("done", "fail", "skip", "timeout")
+NO_CARD_TYPE = 255
+
+
+class RoundHistory:
+    """Последние раунды партии в кольцевом буфере фиксированного размера.
+
+    Числовые поля лежат в array, id карточек — в списке той же длины: память
+    на игру задаётся capacity и не растёт с числом сыгранных раундов.
+    """
+
+    __slots__ = (
+        "capacity", "players", "cards", "kinds", "outcomes", "durations",
+        "head", "size", "version", "rendered",
+    )
+
+    def __init__(self, capacity: int = HISTORY_SIZE):
+        self.capacity = capacity
+        self.players = array("q", bytes(8 * capacity))
+        self.cards: List[Optional[str]] = [None] * capacity
+        self.kinds = array("B", bytes(capacity))  # индекс в CARD_TYPES или NO_CARD_TYPE
+        self.outcomes = array("B", bytes(capacity))  # индекс в HISTORY_OUTCOMES
+        self.durations = array("I", bytes(4 * capacity))  # десятые доли секунды
+        self.head = 0  # позиция следующей записи
+        self.size = 0
+        self.version = 0
+        # (version, limit, текст) последнего показа /history
+        self.rendered: Optional[Tuple[int, int, str]] = None
+
+    def __len__(self) -> int:
+        return self.size
+
+    def push(self, player_id: int, card_id: Optional[str], kind: Optional[str], outcome: str, tenths: int):
+        pos = self.head
+        self.players[pos] = player_id
+        self.cards[pos] = card_id
+        self.kinds[pos] = CARD_TYPE_CODES.get(kind, NO_CARD_TYPE)
+        self.outcomes[pos] = HISTORY_OUTCOMES.index(outcome)
+        self.durations[pos] = tenths
+        self.head = (pos + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+        self.version += 1
+
+    def last(self, limit: int) -> List[Tuple[int, Optional[str], Optional[str], str, int]]:
+        """До limit раундов, от последнего к более ранним."""
+        rounds = []
+        for step in range(1, min(limit, self.size) + 1):
+            pos = (self.head - step) % self.capacity
+            kind = self.kinds[pos]
+            rounds.append((
+                self.players[pos],
+                self.cards[pos],
+                CARD_TYPES[kind] if kind != NO_CARD_TYPE else None,
+                HISTORY_OUTCOMES[self.outcomes[pos]],
+                self.durations[pos],
+            ))
+        return rounds
+
+
+class TopK:
+    """Первые k мест по убыванию очков; при равенстве выше меньший ключ.
+
+    Хранит только k записей, поэтому не всё можно обновить на месте: если
+    участник топа теряет очки или уходит, а за пределами топа кто-то есть,
+    offer()/remove() возвращают False — топ нужно собрать заново из полной таблицы.
+    """
+
+    __slots__ = ("k", "entries", "scores", "complete")
+
+    def __init__(self, k: int, rows: Iterable[Tuple[int, int]] = (), *, complete: bool = True):
+        self.k = k
+        self.entries: List[Tuple[int, int]] = []  # (-очки, ключ) по возрастанию
+        self.scores: Dict[int, int] = {}
+        # за пределами топа никого нет
+        self.complete = True
+        for key, score in rows:
+            self.offer(key, score)
+        self.complete = self.complete and complete
+
+    def offer(self, key: int, score: int) -> bool:
+        old = self.scores.pop(key, None)
+        if old is not None:
+            self.entries.pop(bisect.bisect_left(self.entries, (-old, key)))
+            if score < old and not self.complete:
+                return False
+        item = (-score, key)
+        if len(self.entries) < self.k:
+            bisect.insort(self.entries, item)
+            self.scores[key] = score
+        elif item < self.entries[-1]:
+            bisect.insort(self.entries, item)
+            self.scores[key] = score
+            _, dropped = self.entries.pop()
+            del self.scores[dropped]
+            self.complete = False
+        else:
+            self.complete = False
+        return True
+
+    def remove(self, key: int) -> bool:
+        old = self.scores.pop(key, None)
+        if old is None:
+            return True
+        self.entries.pop(bisect.bisect_left(self.entries, (-old, key)))
+        return self.complete
+
+    def rows(self) -> List[Tuple[int, int]]:
+        return [(key, -neg_score) for neg_score, key in self.entries]
 
 # Все игры по чатам
 GAMES: Dict[int, ChatGame] = {}
 
-# Отложенные операции добавления игроков (chat_id, host_id) -> PendingPlayerAddition
-PENDING_PLAYER_ADDITIONS: Dict[Tuple[int, int], PendingPlayerAddition] = {}
-PENDING_PLAYER_RENAMES: Dict[Tuple[int, int], PendingPlayerRename] = {}
+# Импортированные колоды по хэшу содержимого — одна копия на все чаты
+DECK_STORE: Dict[str, SharedDeck] = {}
+# Чаты, где сейчас идёт импорт колоды из файла
+DECK_IMPORTS_IN_PROGRESS: Set[int] = set()
+# Разбор и проверка больших импортов; один поток — задания выполняются по порядку
+DECK_WORKER = ThreadPoolExecutor(max_workers=1, thread_name_prefix="deck-import")
+# Отфильтрованные колоды по (хэши импортов, фильтр); живут, пока на них ссылается игра
+SHARED_POOLS: "weakref.WeakValueDictionary[Tuple[Tuple[str, ...], DeckIndexKey], CardPool]" = (
+    weakref.WeakValueDictionary()
+)
 
-# Подтверждения завершения игры: (chat_id, user_id) -> timestamp
-END_CONFIRMATIONS: Dict[Tuple[int, int], float] = {}
+# Ожидание ввода имени/переименования и подтверждения выхода: chat_id -> ChatPending
+PENDING_BY_CHAT: Dict[int, ChatPending] = {}
+PENDING_INPUT_TIMEOUT = 300.0
 END_CONFIRM_TIMEOUT = 15.0
+# Ключи (вид, chat_id, user_id); тик в секунду, оборот — чуть больше PENDING_INPUT_TIMEOUT
+PENDING_WHEEL = TimingWheel(tick=1.0, size=512)
 
 
-def clear_pending_additions(chat_id: int):
-    for key in [key for key in PENDING_PLAYER_ADDITIONS if key[0] == chat_id]:
-        PENDING_PLAYER_ADDITIONS.pop(key, None)
+def get_chat_pending(chat_id: int, *, create: bool = False) -> Optional[ChatPending]:
+    pending = PENDING_BY_CHAT.get(chat_id)
+    if pending is None and create:
+        pending = PENDING_BY_CHAT[chat_id] = ChatPending()
+    return pending
 
 
-def clear_pending_renames(chat_id: int):
-    for key in [key for key in PENDING_PLAYER_RENAMES if key[0] == chat_id]:
-        PENDING_PLAYER_RENAMES.pop(key, None)
+def drop_chat_pending_if_empty(chat_id: int):
+    pending = PENDING_BY_CHAT.get(chat_id)
+    if pending is not None and pending.is_empty():
+        del PENDING_BY_CHAT[chat_id]
 
 
-def get_pending_addition(chat_id: int) -> Optional[Tuple[Tuple[int, int], PendingPlayerAddition]]:
-    for key, pending in PENDING_PLAYER_ADDITIONS.items():
-        if key[0] == chat_id:
-            return key, pending
-    return None
+def put_pending_addition(entry: PendingPlayerAddition):
+    entry.expires_at = time.monotonic() + PENDING_INPUT_TIMEOUT
+    get_chat_pending(entry.chat_id, create=True).additions[entry.host_id] = entry
+    PENDING_WHEEL.schedule(("add", entry.chat_id, entry.host_id), entry.expires_at)
+
+
+def get_pending_addition(chat_id: int, user_id: Optional[int] = None) -> Optional[PendingPlayerAddition]:
+    """Ожидание ввода имени от user_id; без user_id — любое ожидание в чате."""
+    pending = PENDING_BY_CHAT.get(chat_id)
+    if pending is None or not pending.additions:
+        return None
+    if user_id is None:
+        return next(iter(pending.additions.values()))
+    return pending.additions.get(user_id)
+
+
+def pop_pending_addition(chat_id: int, user_id: int) -> Optional[PendingPlayerAddition]:
+    pending = PENDING_BY_CHAT.get(chat_id)
+    if pending is None:
+        return None
+    entry = pending.additions.pop(user_id, None)
+    drop_chat_pending_if_empty(chat_id)
+    return entry
+
+
+def put_pending_rename(entry: PendingPlayerRename):
+    entry.expires_at = time.monotonic() + PENDING_INPUT_TIMEOUT
+    get_chat_pending(entry.chat_id, create=True).renames[entry.host_id] = entry
+    PENDING_WHEEL.schedule(("rename", entry.chat_id, entry.host_id), entry.expires_at)
+
+
+def get_pending_rename(chat_id: int, user_id: int) -> Optional[PendingPlayerRename]:
+    pending = PENDING_BY_CHAT.get(chat_id)
+    return pending.renames.get(user_id) if pending is not None else None
+
+
+def pop_pending_rename(chat_id: int, user_id: int) -> Optional[PendingPlayerRename]:
+    pending = PENDING_BY_CHAT.get(chat_id)
+    if pending is None:
+        return None
+    entry = pending.renames.pop(user_id, None)
+    drop_chat_pending_if_empty(chat_id)
+    return entry
+
+
+def clear_pending_additions(chat_id: int):
+    pending = PENDING_BY_CHAT.get(chat_id)
+    if pending is not None:
+        pending.additions.clear()
+        drop_chat_pending_if_empty(chat_id)
+
+
+def clear_pending_renames(chat_id: int):
+    pending = PENDING_BY_CHAT.get(chat_id)
+    if pending is not None:
+        pending.renames.clear()
+        drop_chat_pending_if_empty(chat_id)
 
 
 def require_end_confirmation(chat_id: int, user_id: int) -> bool:
-    key = (chat_id, user_id)
     now = time.monotonic()
-    last = END_CONFIRMATIONS.get(key)
-    if last is None or now - last > END_CONFIRM_TIMEOUT:
-        END_CONFIRMATIONS[key] = now
+    pending = get_chat_pending(chat_id, create=True)
+    deadline = pending.end_confirmations.get(user_id)
+    if deadline is None or now > deadline:
+        deadline = now + END_CONFIRM_TIMEOUT
+        pending.end_confirmations[user_id] = deadline
+        PENDING_WHEEL.schedule(("end", chat_id, user_id), deadline)
         return False
-    END_CONFIRMATIONS.pop(key, None)
+    clear_end_confirmation(chat_id, user_id)
     return True
 
 
+def clear_end_confirmation(chat_id: int, user_id: int):
+    pending = PENDING_BY_CHAT.get(chat_id)
+    if pending is not None:
+        pending.end_confirmations.pop(user_id, None)
+        drop_chat_pending_if_empty(chat_id)
+
+
+def expire_pending(key: Tuple, now: float) -> Optional[Tuple[int, int]]:
+    """Снять просроченную запись; возвращает (chat_id, message_id) подсказки для удаления."""
+    kind, chat_id, user_id = key
+    pending = PENDING_BY_CHAT.get(chat_id)
+    if pending is None:
+        return None
+    if kind == "end":
+        entries = pending.end_confirmations
+        deadline = entries.get(user_id)
+    else:
+        entries = pending.additions if kind == "add" else pending.renames
+        entry = entries.get(user_id)
+        deadline = entry.expires_at if entry is not None else None
+    if deadline is None:
+        return None
+    if deadline > now:
+        PENDING_WHEEL.schedule(key, deadline)
+        return None
+    removed = entries.pop(user_id)
+    drop_chat_pending_if_empty(chat_id)
+    message_id = getattr(removed, "message_id", None)
+    return (chat_id, message_id) if message_id else None
+
+
+async def pending_sweeper():
+    while True:
+        await asyncio.sleep(PENDING_WHEEL.tick)
+        now = time.monotonic()
+        prompts = [prompt for key in PENDING_WHEEL.advance(now) if (prompt := expire_pending(key, now))]
+        for chat_id, message_id in prompts:
+            await safe_delete_message(chat_id, message_id)
+
+
+# Сдвиг time.monotonic() относительно time.time(), зафиксированный при запуске: сроки
+# ожиданий сохраняются как время по часам и не меняются от сброса к сбросу
+MONOTONIC_TO_WALL = time.time() - time.monotonic()
+
+
+def pending_state(chat_id: int) -> Optional[Dict]:
+    """Ожидания чата для хранилища; сроки — моменты по time.time() (wall)."""
+    pending = PENDING_BY_CHAT.get(chat_id)
+    if pending is None:
+        return None
+    return {
+        "wall": True,
+        "additions": [
+            [entry.host_id, entry.message_id, entry.expires_at + MONOTONIC_TO_WALL]
+            for entry in pending.additions.values()
+        ],
+        "renames": [
+            [entry.host_id, entry.player_id, entry.message_id, entry.expires_at + MONOTONIC_TO_WALL]
+            for entry in pending.renames.values()
+        ],
+        "end_confirmations": [
+            [user_id, deadline + MONOTONIC_TO_WALL]
+            for user_id, deadline in pending.end_confirmations.items()
+        ],
+    }
+
+
+def restore_pending(chat_id: int, state: Optional[Dict]):
+    PENDING_BY_CHAT.pop(chat_id, None)
+    if not state:
+        return
+    now = time.monotonic()
+    # старые записи хранили остаток срока в секундах, новые — момент по часам
+    wall_now = time.time() if state.get("wall") else 0.0
+    pending = ChatPending()
+    for host_id, message_id, left in state.get("additions", []):
+        left -= wall_now
+        if left > 0:
+            pending.additions[host_id] = PendingPlayerAddition(chat_id, host_id, message_id, now + left)
+            PENDING_WHEEL.schedule(("add", chat_id, host_id), now + left)
+    for host_id, player_id, message_id, left in state.get("renames", []):
+        left -= wall_now
+        if left > 0:
+            pending.renames[host_id] = PendingPlayerRename(chat_id, host_id, player_id, message_id, now + left)
+            PENDING_WHEEL.schedule(("rename", chat_id, host_id), now + left)
+    for user_id, left in state.get("end_confirmations", []):
+        left -= wall_now
+        if left > 0:
+            pending.end_confirmations[user_id] = now + left
+            PENDING_WHEEL.schedule(("end", chat_id, user_id), now + left)
+    if not pending.is_empty():
+        PENDING_BY_CHAT[chat_id] = pending
+
+
 def reset_deck_cache(game: ChatGame, *, clear_used: bool = False):
     """Сбрасываем кэш последовательностей карточек для новой случайной раздачи."""
-    if not isinstance(game.deck_cache, dict):  # страховка на случай старого состояния
-        game.deck_cache = {"truth": [], "dare": []}
-    if not isinstance(game.last_keywords, dict):
-        game.last_keywords = {"truth": set(), "dare": set()}
-    for kind in ("truth", "dare"):
-        game.deck_cache[kind] = []
-        game.last_keywords[kind] = set()
+    game.deck_cache.clear()
+    game.last_keywords.clear()
     if clear_used:
-        game.used_ids.clear()
+        game.dealt_in_cycle = 0
 
 # ===========================
 # AIROGRAM SETUP
@@ -942,6 +2006,196 @@ bot = Bot(
 
 dp = Dispatcher()
 
+# ===========================
+# ИСХОДЯЩИЕ ЗАПРОСЫ
+# ===========================
+
+# Классы приоритета: меньше — раньше. Карточки и приглашения к ходу идут вперёд
+# кадров спиннера, обновлений лобби и удалений
+PRIORITY_GAME = 0
+PRIORITY_NORMAL = 1
+PRIORITY_BACKGROUND = 2
+PRIORITY_NAMES = ("game", "normal", "background")
+
+OUTBOUND_PRIORITY: contextvars.ContextVar[int] = contextvars.ContextVar(
+    "outbound_priority", default=PRIORITY_NORMAL
+)
+
+
+@contextlib.contextmanager
+def outbound_priority(priority: int):
+    """Приоритет для запросов к Bot API внутри блока (и созданных в нём задач)."""
+    token = OUTBOUND_PRIORITY.set(priority)
+    try:
+        yield
+    finally:
+        OUTBOUND_PRIORITY.reset(token)
+
+
+class TokenBucket:
+    __slots__ = ("rate", "capacity", "tokens", "stamp")
+
+    def __init__(self, rate: float, capacity: float, now: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.stamp = now
+
+    def refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def delay(self, now: float) -> float:
+        """Через сколько секунд появится целый токен (0 — уже есть)."""
+        self.refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+
+class OutboundLimiter(BaseRequestMiddleware):
+    """Middleware сессии бота: запросы в чаты ждут токенов глобальной корзины,
+    корзины чата и — для групп — минутной корзины группы.
+
+    Ожидающие стоят в порядке (приоритет, очередность); первым уходит самый
+    приоритетный запрос, чьи корзины не пусты, так что занятый чат не задерживает
+    остальные. Запросы без chat_id (getUpdates, answerCallbackQuery) не считаются.
+    """
+
+    def __init__(
+        self,
+        global_rate: float = OUTBOUND_GLOBAL_RATE,
+        global_burst: float = OUTBOUND_GLOBAL_BURST,
+        chat_rate: float = OUTBOUND_CHAT_RATE,
+        chat_burst: float = OUTBOUND_CHAT_BURST,
+        group_per_minute: float = OUTBOUND_GROUP_PER_MINUTE,
+        group_burst: float = OUTBOUND_GROUP_BURST,
+    ):
+        now = time.monotonic()
+        self.global_bucket = TokenBucket(global_rate, global_burst, now)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_per_minute / 60
+        self.group_burst = group_burst
+        self.chat_buckets: Dict[object, TokenBucket] = {}
+        self.group_buckets: Dict[object, TokenBucket] = {}
+        # (priority, seq, chat_id, future), отсортирован
+        self.waiting: List[Tuple[int, int, object, asyncio.Future]] = []
+        self.seq = itertools.count()
+        self.wakeup: Optional[asyncio.Event] = None
+        self.task: Optional[asyncio.Task] = None
+        self.max_depth = 0
+        self.sent = [0] * len(PRIORITY_NAMES)
+        self.delayed = [0] * len(PRIORITY_NAMES)
+        self.wait_total = [0.0] * len(PRIORITY_NAMES)
+        self.wait_max = [0.0] * len(PRIORITY_NAMES)
+
+    async def __call__(self, make_request, bot, method):
+        chat_id = getattr(method, "chat_id", None)
+        if chat_id is None:
+            return await make_request(bot, method)
+        priority = OUTBOUND_PRIORITY.get()
+        if isinstance(method, DeleteMessage):
+            priority = max(priority, PRIORITY_BACKGROUND)
+        await self.acquire(chat_id, priority)
+        return await make_request(bot, method)
+
+    @staticmethod
+    def is_group(chat_id: object) -> bool:
+        return not isinstance(chat_id, int) or chat_id < 0
+
+    def bucket(self, buckets: Dict[object, TokenBucket], chat_id: object, rate: float, burst: float, now: float):
+        bucket = buckets.get(chat_id)
+        if bucket is None:
+            if len(buckets) >= OUTBOUND_BUCKET_LIMIT:
+                # полная корзина ничем не отличается от новой
+                for key, old in list(buckets.items()):
+                    old.refill(now)
+                    if old.tokens >= old.capacity:
+                        del buckets[key]
+            bucket = buckets[chat_id] = TokenBucket(rate, burst, now)
+        return bucket
+
+    def chat_delay(self, chat_id: object, now: float) -> float:
+        delay = self.bucket(self.chat_buckets, chat_id, self.chat_rate, self.chat_burst, now).delay(now)
+        if self.is_group(chat_id):
+            group = self.bucket(self.group_buckets, chat_id, self.group_rate, self.group_burst, now)
+            delay = max(delay, group.delay(now))
+        return delay
+
+    def take(self, chat_id: object):
+        self.global_bucket.tokens -= 1
+        self.chat_buckets[chat_id].tokens -= 1
+        if self.is_group(chat_id):
+            self.group_buckets[chat_id].tokens -= 1
+
+    async def acquire(self, chat_id: object, priority: int):
+        now = time.monotonic()
+        self.sent[priority] += 1
+        if not self.waiting and self.global_bucket.delay(now) == 0 and self.chat_delay(chat_id, now) == 0:
+            self.take(chat_id)
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        bisect.insort(self.waiting, (priority, next(self.seq), chat_id, waiter), key=lambda entry: entry[:2])
+        self.max_depth = max(self.max_depth, len(self.waiting))
+        if self.task is None:
+            self.wakeup = asyncio.Event()
+            self.task = asyncio.create_task(self.dispatch())
+        else:
+            self.wakeup.set()
+        await waiter
+        waited = time.monotonic() - now
+        self.delayed[priority] += 1
+        self.wait_total[priority] += waited
+        self.wait_max[priority] = max(self.wait_max[priority], waited)
+
+    async def dispatch(self):
+        try:
+            while self.waiting:
+                now = time.monotonic()
+                delay = self.global_bucket.delay(now)
+                if delay == 0:
+                    delay = None
+                    for pos, (_, _, chat_id, waiter) in enumerate(self.waiting):
+                        if waiter.done():  # вызывающего отменили
+                            del self.waiting[pos]
+                            delay = 0
+                            break
+                        wait = self.chat_delay(chat_id, now)
+                        if wait == 0:
+                            del self.waiting[pos]
+                            self.take(chat_id)
+                            waiter.set_result(None)
+                            delay = 0
+                            break
+                        delay = wait if delay is None else min(delay, wait)
+                if delay:
+                    self.wakeup.clear()
+                    try:
+                        await asyncio.wait_for(self.wakeup.wait(), delay)
+                    except asyncio.TimeoutError:
+                        pass
+        finally:
+            self.task = None
+
+    def stats(self) -> Dict:
+        return {
+            "depth": len(self.waiting),
+            "max_depth": self.max_depth,
+            "classes": {
+                name: {
+                    "sent": self.sent[i],
+                    "delayed": self.delayed[i],
+                    "avg_wait": self.wait_total[i] / self.delayed[i] if self.delayed[i] else 0.0,
+                    "max_wait": self.wait_max[i],
+                }
+                for i, name in enumerate(PRIORITY_NAMES)
+            },
+        }
+
+
+OUTBOUND = OutboundLimiter(
+    global_rate=OUTBOUND_GLOBAL_RATE / SHARD_WORKERS if SHARD_INDEX is not None else OUTBOUND_GLOBAL_RATE,
+)
+
 # ===========================
 # УТИЛИТЫ
 # ===========================
@@ -978,7 +2232,39 @@ def can_control_turn(game: ChatGame, user_id: int) -> bool:
 
 
 def get_player(game: ChatGame, user_id: int) -> Optional[Player]:
-    return next((p for p in game.players if p.user_id == user_id), None)
+    return game.players_by_id.get(user_id)
+
+
+def index_player(game: ChatGame, player: Player):
+    game.players_by_id[player.user_id] = player
+    key = player.name.casefold()
+    game.player_names[key] = game.player_names.get(key, 0) + 1
+
+
+def unindex_player(game: ChatGame, player: Player):
+    game.players_by_id.pop(player.user_id, None)
+    key = player.name.casefold()
+    count = game.player_names.get(key, 0) - 1
+    if count > 0:
+        game.player_names[key] = count
+    else:
+        game.player_names.pop(key, None)
+
+
+def rebuild_player_index(game: ChatGame):
+    game.players_by_id.clear()
+    game.player_names.clear()
+    for player in game.players:
+        index_player(game, player)
+
+
+def rename_player(game: ChatGame, player: Player, new_name: str):
+    unindex_player(game, player)
+    player.name = new_name
+    index_player(game, player)
+    if game.history is not None:
+        game.history.rendered = None
+    journal_event(game.chat_id, "rename", u=player.user_id, n=new_name)
 
 
 def format_player_name(game: ChatGame, player: Player) -> str:
@@ -987,28 +2273,93 @@ def format_player_name(game: ChatGame, player: Player) -> str:
 
 
 def cleanup_scores(game: ChatGame):
-    player_ids = {p.user_id for p in game.players}
-    game.scores = {uid: score for uid, score in game.scores.items() if uid in player_ids}
+    players_by_id = game.players_by_id
+    if any(uid not in players_by_id for uid in game.scores):
+        game.scores = {uid: score for uid, score in game.scores.items() if uid in players_by_id}
+        game.ranking = None
+
+
+def set_score(game: ChatGame, user_id: int, score: int):
+    game.scores[user_id] = score
+    if game.ranking is not None and not game.ranking.offer(user_id, score):
+        game.ranking = None
+
+
+def game_ranking(game: ChatGame) -> TopK:
+    if game.ranking is None:
+        top = heapq.nlargest(SCOREBOARD_SIZE, game.scores.items(), key=lambda kv: (kv[1], -kv[0]))
+        game.ranking = TopK(SCOREBOARD_SIZE, top, complete=len(game.scores) <= SCOREBOARD_SIZE)
+    return game.ranking
+
+
+def push_round(
+    game: ChatGame, player_id: int, card_id: Optional[str], kind: Optional[str], outcome: str, tenths: int
+):
+    if game.history is None:
+        game.history = RoundHistory()
+    game.history.push(player_id, card_id, kind, outcome, tenths)
+
+
+def record_round(game: ChatGame, turn: Turn, outcome: str) -> int:
+    """Записать завершённый ход в историю; возвращает длительность в десятых секунды."""
+    tenths = round(max(0.0, time.time() - turn.started_at) * 10) if turn.started_at else 0
+    push_round(game, turn.player_id, turn.card_id, turn.type, outcome, tenths)
+    return tenths
+
+
+HISTORY_OUTCOME_ICONS = {"done": "✅", "fail": "❌", "skip": "🔁", "timeout": "⏱️"}
+HISTORY_TEXT_LIMIT = 60
+
+
+def format_history(game: ChatGame, limit: int) -> str:
+    history = game.history
+    if history is None or not len(history):
+        return "📜 История пуста: ещё не сыграно ни одного раунда."
+    cached = history.rendered
+    if cached is not None and cached[0] == history.version and cached[1] == limit:
+        return cached[2]
+    rounds = history.last(limit)
+    lines = [f"📜 <b>Последние раунды</b> ({len(rounds)}):"]
+    for player_id, card_id, kind, outcome, tenths in rounds:
+        player = get_player(game, player_id)
+        name = html.escape(player.name) if player else f"Игрок {player_id}"
+        card = None
+        if kind and card_id:
+            card = get_card_pool(game, kind).get(card_id) or find_card(game, card_id)
+        if card is not None:
+            text = card.text if len(card.text) <= HISTORY_TEXT_LIMIT else card.text[:HISTORY_TEXT_LIMIT - 1] + "…"
+        else:
+            text = card_id or "без карточки"
+        kind_icon = "🟦" if kind == "truth" else "🟥" if kind == "dare" else "▫️"
+        lines.append(
+            f"{HISTORY_OUTCOME_ICONS[outcome]} {name} {kind_icon} {html.escape(text)} · {tenths / 10:.1f} с"
+        )
+    text = "\n".join(lines)
+    history.rendered = (history.version, limit, text)
+    return text
+
+
+def format_score_line(position: int, ref: str, score: int) -> str:
+    medal = "🥇" if position == 1 else "🥈" if position == 2 else "🥉" if position == 3 else "🎯"
+    return f"{medal} {ref} — <b>{score}</b>"
 
 
 def format_scores(game: ChatGame) -> str:
-    cleanup_scores(game)
+    """Топ SCOREBOARD_SIZE игроков партии; scores содержит только игроков из лобби."""
     if not game.scores:
         return "Пока никто не получил очки."
-    ordered: List[Tuple[int, int]] = sorted(
-        game.scores.items(), key=lambda kv: kv[1], reverse=True
-    )
     lines = []
-    for position, (uid, score) in enumerate(ordered, start=1):
+    for position, (uid, score) in enumerate(game_ranking(game).rows(), start=1):
         player = get_player(game, uid)
         name = player.name if player else f"Игрок {uid}"
-        medal = "🥇" if position == 1 else "🥈" if position == 2 else "🥉" if position == 3 else "🎯"
-        prefix = medal
         if player and player.is_virtual:
             ref = html.escape(name)
         else:
             ref = mention_html(uid, name)
-        lines.append(f"{prefix} {ref} — <b>{score}</b>")
+        lines.append(format_score_line(position, ref, score))
+    hidden = len(game.scores) - len(lines)
+    if hidden > 0:
+        lines.append(f"…и ещё {hidden}")
     return "\n".join(lines)
 
 
@@ -1021,22 +2372,6 @@ def describe_age(level: str) -> str:
     return f"{data['emoji']} {data['title']}"
 
 
-def get_selected_categories(game: ChatGame) -> Set[str]:
-    raw = game.settings.get("categories")
-    if isinstance(raw, set):
-        categories = {c for c in raw if c in CATEGORY_INFO}
-    elif isinstance(raw, (list, tuple)):
-        categories = {c for c in raw if c in CATEGORY_INFO}
-    else:
-        fallback = game.settings.get("category")
-        categories = {fallback} if fallback in CATEGORY_INFO else set()
-    if not categories:
-        categories = set(DEFAULT_CATEGORY_SET)
-    game.settings["categories"] = set(categories)
-    game.settings.pop("category", None)
-    return game.settings["categories"]
-
-
 def describe_categories(categories: Set[str]) -> str:
     if not categories:
         categories = set(DEFAULT_CATEGORY_SET)
@@ -1052,11 +2387,11 @@ def describe_categories(categories: Set[str]) -> str:
 
 
 def describe_penalty(game: ChatGame) -> str:
-    return "-1" if game.settings.get("skip_penalty", 0) == -1 else "0"
+    return "-1" if game.settings.skip_penalty == -1 else "0"
 
 
 def describe_points(game: ChatGame) -> str:
-    return "Включены" if game.settings.get("points", True) else "Отключены"
+    return "Включены" if game.settings.points else "Отключены"
 
 
 def register_player(
@@ -1075,22 +2410,26 @@ def register_player(
     )
     player = Player(user_id, name, is_virtual=is_virtual)
     game.players.append(player)
-    game.scores.setdefault(user_id, 0)
+    index_player(game, player)
+    if user_id not in game.scores:
+        set_score(game, user_id, 0)
+    journal_event(game.chat_id, "join", u=user_id, n=name, v=is_virtual)
     return player
 
 
 def drop_player(game: ChatGame, user_id: int) -> Tuple[bool, bool]:
-    removed_index: Optional[int] = None
-    for idx, player in enumerate(game.players):
-        if player.user_id == user_id:
-            removed_index = idx
-            break
-
-    if removed_index is None:
+    player = game.players_by_id.get(user_id)
+    if player is None:
         return False, False
 
+    removed_index = game.players.index(player)
     game.players.pop(removed_index)
+    unindex_player(game, player)
     game.scores.pop(user_id, None)
+    if game.ranking is not None and not game.ranking.remove(user_id):
+        game.ranking = None
+    if game.history is not None:
+        game.history.rendered = None
 
     removed_current = False
     if game.current_turn and game.current_turn.player_id == user_id:
@@ -1108,20 +2447,23 @@ def drop_player(game: ChatGame, user_id: int) -> Tuple[bool, bool]:
         if game.current_idx >= len(game.players):
             game.current_idx = len(game.players) - 1
 
+    journal_event(game.chat_id, "drop", u=user_id, i=game.current_idx)
     return True, removed_current
 
 
 def move_player_in_list(game: ChatGame, user_id: int, offset: int) -> bool:
+    player = game.players_by_id.get(user_id)
+    if player is None:
+        return False
     players = game.players
-    for idx, player in enumerate(players):
-        if player.user_id == user_id:
-            new_idx = idx + offset
-            if new_idx < 0 or new_idx >= len(players):
-                return False
-            players[idx], players[new_idx] = players[new_idx], players[idx]
-            game.current_idx = -1
-            return True
-    return False
+    idx = players.index(player)
+    new_idx = idx + offset
+    if new_idx < 0 or new_idx >= len(players):
+        return False
+    players[idx], players[new_idx] = players[new_idx], players[idx]
+    game.current_idx = -1
+    journal_event(game.chat_id, "move", u=user_id, o=offset)
+    return True
 
 
 def allocate_virtual_id(game: ChatGame) -> int:
@@ -1133,6 +2475,92 @@ def is_message_not_modified(exc: TelegramBadRequest) -> bool:
     return "message is not modified" in str(exc).lower()
 
 
+def is_message_gone(exc: TelegramBadRequest) -> bool:
+    text = str(exc).lower()
+    return "message to edit not found" in text or "message can't be edited" in text
+
+
+def render_key(text: str, reply_markup: Optional[InlineKeyboardMarkup]) -> int:
+    """Хэш текста и клавиатуры: совпал — правка ничего не изменит."""
+    rows = None
+    if reply_markup is not None:
+        rows = tuple(
+            tuple((button.text, button.callback_data, button.url) for button in row)
+            for row in reply_markup.inline_keyboard
+        )
+    return hash((text, rows))
+
+
+def already_rendered(game: ChatGame, role: str, message_id: Optional[int], key: int) -> bool:
+    if message_id is not None and game.rendered.get(role) == (message_id, key):
+        EDIT_STATS["skipped"] += 1
+        return True
+    return False
+
+
+def remember_render(game: ChatGame, role: str, message_id: int, key: int):
+    # одно сообщение могли перерисовать под другую роль — старая запись больше не верна
+    for other, (other_id, _) in list(game.rendered.items()):
+        if other_id == message_id and other != role:
+            del game.rendered[other]
+    game.rendered[role] = (message_id, key)
+
+
+# Исходы edit_with_retry и правки, отброшенные без запроса (already_rendered)
+EDIT_STATS = {
+    "skipped": 0,
+    "edited": 0,
+    "not_modified": 0,
+    "retry_after": 0,
+    "network_retries": 0,
+    "gone": 0,
+    "failed": 0,
+    # отрисовки лобби и панели, брошенные после ошибки
+    "abandoned": 0,
+}
+
+
+async def edit_with_retry(edit) -> bool:
+    """Выполнить правку edit() (фабрику корутины), переждав flood control и сетевые сбои.
+
+    True — правка применена или текст не изменился; False — исходного сообщения
+    больше нет и можно отправить новое. Остальные ошибки и исчерпанные попытки
+    пробрасываются: новое сообщение под тем же ограничением тоже не пройдёт.
+    """
+    backoff = EDIT_RETRY_BACKOFF
+    for attempt in range(1, EDIT_RETRY_ATTEMPTS + 1):
+        try:
+            await edit()
+            EDIT_STATS["edited"] += 1
+            return True
+        except TelegramRetryAfter as exc:
+            if attempt == EDIT_RETRY_ATTEMPTS or exc.retry_after > EDIT_RETRY_MAX_WAIT:
+                EDIT_STATS["failed"] += 1
+                raise
+            EDIT_STATS["retry_after"] += 1
+            await asyncio.sleep(exc.retry_after)
+        except TelegramBadRequest as exc:
+            if is_message_not_modified(exc):
+                EDIT_STATS["not_modified"] += 1
+                return True
+            if is_message_gone(exc):
+                EDIT_STATS["gone"] += 1
+                return False
+            EDIT_STATS["failed"] += 1
+            raise
+        except (TelegramNetworkError, TelegramServerError):
+            if attempt == EDIT_RETRY_ATTEMPTS:
+                EDIT_STATS["failed"] += 1
+                raise
+            EDIT_STATS["network_retries"] += 1
+            await asyncio.sleep(backoff)
+            backoff *= 2
+        except Exception:
+            EDIT_STATS["failed"] += 1
+            raise
+    return False
+
+
 async def safe_delete_message(chat_id: int, message_id: Optional[int]):
     if not message_id:
         return
@@ -1150,6 +2578,16 @@ async def refresh_lobby(
     message: Optional[Message] = None,
     force_new: bool = False,
 ):
+    # лобби перерисуется при следующем действии; ответ на кнопку и закрытие игры ждать не должны
+    try:
+        with outbound_priority(PRIORITY_BACKGROUND):
+            await render_lobby(game, message=message, force_new=force_new)
+    except Exception:
+        EDIT_STATS["abandoned"] += 1
+        logger.exception("Не удалось обновить лобби в чате %s", game.chat_id)
+
+
+async def render_lobby(game: ChatGame, *, message: Optional[Message], force_new: bool):
     players_lines = [format_player_name(game, p) for p in game.players]
     players_block = "\n".join(players_lines) if players_lines else "—"
     text = (
@@ -1158,42 +2596,42 @@ async def refresh_lobby(
         "Добавляйте игроков кнопкой «Добавить игрока». «Старт» начинает партию, «Выйти» вернёт в главное меню."
     )
     keyboard = lobby_keyboard(game)
+    key = render_key(text, keyboard)
     target_chat = game.chat_id
 
     if message:
-        try:
-            await message.edit_text(text, reply_markup=keyboard)
+        if already_rendered(game, "lobby", message.message_id, key) or await edit_with_retry(
+            lambda: message.edit_text(text, reply_markup=keyboard)
+        ):
             game.lobby_message_id = message.message_id
+            remember_render(game, "lobby", message.message_id, key)
             return
-        except TelegramBadRequest as exc:
-            if is_message_not_modified(exc):
-                game.lobby_message_id = message.message_id
-                return
-        except Exception:
-            pass
+        if game.lobby_message_id == message.message_id:
+            game.lobby_message_id = None
 
     old_message_id: Optional[int] = None
     if force_new and game.lobby_message_id:
         old_message_id = game.lobby_message_id
         game.lobby_message_id = None
 
-    if game.lobby_message_id and not force_new:
-        try:
-            await bot.edit_message_text(
+    lobby_message_id = game.lobby_message_id
+    if lobby_message_id and not force_new:
+        if already_rendered(game, "lobby", lobby_message_id, key):
+            return
+        if await edit_with_retry(
+            lambda: bot.edit_message_text(
                 text,
                 chat_id=target_chat,
-                message_id=game.lobby_message_id,
+                message_id=lobby_message_id,
                 reply_markup=keyboard,
             )
+        ):
+            remember_render(game, "lobby", lobby_message_id, key)
             return
-        except TelegramBadRequest as exc:
-            if is_message_not_modified(exc):
-                return
-        except Exception:
-            pass
 
     sent = await bot.send_message(target_chat, text, reply_markup=keyboard)
     game.lobby_message_id = sent.message_id
+    remember_render(game, "lobby", sent.message_id, key)
 
     if old_message_id and old_message_id != sent.message_id:
         try:
@@ -1204,9 +2642,9 @@ async def refresh_lobby(
 
 def settings_summary(game: ChatGame) -> str:
     return (
-        f"⏱️ Таймер: <b>{describe_timer(game.settings.get('timer', 0))}</b>\n"
-        f"🎚 Возраст: <b>{describe_age(game.settings.get('age_level', DEFAULT_AGE_LEVEL))}</b>\n"
-        f"🎭 Категория: <b>{describe_categories(get_selected_categories(game))}</b>\n"
+        f"⏱️ Таймер: <b>{describe_timer(game.settings.timer)}</b>\n"
+        f"🎚 Возраст: <b>{describe_age(game.settings.age_level)}</b>\n"
+        f"🎭 Категория: <b>{describe_categories(game.settings.categories)}</b>\n"
         f"⭐ Очки: <b>{describe_points(game)}</b>\n"
         f"⚖️ Штраф за пропуск: <b>{describe_penalty(game)}</b>"
     )
@@ -1252,7 +2690,20 @@ def player_menu_text(game: ChatGame, menu: str) -> str:
     return header
 
 
+# Меню с кнопками по игрокам; остальным состав игроков не важен
+PLAYER_LIST_MENUS = ("rename", "reorder", "delete")
+
+
 def build_player_menu_keyboard(game: ChatGame, menu: str) -> InlineKeyboardMarkup:
+    players: Tuple[Tuple[int, str], ...] = ()
+    if menu in PLAYER_LIST_MENUS:
+        players = tuple((player.user_id, player.name) for player in game.players)
+    return player_menu_keyboard_for(menu, players)
+
+
+@functools.lru_cache(maxsize=KEYBOARD_CACHE_SIZE)
+def player_menu_keyboard_for(menu: str, players: Tuple[Tuple[int, str], ...]) -> InlineKeyboardMarkup:
+    """Клавиатура меню игроков для состава players (user_id, имя); разметка общая и не меняется."""
     rows: List[List[InlineKeyboardButton]] = []
     if menu == "root":
         rows = [
@@ -1265,31 +2716,31 @@ def build_player_menu_keyboard(game: ChatGame, menu: str) -> InlineKeyboardMarku
         rows = [
             [
                 InlineKeyboardButton(
-                    text=f"{idx + 1}. {player.name}",
-                    callback_data=f"pm:rename:{player.user_id}",
+                    text=f"{idx + 1}. {name}",
+                    callback_data=f"pm:rename:{user_id}",
                 )
             ]
-            for idx, player in enumerate(game.players)
+            for idx, (user_id, name) in enumerate(players)
         ]
         rows.append([InlineKeyboardButton(text="⬅️ Назад", callback_data="pm:menu:root")])
     elif menu == "reorder":
-        last_index = len(game.players) - 1
-        for idx, player in enumerate(game.players):
+        last_index = len(players) - 1
+        for idx, (user_id, name) in enumerate(players):
             row: List[InlineKeyboardButton] = []
             if idx > 0:
                 row.append(
                     InlineKeyboardButton(
-                        text="⬆️", callback_data=f"pm:move:up:{player.user_id}"
+                        text="⬆️", callback_data=f"pm:move:up:{user_id}"
                     )
                 )
             if idx < last_index:
                 row.append(
                     InlineKeyboardButton(
-                        text="⬇️", callback_data=f"pm:move:down:{player.user_id}"
+                        text="⬇️", callback_data=f"pm:move:down:{user_id}"
                     )
                 )
 
-            row.append(InlineKeyboardButton(text=player.name, callback_data="pm:noop"))
+            row.append(InlineKeyboardButton(text=name, callback_data="pm:noop"))
             rows.append(row)
 
         rows.append([InlineKeyboardButton(text="🔙 Назад", callback_data="pm:menu:root")])
@@ -1297,11 +2748,11 @@ def build_player_menu_keyboard(game: ChatGame, menu: str) -> InlineKeyboardMarku
         rows = [
             [
                 InlineKeyboardButton(
-                    text=f"🗑 {player.name}",
-                    callback_data=f"pm:delete:{player.user_id}",
+                    text=f"🗑 {name}",
+                    callback_data=f"pm:delete:{user_id}",
                 )
             ]
-            for player in game.players
+            for user_id, name in players
         ]
         rows.append([InlineKeyboardButton(text="⬅️ Назад", callback_data="pm:menu:root")])
     else:
@@ -1310,6 +2761,10 @@ def build_player_menu_keyboard(game: ChatGame, menu: str) -> InlineKeyboardMarku
 
 
 def start_menu_keyboard(has_game: bool) -> InlineKeyboardMarkup:
+    return START_MENU_KEYBOARDS[has_game]
+
+
+def build_start_menu_keyboard(has_game: bool) -> InlineKeyboardMarkup:
     rows = [
         [
             InlineKeyboardButton(text="🎮 Новая игра", callback_data="main:newgame"),
@@ -1322,8 +2777,11 @@ def start_menu_keyboard(has_game: bool) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(inline_keyboard=rows)
 
 
+START_MENU_KEYBOARDS = {has_game: build_start_menu_keyboard(has_game) for has_game in (False, True)}
+
+
 async def send_main_menu(chat_id: int):
-    game = GAMES.get(chat_id)
+    game = ensure_game(chat_id)
     has_game = bool(game and game.in_progress)
     await bot.send_message(
         chat_id,
@@ -1337,6 +2795,23 @@ async def send_main_menu(chat_id: int):
 
 
 def build_settings_keyboard(game: ChatGame, menu: str = "root") -> InlineKeyboardMarkup:
+    settings = game.settings
+    if menu == "timer":
+        state: Tuple = (settings.timer,)
+    elif menu == "age":
+        state = (settings.age_level,)
+    elif menu == "category":
+        state = (frozenset(settings.categories),)
+    elif menu == "other":
+        state = (settings.points, settings.skip_penalty == -1)
+    else:
+        state = ()
+    return settings_keyboard_for(menu, state)
+
+
+@functools.lru_cache(maxsize=KEYBOARD_CACHE_SIZE)
+def settings_keyboard_for(menu: str, state: Tuple) -> InlineKeyboardMarkup:
+    """Клавиатура раздела настроек; state — только те настройки, что в нём видны."""
     rows: List[List[InlineKeyboardButton]] = []
     if menu == "root":
         rows = [
@@ -1351,7 +2826,7 @@ def build_settings_keyboard(game: ChatGame, menu: str = "root") -> InlineKeyboar
             [InlineKeyboardButton(text="❌ Закрыть", callback_data="st:close")],
         ]
     elif menu == "timer":
-        current_timer = game.settings.get("timer", 0)
+        (current_timer,) = state
         rows = [
             [
                 InlineKeyboardButton(
@@ -1367,7 +2842,7 @@ def build_settings_keyboard(game: ChatGame, menu: str = "root") -> InlineKeyboar
         rows.append([InlineKeyboardButton(text="⬅️ Назад", callback_data="st:menu:root")])
     elif menu == "age":
         buttons = []
-        current = game.settings.get("age_level", DEFAULT_AGE_LEVEL)
+        (current,) = state
         for key, data in sorted(AGE_LEVELS.items(), key=lambda item: item[1]["rank"]):
             prefix = SELECTED_MARK if key == current else UNSELECTED_MARK
             buttons.append(
@@ -1379,7 +2854,7 @@ def build_settings_keyboard(game: ChatGame, menu: str = "root") -> InlineKeyboar
         rows = [[btn] for btn in buttons]
         rows.append([InlineKeyboardButton(text="⬅️ Назад", callback_data="st:menu:root")])
     elif menu == "category":
-        selected = get_selected_categories(game)
+        (selected,) = state
         rows = []
         for key, info in CATEGORY_INFO.items():
             prefix = SELECTED_MARK if key in selected else UNSELECTED_MARK
@@ -1392,12 +2867,13 @@ def build_settings_keyboard(game: ChatGame, menu: str = "root") -> InlineKeyboar
             ])
         rows.append([InlineKeyboardButton(text="⬅️ Назад", callback_data="st:menu:root")])
     elif menu == "other":
+        points, penalty = state
         points_text = (
-            "⭐ Очки: " + ("Вкл" if game.settings.get("points", True) else "Выкл")
+            "⭐ Очки: " + ("Вкл" if points else "Выкл")
         )
         penalty_text = (
             "⚖️ Штраф: "
-            + ("-1" if game.settings.get("skip_penalty", 0) == -1 else "0")
+            + ("-1" if penalty else "0")
         )
         rows = [
             [InlineKeyboardButton(text=points_text, callback_data="st:toggle:points")],
@@ -1418,23 +2894,33 @@ async def show_player_menu(
         await close_settings_menu(game)
     text = player_menu_text(game, menu)
     keyboard = build_player_menu_keyboard(game, menu)
+    key = render_key(text, keyboard)
     target_chat = game.chat_id
 
     if message:
+        if already_rendered(game, "player_menu", message.message_id, key):
+            game.player_menu_message_id = message.message_id
+            game.player_menu_state = menu
+            return
         try:
             await message.edit_text(text, reply_markup=keyboard)
             game.player_menu_message_id = message.message_id
             game.player_menu_state = menu
+            remember_render(game, "player_menu", message.message_id, key)
             return
         except TelegramBadRequest as exc:
             if is_message_not_modified(exc):
                 game.player_menu_message_id = message.message_id
                 game.player_menu_state = menu
+                remember_render(game, "player_menu", message.message_id, key)
                 return
         except Exception:
             pass
 
     if game.player_menu_message_id:
+        if already_rendered(game, "player_menu", game.player_menu_message_id, key):
+            game.player_menu_state = menu
+            return
         try:
             await bot.edit_message_text(
                 text,
@@ -1443,10 +2929,12 @@ async def show_player_menu(
                 reply_markup=keyboard,
             )
             game.player_menu_state = menu
+            remember_render(game, "player_menu", game.player_menu_message_id, key)
             return
         except TelegramBadRequest as exc:
             if is_message_not_modified(exc):
                 game.player_menu_state = menu
+                remember_render(game, "player_menu", game.player_menu_message_id, key)
                 return
         except Exception:
             pass
@@ -1454,6 +2942,7 @@ async def show_player_menu(
     sent = await bot.send_message(target_chat, text, reply_markup=keyboard)
     game.player_menu_message_id = sent.message_id
     game.player_menu_state = menu
+    remember_render(game, "player_menu", sent.message_id, key)
 
 
 async def show_settings_menu(
@@ -1465,21 +2954,29 @@ async def show_settings_menu(
         await close_player_menu(game)
     text = settings_text(game, menu)
     keyboard = build_settings_keyboard(game, menu)
+    key = render_key(text, keyboard)
     target_chat = game.chat_id
 
     if message:
+        if already_rendered(game, "settings", message.message_id, key):
+            game.settings_message_id = message.message_id
+            return
         try:
             await message.edit_text(text, reply_markup=keyboard)
             game.settings_message_id = message.message_id
+            remember_render(game, "settings", message.message_id, key)
             return
         except TelegramBadRequest as exc:
             if is_message_not_modified(exc):
                 game.settings_message_id = message.message_id
+                remember_render(game, "settings", message.message_id, key)
                 return
         except Exception:
             pass
 
     if game.settings_message_id:
+        if already_rendered(game, "settings", game.settings_message_id, key):
+            return
         try:
             await bot.edit_message_text(
                 text,
@@ -1487,15 +2984,18 @@ async def show_settings_menu(
                 message_id=game.settings_message_id,
                 reply_markup=keyboard,
             )
+            remember_render(game, "settings", game.settings_message_id, key)
             return
         except TelegramBadRequest as exc:
             if is_message_not_modified(exc):
+                remember_render(game, "settings", game.settings_message_id, key)
                 return
         except Exception:
             pass
 
     sent = await bot.send_message(target_chat, text, reply_markup=keyboard)
     game.settings_message_id = sent.message_id
+    remember_render(game, "settings", sent.message_id, key)
 
 
 async def close_settings_menu(game: ChatGame):
@@ -1531,6 +3031,7 @@ async def end_game_session(
     await close_player_menu(game)
     clear_pending_additions(game.chat_id)
     clear_pending_renames(game.chat_id)
+    discard_panel_render(game.chat_id)
 
     if game.panel_message_id:
         try:
@@ -1553,7 +3054,7 @@ async def end_game_session(
     cleanup_scores(game)
     summary = format_scores(game)
     scoreboard_text = ""
-    if game.settings.get("points", True) and rounds_finished > 0 and game.scores:
+    if game.settings.points and rounds_finished > 0 and game.scores:
         scoreboard_text = f"\n\n🏆 <b>Финальный счёт</b>:\n{summary}"
     elif game.scores:
         scoreboard_text = f"\n\n📊 Итоги:\n{summary}"
@@ -1564,6 +3065,7 @@ async def end_game_session(
         game.current_idx = -1
         game.rounds_played = 0
         reset_deck_cache(game, clear_used=True)
+        journal_event(game.chat_id, "stop")
         await refresh_lobby(game, force_new=True)
     else:
         if game.lobby_message_id:
@@ -1577,98 +3079,447 @@ async def end_game_session(
         await send_main_menu(game.chat_id)
 
     if not keep_game:
-        GAMES.pop(game.chat_id, None)
-
-def get_deck_for_game(game: ChatGame) -> List[Dict]:
-    # фильтр по возрасту/категориям
-    selected_age = game.settings.get("age_level", DEFAULT_AGE_LEVEL)
-    if selected_age not in AGE_LEVELS:
-        selected_age = DEFAULT_AGE_LEVEL
-        game.settings["age_level"] = selected_age
-    age_rank = AGE_LEVELS[selected_age]["rank"]
-    if selected_age == "18+":
-        allowed_age = {"18+"}
+        release_shared_decks(game)
+        forget_game(game.chat_id)
+
+def allowed_ages_for(level: str) -> FrozenSet[str]:
+    if level == "18+":
+        return frozenset({"18+"})
+    age_rank = AGE_LEVELS[level]["rank"]
+    return frozenset(age for age, data in AGE_LEVELS.items() if data["rank"] <= age_rank)
+
+
+ALLOWED_AGES: Dict[str, FrozenSet[str]] = {level: allowed_ages_for(level) for level in AGE_LEVELS}
+
+
+def get_deck_filter(game: ChatGame) -> Tuple[FrozenSet[str], FrozenSet[str]]:
+    # фильтр по возрасту/категориям; значения проверены в GameSettings
+    return ALLOWED_AGES[game.settings.age_level], game.settings.categories
+
+
+def pool_bucket_keys(key: DeckIndexKey) -> List[DeckBucketKey]:
+    # порядок обхода фиксирован, чтобы позиции карточек не зависели от хэшей строк
+    kind, ages, categories = key
+    return [(kind, age, category) for age in sorted(ages) for category in sorted(categories)]
+
+
+def build_card_pool(game: ChatGame, key: DeckIndexKey) -> CardPool:
+    pool = CardPool()
+    bucket_keys = pool_bucket_keys(key)
+    bucket_sets = [deck.buckets for deck in game.extra_decks]
+    if STOCK_DECK is not None:
+        pool.add_compiled(STOCK_DECK, bucket_keys)
     else:
-        allowed_age = {
-            age for age, data in AGE_LEVELS.items() if data["rank"] <= age_rank
-        }
+        bucket_sets.insert(0, DEFAULT_DECK_BUCKETS)
+    for buckets in bucket_sets:
+        pool.add_buckets(buckets, bucket_keys)
+    return pool
+
+
+def get_card_pool(game: ChatGame, kind: str) -> CardPool:
+    """Колода нужного типа под текущие настройки; строится один раз на фильтр.
+
+    Готовые колоды общие для чатов с одинаковым набором импортов и не меняются.
+    """
+    ages, categories = get_deck_filter(game)
+    key = (kind, ages, categories)
+    pool = game.deck_index.get(key)
+    if pool is None:
+        shared_key = (tuple(deck.digest for deck in game.extra_decks), key)
+        pool = SHARED_POOLS.get(shared_key)
+        if pool is None:
+            pool = build_card_pool(game, key)
+            SHARED_POOLS[shared_key] = pool
+        while len(game.deck_index) >= DECK_INDEX_LIMIT:
+            game.deck_index.pop(next(iter(game.deck_index)))
+        game.deck_index[key] = pool
+    return pool
+
+
+def find_card(game: ChatGame, card_id: str) -> Optional[Card]:
+    """Карточка по id среди всех колод чата без учёта фильтров — настройки могли смениться."""
+    if STOCK_DECK is not None:
+        position = STOCK_DECK.find(card_id)
+        if position is not None:
+            return STOCK_DECK.card(position)
+    elif card_id in DEFAULT_DECK_BY_ID:
+        return DEFAULT_DECK_BY_ID[card_id]
+    for deck in game.extra_decks:
+        if card_id in deck.ids:
+            return next(card for card in deck.cards if card.id == card_id)
+    return None
 
-    selected_categories = get_selected_categories(game)
-    allowed_categories = set(selected_categories) if selected_categories else set(DEFAULT_CATEGORY_SET)
 
-    deck = [
-        c
-        for c in (DEFAULT_DECK + game.extra_deck)
-        if c.get("age") in allowed_age and c.get("category") in allowed_categories
-    ]
+def sync_deck_index(game: ChatGame):
+    """Подготовить индекс под изменившиеся возраст/категории."""
+    for kind in CARD_TYPES:
+        get_card_pool(game, kind)
+
+
+def deck_digest(raw_cards: Sequence[Dict]) -> str:
+    hasher = hashlib.sha256()
+    for raw in raw_cards:
+        record = [raw["id"], raw["type"], raw["category"], raw["age"], raw["tags"], raw["text"]]
+        hasher.update(json.dumps(record, ensure_ascii=False, separators=(",", ":")).encode("utf-8"))
+        hasher.update(b"\n")
+    return hasher.hexdigest()
+
+
+def build_shared_deck(raw_cards: Sequence[Dict]) -> SharedDeck:
+    """Собрать колоду вне хранилища; уже известное содержимое берётся из DECK_STORE."""
+    digest = deck_digest(raw_cards)
+    deck = DECK_STORE.get(digest)
+    if deck is not None:
+        return deck
+    return shared_deck_from_dicts(digest, raw_cards)
+
+
+def shared_deck_from_dicts(digest: str, raw_cards: Sequence[Dict]) -> SharedDeck:
+    cards = tuple(card_from_dict(raw) for raw in raw_cards)
+    buckets: Dict[DeckBucketKey, List[Card]] = {}
+    add_to_buckets(buckets, cards)
+    return SharedDeck(
+        digest=digest,
+        cards=cards,
+        ids=frozenset(card.id for card in cards),
+        buckets=buckets,
+    )
+
+
+def register_shared_deck(deck: SharedDeck) -> SharedDeck:
+    """Сохранить колоду в DECK_STORE (или взять копию оттуда); счётчик ссылок +1."""
+    deck = DECK_STORE.setdefault(deck.digest, deck)
+    deck.refs += 1
     return deck
 
+
+def acquire_shared_deck(raw_cards: Sequence[Dict]) -> SharedDeck:
+    """Найти колоду с тем же содержимым или сохранить новую; счётчик ссылок +1."""
+    return register_shared_deck(build_shared_deck(raw_cards))
+
+
+def attach_shared_deck(game: ChatGame, deck: SharedDeck):
+    """Подключить колоду и дописать её карточки в уже построенные колоды игры."""
+    game.extra_decks.append(deck)
+    digests = tuple(extra.digest for extra in game.extra_decks)
+    for key, pool in list(game.deck_index.items()):
+        shared_key = (digests, key)
+        extended = SHARED_POOLS.get(shared_key)
+        if extended is None:
+            # старая колода может быть общей с другими чатами — дописываем в копию
+            extended = pool.extended(deck.buckets, pool_bucket_keys(key))
+            SHARED_POOLS[shared_key] = extended
+        game.deck_index[key] = extended
+
+
+def release_shared_decks(game: ChatGame):
+    for deck in game.extra_decks:
+        deck.refs -= 1
+        if deck.refs <= 0:
+            DECK_STORE.pop(deck.digest, None)
+    game.extra_decks = []
+    game.deck_index.clear()
+
+
+def is_card_id_taken(game: ChatGame, card_id: str) -> bool:
+    return is_card_id_in_decks(game.extra_decks, card_id)
+
+
+def is_card_id_in_decks(decks: Sequence[SharedDeck], card_id: str) -> bool:
+    if STOCK_DECK is not None:
+        in_stock = STOCK_DECK.find(card_id) is not None
+    else:
+        in_stock = card_id in DEFAULT_DECK_IDS
+    return in_stock or any(card_id in deck.ids for deck in decks)
+
+
+def validate_deck_items(
+    decks: Sequence[SharedDeck], items: Iterable[object], batch_ids: Set[str]
+) -> Tuple[List[Dict], int]:
+    """Проверить карточки импорта; возвращает принятые и число пропущенных."""
+    accepted: List[Dict] = []
+    skipped = 0
+    for raw in items:
+        card = normalize_deck_item(raw)
+        if card is None or card["id"] in batch_ids or is_card_id_in_decks(decks, card["id"]):
+            skipped += 1
+            continue
+        accepted.append(card)
+        batch_ids.add(card["id"])
+    return accepted, skipped
+
+
+def prepare_deck_batch(
+    decks: Sequence[SharedDeck], items: Sequence[object], batch_ids: Set[str]
+) -> Tuple[Optional[SharedDeck], int, int]:
+    """Проверить пачку и собрать из неё колоду, не трогая игру: (колода, принято, пропущено).
+
+    Может выполняться в DECK_WORKER, поэтому получает снимок колод игры, а не её саму.
+    """
+    accepted, skipped = validate_deck_items(decks, items, batch_ids)
+    deck = build_shared_deck(accepted) if accepted else None
+    return deck, len(accepted), skipped
+
+
+async def run_deck_job(func, *args, **kwargs):
+    job = functools.partial(func, *args, **kwargs)
+    return await asyncio.get_running_loop().run_in_executor(DECK_WORKER, job)
+
+
+async def prepare_deck_batch_async(
+    decks: Sequence[SharedDeck], items: Sequence[object], batch_ids: Set[str]
+) -> Tuple[Optional[SharedDeck], int, int]:
+    if len(items) < DECK_OFFLOAD_MIN_ITEMS:
+        return prepare_deck_batch(decks, items, batch_ids)
+    return await run_deck_job(prepare_deck_batch, decks, items, batch_ids)
+
+
+def commit_prepared_decks(game: ChatGame, decks: Sequence[SharedDeck]):
+    """Подключить готовые колоды за один шаг цикла событий: игра видит импорт целиком."""
+    attached = [register_shared_deck(deck) for deck in decks]
+    for deck in attached:
+        attach_shared_deck(game, deck)
+    if attached:
+        reset_deck_cache(game, clear_used=True)
+        journal_decks(game, attached)
+
+
+_JSON_DECODER = json.JSONDecoder()
+_WHITESPACE = re.compile(r"\s*")
+
+
+@dataclass
+class DeckStreamParser:
+    """Инкрементальный разбор колоды по кускам файла.
+
+    JSON вида {"meta": ..., "items": [...]} отдаёт карточки из items по одной,
+    NDJSON — по строке на карточку. В буфере держим только недочитанный хвост.
+    """
+    ndjson: bool = False
+    buffer: str = ""
+    state: str = "start"
+    decoder: codecs.IncrementalDecoder = field(
+        default_factory=lambda: codecs.getincrementaldecoder("utf-8-sig")()
+    )
+
+    def feed(self, chunk: bytes, *, final: bool = False) -> List[object]:
+        self.buffer += self.decoder.decode(chunk, final)
+        items = self._parse_ndjson(final) if self.ndjson else self._parse_json(final)
+        if len(self.buffer) > DECK_MAX_ITEM_CHARS:
+            raise DeckFormatError("слишком длинная карточка или повреждённый JSON")
+        if final and not self.ndjson and self.state != "done":
+            raise DeckFormatError("файл оборвался или не является объектом с полем items")
+        return items
+
+    def _parse_ndjson(self, final: bool) -> List[object]:
+        lines = self.buffer.split("\n")
+        self.buffer = "" if final else lines.pop()
+        items: List[object] = []
+        for line in lines:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                item = json.loads(line)
+            except ValueError:
+                item = None  # битая строка считается пропущенной карточкой
+            if isinstance(item, dict) and "meta" in item and "text" not in item:
+                continue
+            items.append(item)
+        return items
+
+    def _decode(self, buf: str, pos: int, final: bool) -> Optional[Tuple[object, int]]:
+        """Значение целиком или None, если его конец ещё не пришёл."""
+        try:
+            value, end = _JSON_DECODER.raw_decode(buf, pos)
+        except json.JSONDecodeError as exc:
+            if final:
+                raise DeckFormatError(f"некорректный JSON: {exc}") from None
+            return None
+        # число или литерал на краю буфера могут продолжиться в следующем куске
+        if end >= len(buf) and not final:
+            return None
+        return value, end
+
+    def _parse_json(self, final: bool) -> List[object]:
+        items: List[object] = []
+        buf = self.buffer
+        pos = 0
+        while True:
+            pos = _WHITESPACE.match(buf, pos).end()
+            if pos >= len(buf):
+                break
+            char = buf[pos]
+            state = self.state
+            if state == "start":
+                if char != "{":
+                    raise DeckFormatError("ожидался объект {\"meta\": ..., \"items\": [...]}")
+                pos += 1
+                self.state = "key"
+            elif state in ("key", "next_key"):
+                if char == "}":
+                    pos += 1
+                    self.state = "done"
+                    continue
+                if state == "next_key":
+                    if char != ",":
+                        raise DeckFormatError("ожидалась запятая между полями")
+                    pos += 1
+                    self.state = "key"
+                    continue
+                decoded = self._decode(buf, pos, final)
+                if decoded is None:
+                    break
+                key, end = decoded
+                colon = _WHITESPACE.match(buf, end).end()
+                if colon >= len(buf):
+                    break
+                if not isinstance(key, str) or buf[colon] != ":":
+                    raise DeckFormatError("ожидалось имя поля")
+                pos = colon + 1
+                self.state = "items" if key == "items" else "value"
+            elif state == "value":
+                decoded = self._decode(buf, pos, final)
+                if decoded is None:
+                    break
+                pos = decoded[1]
+                self.state = "next_key"
+            elif state == "items":
+                if char != "[":
+                    raise DeckFormatError("поле items должно быть списком")
+                pos += 1
+                self.state = "first_item"
+            elif state in ("first_item", "item"):
+                if char == "]" and state == "first_item":
+                    pos += 1
+                    self.state = "next_key"
+                    continue
+                decoded = self._decode(buf, pos, final)
+                if decoded is None:
+                    break
+                item, pos = decoded
+                items.append(item)
+                self.state = "next_item"
+            elif state == "next_item":
+                if char == "]":
+                    pos += 1
+                    self.state = "next_key"
+                elif char == ",":
+                    pos += 1
+                    self.state = "item"
+                else:
+                    raise DeckFormatError("ожидалась запятая между карточками")
+            else:
+                raise DeckFormatError("лишние данные после JSON")
+        self.buffer = buf[pos:]
+        return items
+
+
+def get_deal_queue(game: ChatGame, kind: str) -> DealQueue:
+    queue = game.deck_cache.get(kind)
+    if not isinstance(queue, DealQueue):
+        queue = DealQueue()
+        game.deck_cache[kind] = queue
+    return queue
+
+
+def refill_deal_queue(game: ChatGame, queue: DealQueue, pool: CardPool) -> bool:
+    """Новый круг раздачи; True, если колода уже раздавалась (нужно сообщить о перемешивании)."""
+    queue.start_cycle(len(pool))
+    restarted = game.dealt_in_cycle > 0
+    game.dealt_in_cycle = 0
+    return restarted
+
+
 def pick_card(
     game: ChatGame,
     kind: str,
     *,
     exclude: Optional[Set[str]] = None,
-) -> Tuple[Optional[Dict], bool]:
-    available = [c for c in get_deck_for_game(game) if c.get("type") == kind]
-    if not available:
+) -> Tuple[Optional[Card], bool]:
+    pool = get_card_pool(game, kind)
+    if not pool:
         return None, False
 
     exclude_ids = set(exclude or [])
-    cards_by_id = {c["id"]: c for c in available}
-    queue = game.deck_cache.setdefault(kind, [])
-    queue[:] = [cid for cid in queue if cid in cards_by_id]
+    queue = get_deal_queue(game, kind)
 
-    avoid_keywords = set(game.last_keywords.get(kind, set()))
-    similar_buffer: List[Tuple[str, Set[str]]] = []
+    avoid_keywords = game.last_keywords.get(kind, EMPTY_SIGNATURE)
+    avoid_mask = avoid_keywords[0]
+    similar_buffer: List[Card] = []
+    # исключённые карточки уходят под низ колоды после выбора
+    held_back: List[str] = []
+    total_candidates = len(pool) - len(exclude_ids)
 
     restarted = False
+    refilled = False
     if not queue:
-        shuffled_ids = list(cards_by_id.keys())
-        random.shuffle(shuffled_ids)
-        queue.extend(shuffled_ids)
-        if game.used_ids:
-            restarted = True
-        game.used_ids.clear()
-
-    while queue:
-        card_id = queue.pop()
-        card = cards_by_id.get(card_id)
-        if not card:
+        restarted = refill_deal_queue(game, queue, pool)
+        refilled = True
+
+    card: Optional[Card] = None
+    while card is None:
+        card_id = queue.pop(pool)
+        if card_id is None:
+            if similar_buffer or refilled:
+                break
+            # в очереди оставались только устаревшие или исключённые карточки
+            restarted = refill_deal_queue(game, queue, pool)
+            refilled = True
+            held_back.clear()
+            continue
+        candidate = pool.get(card_id)
+        if not candidate:
             continue
         if (
             exclude_ids
             and card_id in exclude_ids
-            and len(cards_by_id) > len(exclude_ids)
+            and len(pool) > len(exclude_ids)
         ):
-            queue.insert(0, card_id)
+            held_back.append(card_id)
             continue
-        keywords = extract_keywords(card.get("text", ""))
-        similar = bool(avoid_keywords and keywords and (keywords & avoid_keywords))
-        total_candidates = len(cards_by_id) - len(exclude_ids)
+        # дешёвый AND масок отсекает почти все карточки без вызова функции
+        similar = bool(candidate.keyword_mask & avoid_mask) and signatures_overlap(
+            candidate.keywords, avoid_keywords
+        )
         if similar and total_candidates > len(similar_buffer):
-            similar_buffer.append((card_id, keywords))
+            similar_buffer.append(candidate)
             continue
+        card = candidate
+
+    if card is None:
+        if not similar_buffer:
+            for held_id in held_back:
+                queue.push_bottom(held_id)
+            return None, restarted
+        # похожие карточки закончились вместе с очередью — берём первую из отложенных
+        card = similar_buffer[0]
+        similar_buffer = similar_buffer[1:]
+
+    game.dealt_in_cycle += 1
+    game.last_keywords[kind] = card.keywords
+    for held_id in held_back:
+        queue.push_bottom(held_id)
+    for skipped in reversed(similar_buffer):
+        queue.push_bottom(skipped.id)
+    return card, restarted
+
+# Клавиатуры лобби и хода не зависят от состояния игры: собираются один раз при
+# загрузке модуля и отдаются готовыми (разметку никто не меняет)
 
-        game.used_ids.add(card_id)
-        game.last_keywords[kind] = keywords
-        for skipped_id, _ in reversed(similar_buffer):
-            queue.insert(0, skipped_id)
-        return card, restarted
+def lobby_keyboard(game: ChatGame) -> InlineKeyboardMarkup:
+    return LOBBY_KEYBOARD
 
-    while similar_buffer:
-        card_id, keywords = similar_buffer.pop(0)
-        card = cards_by_id.get(card_id)
-        if not card:
-            continue
-        game.used_ids.add(card_id)
-        game.last_keywords[kind] = keywords
-        for rest_id, _ in reversed(similar_buffer):
-            queue.insert(0, rest_id)
-        return card, restarted
 
-    return None, restarted
+def turn_choice_keyboard(game: ChatGame, show_end: bool) -> InlineKeyboardMarkup:
+    return TURN_CHOICE_KEYBOARDS[show_end]
 
-def lobby_keyboard(game: ChatGame) -> InlineKeyboardMarkup:
+
+def task_keyboard(game: ChatGame, for_host: bool, allow_reroll: bool) -> InlineKeyboardMarkup:
+    return TASK_KEYBOARDS[for_host, allow_reroll]
+
+
+def build_lobby_keyboard() -> InlineKeyboardMarkup:
     buttons: List[List[InlineKeyboardButton]] = [
         [InlineKeyboardButton(text="▶️ Старт", callback_data="start")],
         [
@@ -1683,7 +3534,7 @@ def lobby_keyboard(game: ChatGame) -> InlineKeyboardMarkup:
 
     return InlineKeyboardMarkup(inline_keyboard=buttons)
 
-def turn_choice_keyboard(game: ChatGame, show_end: bool) -> InlineKeyboardMarkup:
+def build_turn_choice_keyboard(show_end: bool) -> InlineKeyboardMarkup:
     row1 = [
         InlineKeyboardButton(text="🟦 Правда", callback_data="truth"),
         InlineKeyboardButton(text="🟥 Действие", callback_data="dare"),
@@ -1695,7 +3546,7 @@ def turn_choice_keyboard(game: ChatGame, show_end: bool) -> InlineKeyboardMarkup
         rows.append([InlineKeyboardButton(text="🏁 Завершить", callback_data="end")])
     return InlineKeyboardMarkup(inline_keyboard=rows)
 
-def task_keyboard(game: ChatGame, for_host: bool, allow_reroll: bool) -> InlineKeyboardMarkup:
+def build_task_keyboard(for_host: bool, allow_reroll: bool) -> InlineKeyboardMarkup:
     rows: List[List[InlineKeyboardButton]] = [
         [
             InlineKeyboardButton(text="✅ Выполнено", callback_data="done"),
@@ -1708,8 +3559,1548 @@ def task_keyboard(game: ChatGame, for_host: bool, allow_reroll: bool) -> InlineK
         rows.append([InlineKeyboardButton(text="🏁 Завершить", callback_data="end")])
     return InlineKeyboardMarkup(inline_keyboard=rows)
 
+
+LOBBY_KEYBOARD = build_lobby_keyboard()
+TURN_CHOICE_KEYBOARDS = {show_end: build_turn_choice_keyboard(show_end) for show_end in (False, True)}
+TASK_KEYBOARDS = {
+    (for_host, allow_reroll): build_task_keyboard(for_host, allow_reroll)
+    for for_host in (False, True)
+    for allow_reroll in (False, True)
+}
+
+# ===========================
+# ХРАНЕНИЕ СОСТОЯНИЯ
+# ===========================
+#
+# Игры пишутся в SQLite (WAL) не на каждое изменение: чат помечается «грязным»
+# после обработки апдейта или срабатывания таймера, а фоновая задача раз в
+# STATE_FLUSH_INTERVAL секунд сохраняет все помеченные игры одной транзакцией
+# в отдельном потоке. После рестарта игра читается из базы при первом обращении.
+#
+# Хранилище (STATE_BACKEND) — SQLite, память или Redis. С общим хранилищем
+# (Redis, несколько реплик) GAMES — лишь кэш горячих игр: перед апдейтом
+# версия игры сверяется с хранилищем, после апдейта игра сразу записывается,
+# а запись поверх чужой версии отклоняется и локальная копия сбрасывается.
+
+STATE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS games (
+    chat_id INTEGER PRIMARY KEY,
+    state TEXT NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS decks (
+    digest TEXT PRIMARY KEY,
+    cards TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS game_decks (
+    chat_id INTEGER NOT NULL,
+    digest TEXT NOT NULL,
+    PRIMARY KEY (chat_id, digest)
+);
+CREATE INDEX IF NOT EXISTS game_decks_digest ON game_decks (digest);
+CREATE TABLE IF NOT EXISTS leaderboard (
+    scope INTEGER NOT NULL,
+    user_id INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    points INTEGER NOT NULL,
+    PRIMARY KEY (scope, user_id)
+);
+CREATE INDEX IF NOT EXISTS leaderboard_top ON leaderboard (scope, points DESC, user_id);
+"""
+
+# Чаты с несохранёнными изменениями и удалённые игры, ещё не стёртые из базы
+DIRTY_GAMES: Set[int] = set()
+DELETED_GAMES: Set[int] = set()
+# Игры, запись которых сейчас идёт в потоке хранилища
+SAVING_GAMES: Set[int] = set()
+# Счётчики выгрузки и обратной загрузки игр, сброса устаревших копий и конфликтов записи
+GAME_CACHE_STATS: Dict[str, int] = {
+    "evictions": 0,
+    "rehydrations": 0,
+    "invalidations": 0,
+    "conflicts": 0,
+    "unchanged": 0,
+}
+
+
+def card_to_dict(card: Card) -> Dict:
+    return {
+        "id": card.id,
+        "type": card.type,
+        "category": card.category,
+        "age": card.age,
+        "tags": list(card.tags),
+        "text": card.text,
+    }
+
+
+class StateStore(ABC):
+    """Хранилище игр: SQLite, память процесса или Redis.
+
+    Запись идёт пачками в потоке executor, туда же уходят чтения перед
+    обработкой апдейта и чтения рекордов; из цикла событий хранилище читается
+    только как запасной путь (игра чужого чата, таймер). Каждая запись игры
+    выдаёт новую версию; игра с устаревшей версией не пишется (оптимистическая
+    блокировка), write_batch возвращает новые версии только для записанных игр.
+    """
+
+    # другие реплики бота пишут в то же хранилище
+    shared = False
+
+    def __init__(self):
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="state-flush")
+
+    @abstractmethod
+    def load_game(self, chat_id: int) -> Optional[Tuple[int, Dict]]:
+        ...
+
+    @abstractmethod
+    def game_version(self, chat_id: int) -> int:
+        ...
+
+    @abstractmethod
+    def load_deck(self, digest: str) -> Optional[List[Dict]]:
+        ...
+
+    @abstractmethod
+    def write_batch(
+        self,
+        games: Sequence[Tuple[int, int, str, Sequence[SharedDeck]]],
+        deleted: Sequence[int],
+    ) -> Dict[int, int]:
+        ...
+
+    @abstractmethod
+    def top_points(self, scope: int, limit: int) -> List[Tuple[int, str, int]]:
+        """Лучшие (user_id, имя, очки) рекордов scope по убыванию очков."""
+
+    @abstractmethod
+    def user_points(self, scope: int, user_id: int) -> int:
+        ...
+
+    @abstractmethod
+    def add_points(self, rows: Sequence[Tuple[int, int, str, int]]):
+        """Прибавить очки пачкой (scope, user_id, имя, изменение) — поток записи."""
+
+
+def connect_state_db(path: str) -> sqlite3.Connection:
+    conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA busy_timeout=5000")
+    return conn
+
+
+def migrate_state_db(conn: sqlite3.Connection):
+    """Создать таблицы и добавить новые столбцы; безопасно при одновременном запуске."""
+    conn.executescript(STATE_SCHEMA)
+    # проверка и ALTER под одной блокировкой записи: второй процесс увидит готовый столбец
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(games)")}
+        if "version" not in columns:
+            conn.execute("ALTER TABLE games ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+        conn.execute("COMMIT")
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+
+
+class GameStore(StateStore):
+    """SQLite в режиме WAL: отдельные соединения для чтения и записи."""
+
+    def __init__(self, path: str):
+        super().__init__()
+        self.path = path
+        self.reader = self._connect()
+        migrate_state_db(self.reader)
+        self.writer: Optional[sqlite3.Connection] = None
+        # колоды, которые точно лежат в базе; меняется только в потоке записи
+        self.saved_decks: Set[str] = set()
+
+    def _connect(self) -> sqlite3.Connection:
+        return connect_state_db(self.path)
+
+    def load_game(self, chat_id: int) -> Optional[Tuple[int, Dict]]:
+        row = self.reader.execute(
+            "SELECT version, state FROM games WHERE chat_id = ?", (chat_id,)
+        ).fetchone()
+        return (row[0], json.loads(row[1])) if row else None
+
+    def game_version(self, chat_id: int) -> int:
+        row = self.reader.execute("SELECT version FROM games WHERE chat_id = ?", (chat_id,)).fetchone()
+        return row[0] if row else 0
+
+    def load_deck(self, digest: str) -> Optional[List[Dict]]:
+        row = self.reader.execute("SELECT cards FROM decks WHERE digest = ?", (digest,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def top_points(self, scope: int, limit: int) -> List[Tuple[int, str, int]]:
+        return self.reader.execute(
+            "SELECT user_id, name, points FROM leaderboard WHERE scope = ? "
+            "ORDER BY points DESC, user_id LIMIT ?",
+            (scope, limit),
+        ).fetchall()
+
+    def user_points(self, scope: int, user_id: int) -> int:
+        row = self.reader.execute(
+            "SELECT points FROM leaderboard WHERE scope = ? AND user_id = ?", (scope, user_id)
+        ).fetchone()
+        return row[0] if row else 0
+
+    def add_points(self, rows: Sequence[Tuple[int, int, str, int]]):
+        conn = self._writer()
+        conn.execute("BEGIN")
+        try:
+            conn.executemany(
+                "INSERT INTO leaderboard (scope, user_id, name, points) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (scope, user_id) DO UPDATE SET "
+                "points = points + excluded.points, name = excluded.name",
+                rows,
+            )
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def _writer(self) -> sqlite3.Connection:
+        if self.writer is None:
+            self.writer = self._connect()
+        return self.writer
+
+    def write_batch(
+        self,
+        games: Sequence[Tuple[int, int, str, Sequence[SharedDeck]]],
+        deleted: Sequence[int],
+    ) -> Dict[int, int]:
+        """Сохранить пачку игр и удалить закрытые одной транзакцией (поток записи)."""
+        conn = self._writer()
+        now = time.time()
+        written: Dict[int, int] = {}
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            released: Set[str] = set()
+            # удаления раньше записей: новая игра в том же чате начинается с версии 0
+            for chat_id in deleted:
+                released |= self._unlink_decks(conn, chat_id)
+            conn.executemany("DELETE FROM games WHERE chat_id = ?", [(chat_id,) for chat_id in deleted])
+            for chat_id, version, state, decks in games:
+                row = conn.execute("SELECT version FROM games WHERE chat_id = ?", (chat_id,)).fetchone()
+                if (row[0] if row else 0) != version:
+                    continue
+                written[chat_id] = version + 1
+                released |= self._unlink_decks(conn, chat_id)
+                conn.execute(
+                    "INSERT OR REPLACE INTO games (chat_id, state, updated_at, version) VALUES (?, ?, ?, ?)",
+                    (chat_id, state, now, written[chat_id]),
+                )
+                for deck in decks:
+                    conn.execute(
+                        "INSERT OR IGNORE INTO game_decks (chat_id, digest) VALUES (?, ?)",
+                        (chat_id, deck.digest),
+                    )
+                    if deck.digest not in self.saved_decks:
+                        cards = json.dumps([card_to_dict(card) for card in deck.cards], ensure_ascii=False)
+                        conn.execute(
+                            "INSERT OR IGNORE INTO decks (digest, cards) VALUES (?, ?)",
+                            (deck.digest, cards),
+                        )
+                        self.saved_decks.add(deck.digest)
+                    released.discard(deck.digest)
+            for digest in released:
+                deleted_rows = conn.execute(
+                    "DELETE FROM decks WHERE digest = ? AND NOT EXISTS "
+                    "(SELECT 1 FROM game_decks WHERE game_decks.digest = decks.digest)",
+                    (digest,),
+                ).rowcount
+                if deleted_rows:
+                    self.saved_decks.discard(digest)
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            self.saved_decks.clear()
+            raise
+        return written
+
+    @staticmethod
+    def _unlink_decks(conn: sqlite3.Connection, chat_id: int) -> Set[str]:
+        digests = {
+            digest for (digest,) in conn.execute("SELECT digest FROM game_decks WHERE chat_id = ?", (chat_id,))
+        }
+        conn.execute("DELETE FROM game_decks WHERE chat_id = ?", (chat_id,))
+        return digests
+
+
+class MemoryStore(StateStore):
+    """Хранилище в памяти процесса: для тестов и запуска без диска."""
+
+    def __init__(self):
+        super().__init__()
+        self.lock = threading.Lock()
+        self.games: Dict[int, Tuple[int, str]] = {}
+        self.decks: Dict[str, List[Dict]] = {}
+        self.game_decks: Dict[int, Set[str]] = {}
+        self.clock = itertools.count(1)
+        self.points: Dict[int, Dict[int, List]] = {}  # scope -> user_id -> [имя, очки]
+
+    def load_game(self, chat_id: int) -> Optional[Tuple[int, Dict]]:
+        with self.lock:
+            stored = self.games.get(chat_id)
+        return (stored[0], json.loads(stored[1])) if stored else None
+
+    def game_version(self, chat_id: int) -> int:
+        with self.lock:
+            stored = self.games.get(chat_id)
+        return stored[0] if stored else 0
+
+    def load_deck(self, digest: str) -> Optional[List[Dict]]:
+        with self.lock:
+            return self.decks.get(digest)
+
+    def write_batch(
+        self,
+        games: Sequence[Tuple[int, int, str, Sequence[SharedDeck]]],
+        deleted: Sequence[int],
+    ) -> Dict[int, int]:
+        written: Dict[int, int] = {}
+        with self.lock:
+            released: Set[str] = set()
+            for chat_id in deleted:
+                self.games.pop(chat_id, None)
+                released |= self.game_decks.pop(chat_id, set())
+            for chat_id, version, state, decks in games:
+                stored = self.games.get(chat_id)
+                if (stored[0] if stored else 0) != version:
+                    continue
+                written[chat_id] = next(self.clock)
+                self.games[chat_id] = (written[chat_id], state)
+                released |= self.game_decks.get(chat_id, set())
+                self.game_decks[chat_id] = {deck.digest for deck in decks}
+                for deck in decks:
+                    if deck.digest not in self.decks:
+                        self.decks[deck.digest] = [card_to_dict(card) for card in deck.cards]
+            in_use = set().union(*self.game_decks.values()) if self.game_decks else set()
+            for digest in released - in_use:
+                self.decks.pop(digest, None)
+        return written
+
+    def top_points(self, scope: int, limit: int) -> List[Tuple[int, str, int]]:
+        with self.lock:
+            rows = [(user_id, name, points) for user_id, (name, points) in self.points.get(scope, {}).items()]
+        return heapq.nsmallest(limit, rows, key=lambda row: (-row[2], row[0]))
+
+    def user_points(self, scope: int, user_id: int) -> int:
+        with self.lock:
+            entry = self.points.get(scope, {}).get(user_id)
+        return entry[1] if entry else 0
+
+    def add_points(self, rows: Sequence[Tuple[int, int, str, int]]):
+        with self.lock:
+            for scope, user_id, name, delta in rows:
+                entry = self.points.setdefault(scope, {}).setdefault(user_id, [name, 0])
+                entry[0] = name
+                entry[1] += delta
+
+
+class RespError(Exception):
+    pass
+
+
+class RespClient:
+    """Минимальный клиент протокола Redis (RESP2) поверх сокета, без пула.
+
+    После сетевой ошибки или таймаута сокет закрывается, следующий вызов
+    подключается заново. retry — повторить команду на новом соединении один раз:
+    только для чтений, запись могла дойти до сервера.
+    """
+
+    def __init__(self, url: str, *, timeout: float = REDIS_TIMEOUT, retry: bool = False):
+        self.url = urllib.parse.urlparse(url)
+        self.timeout = timeout
+        self.retry = retry
+        self.lock = threading.Lock()
+        self.sock: Optional[socket.socket] = None
+        self.reader = None
+        with self.lock:
+            self._connect()
+
+    def _connect(self):
+        parsed = self.url
+        self.sock = socket.create_connection(
+            (parsed.hostname or "localhost", parsed.port or 6379), timeout=self.timeout
+        )
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.reader = self.sock.makefile("rb")
+        try:
+            if parsed.password:
+                self._call(("AUTH", parsed.password))
+            database = parsed.path.lstrip("/")
+            if database and database != "0":
+                self._call(("SELECT", database))
+        except BaseException:
+            self._close()
+            raise
+
+    def _close(self):
+        for closable in (self.reader, self.sock):
+            if closable is not None:
+                with contextlib.suppress(OSError):
+                    closable.close()
+        self.sock = None
+        self.reader = None
+
+    def call(self, *args):
+        with self.lock:
+            for attempt in range(2 if self.retry else 1):
+                try:
+                    if self.sock is None:
+                        self._connect()
+                    return self._call(args)
+                except (OSError, ConnectionError):
+                    # ответ мог остаться в сокете недочитанным — соединение больше не годится
+                    self._close()
+                    if attempt or not self.retry:
+                        raise
+
+    def _call(self, args):
+        parts = [b"*%d\r\n" % len(args)]
+        for arg in args:
+            data = arg if isinstance(arg, bytes) else str(arg).encode("utf-8")
+            parts.append(b"$%d\r\n%s\r\n" % (len(data), data))
+        self.sock.sendall(b"".join(parts))
+        return self._read_reply()
+
+    def _read_reply(self):
+        line = self.reader.readline()
+        if not line:
+            raise ConnectionError("Redis закрыл соединение")
+        kind, payload = line[:1], line[1:-2]
+        if kind == b"+":
+            return payload.decode("utf-8")
+        if kind == b"-":
+            raise RespError(payload.decode("utf-8"))
+        if kind == b":":
+            return int(payload)
+        if kind == b"$":
+            size = int(payload)
+            if size < 0:
+                return None
+            data = self.reader.read(size + 2)
+            return data[:-2]
+        if kind == b"*":
+            count = int(payload)
+            if count < 0:
+                return None
+            return [self._read_reply() for _ in range(count)]
+        raise RespError(f"неизвестный ответ Redis: {line!r}")
+
+
+class RedisStore(StateStore):
+    """Игры в Redis: общее состояние для нескольких реплик бота.
+
+    state:<chat> — JSON игры, ver:<chat> — её версия из общего счётчика clock
+    (версии не повторяются и после удаления игры), gamedecks:<chat> и
+    deckrefs:<digest> — множества для подсчёта ссылок на колоды deck:<digest>.
+    Рекорды — sorted set points:<scope> и имена в хэше names:<scope>.
+    """
+
+    shared = True
+    WRITE_ATTEMPTS = 3
+
+    def __init__(self, url: str, prefix: str):
+        super().__init__()
+        self.url = url
+        self.prefix = prefix
+        self.reader = RespClient(url, retry=True)
+        self.writer: Optional[RespClient] = None
+
+    def key(self, kind: str, name) -> str:
+        return f"{self.prefix}{kind}:{name}"
+
+    def _writer(self) -> RespClient:
+        if self.writer is None:
+            self.writer = RespClient(self.url)
+        return self.writer
+
+    def load_game(self, chat_id: int) -> Optional[Tuple[int, Dict]]:
+        version, state = self.reader.call("MGET", self.key("ver", chat_id), self.key("state", chat_id))
+        if state is None:
+            return None
+        return int(version), json.loads(state)
+
+    def game_version(self, chat_id: int) -> int:
+        version = self.reader.call("GET", self.key("ver", chat_id))
+        return int(version) if version is not None else 0
+
+    def load_deck(self, digest: str) -> Optional[List[Dict]]:
+        cards = self.reader.call("GET", self.key("deck", digest))
+        return json.loads(cards) if cards is not None else None
+
+    def write_batch(
+        self,
+        games: Sequence[Tuple[int, int, str, Sequence[SharedDeck]]],
+        deleted: Sequence[int],
+    ) -> Dict[int, int]:
+        conn = self._writer()
+        written: Dict[int, int] = {}
+        released: Set[str] = set()
+        for chat_id in deleted:
+            released |= self._delete_game(conn, chat_id)
+        for chat_id, version, state, decks in games:
+            for _ in range(self.WRITE_ATTEMPTS):
+                result = self._write_game(conn, chat_id, version, state, decks)
+                if result is not None:
+                    break
+            else:
+                result = (0, set())
+            new_version, dropped = result
+            if new_version:
+                written[chat_id] = new_version
+                released |= dropped
+        for digest in released:
+            self._drop_unused_deck(conn, digest)
+        return written
+
+    def _write_game(self, conn: RespClient, chat_id: int, version: int, state: str, decks):
+        """Одна попытка записи; None — транзакцию сорвала чужая запись, можно повторить."""
+        ver_key = self.key("ver", chat_id)
+        deck_keys = [self.key("deck", deck.digest) for deck in decks]
+        conn.call("WATCH", ver_key, *deck_keys)
+        stored = conn.call("GET", ver_key)
+        if (int(stored) if stored is not None else 0) != version:
+            conn.call("UNWATCH")
+            return 0, set()
+        digests = {deck.digest for deck in decks}
+        old_digests = {digest.decode("utf-8") for digest in conn.call("SMEMBERS", self.key("gamedecks", chat_id))}
+        missing = [deck for deck, key in zip(decks, deck_keys) if not conn.call("EXISTS", key)]
+        new_version = conn.call("INCR", self.key("clock", "games"))
+        conn.call("MULTI")
+        conn.call("SET", self.key("state", chat_id), state)
+        conn.call("SET", ver_key, new_version)
+        conn.call("DEL", self.key("gamedecks", chat_id))
+        if digests:
+            conn.call("SADD", self.key("gamedecks", chat_id), *digests)
+        for deck in missing:
+            cards = json.dumps([card_to_dict(card) for card in deck.cards], ensure_ascii=False)
+            conn.call("SET", self.key("deck", deck.digest), cards)
+        for digest in digests:
+            conn.call("SADD", self.key("deckrefs", digest), chat_id)
+        for digest in old_digests - digests:
+            conn.call("SREM", self.key("deckrefs", digest), chat_id)
+        if conn.call("EXEC") is None:
+            return None
+        return new_version, old_digests - digests
+
+    def _delete_game(self, conn: RespClient, chat_id: int) -> Set[str]:
+        old_digests = {digest.decode("utf-8") for digest in conn.call("SMEMBERS", self.key("gamedecks", chat_id))}
+        conn.call("MULTI")
+        conn.call("DEL", self.key("state", chat_id), self.key("ver", chat_id), self.key("gamedecks", chat_id))
+        for digest in old_digests:
+            conn.call("SREM", self.key("deckrefs", digest), chat_id)
+        conn.call("EXEC")
+        return old_digests
+
+    def top_points(self, scope: int, limit: int) -> List[Tuple[int, str, int]]:
+        flat = self.reader.call("ZREVRANGE", self.key("points", scope), 0, limit - 1, "WITHSCORES")
+        if not flat:
+            return []
+        user_ids = [int(member) for member in flat[::2]]
+        names = self.reader.call("HMGET", self.key("names", scope), *user_ids)
+        return [
+            (user_id, name.decode("utf-8") if name is not None else str(user_id), int(float(points)))
+            for user_id, name, points in zip(user_ids, names, flat[1::2])
+        ]
+
+    def user_points(self, scope: int, user_id: int) -> int:
+        points = self.reader.call("ZSCORE", self.key("points", scope), user_id)
+        return int(float(points)) if points is not None else 0
+
+    def add_points(self, rows: Sequence[Tuple[int, int, str, int]]):
+        conn = self._writer()
+        conn.call("MULTI")
+        for scope, user_id, name, delta in rows:
+            conn.call("ZINCRBY", self.key("points", scope), delta, user_id)
+            conn.call("HSET", self.key("names", scope), user_id, name)
+        conn.call("EXEC")
+
+    def _drop_unused_deck(self, conn: RespClient, digest: str):
+        refs_key = self.key("deckrefs", digest)
+        conn.call("WATCH", refs_key)
+        if conn.call("SCARD", refs_key):
+            conn.call("UNWATCH")
+            return
+        conn.call("MULTI")
+        conn.call("DEL", self.key("deck", digest))
+        # если колоду успели подключить, EXEC вернёт nil и колода останется
+        conn.call("EXEC")
+
+
+def open_state_store() -> Optional[StateStore]:
+    # фронт шардов игр не держит; воркеры делят одно хранилище, их чаты не пересекаются
+    if IS_SHARD_FRONT:
+        return None
+    if STATE_BACKEND == "memory":
+        return MemoryStore()
+    if STATE_BACKEND == "redis":
+        return RedisStore(REDIS_URL, REDIS_PREFIX)
+    return GameStore(STATE_DB_PATH) if STATE_DB_PATH else None
+
+
+STATE_STORE: Optional[StateStore] = open_state_store()
+
+
+def mark_game_dirty(game: ChatGame):
+    if STATE_STORE is not None and GAMES.get(game.chat_id) is game:
+        DIRTY_GAMES.add(game.chat_id)
+
+
+def forget_game(chat_id: int):
+    journal_event(chat_id, "end")
+    GAMES.pop(chat_id, None)
+    DIRTY_GAMES.discard(chat_id)
+    if STATE_STORE is not None:
+        DELETED_GAMES.add(chat_id)
+
+
+def deal_queue_state(queue: DealQueue) -> Dict:
+    shuffle = queue.shuffle
+    return {
+        "shuffle": None if shuffle is None else {
+            "size": shuffle.size,
+            "keys": list(shuffle.keys),
+            "half_bits": shuffle.half_bits,
+            "cursor": shuffle.cursor,
+            "order": None if shuffle.order is None else shuffle.order.tolist(),
+        },
+        "items": list(queue.items),
+    }
+
+
+def deal_queue_from_state(state: Dict) -> DealQueue:
+    queue = DealQueue(items=deque(state.get("items") or ()))
+    queue.members = set(queue.items)
+    shuffle = state.get("shuffle")
+    if shuffle:
+        order = shuffle.get("order")
+        queue.shuffle = LazyShuffle(
+            size=shuffle["size"],
+            keys=tuple(shuffle["keys"]),
+            half_bits=shuffle["half_bits"],
+            cursor=shuffle["cursor"],
+            order=None if order is None else array("I", order),
+        )
+    return queue
+
+
+def serialize_game(game: ChatGame) -> Dict:
+    return {
+        "host_id": game.host_id,
+        "players": [asdict(player) for player in game.players],
+        "current_idx": game.current_idx,
+        "in_progress": game.in_progress,
+        "scores": [[user_id, score] for user_id, score in game.scores.items()],
+        "dealt_in_cycle": game.dealt_in_cycle,
+        "settings": game.settings.to_dict(),
+        "current_turn": asdict(game.current_turn) if game.current_turn else None,
+        "decks": [deck.digest for deck in game.extra_decks],
+        "deal_queues": {kind: deal_queue_state(queue) for kind, queue in game.deck_cache.items()},
+        "lobby_message_id": game.lobby_message_id,
+        "settings_message_id": game.settings_message_id,
+        "panel_message_id": game.panel_message_id,
+        "rounds_played": game.rounds_played,
+        "virtual_counter": game.virtual_counter,
+        "player_menu_message_id": game.player_menu_message_id,
+        "player_menu_state": game.player_menu_state,
+        "history": [list(entry) for entry in reversed(game.history.last(HISTORY_SIZE))] if game.history else [],
+    }
+
+
+def read_stored_deck(digest: str) -> Optional[List[Dict]]:
+    raw_cards = STATE_STORE.load_deck(digest) if STATE_STORE is not None else None
+    if raw_cards is None and JOURNAL is not None:
+        raw_cards = JOURNAL.load_deck(digest)
+    return raw_cards
+
+
+def read_stored_game(chat_id: int) -> Optional[Tuple[int, Dict, Dict[str, List[Dict]]]]:
+    """Версия, состояние и ещё не загруженные колоды игры — всё чтение хранилища сразу.
+
+    Не трогает GAMES, поэтому может идти в потоке executor.
+    """
+    loaded = STATE_STORE.load_game(chat_id)
+    if loaded is None:
+        return None
+    version, state = loaded
+    decks = {}
+    for digest in state.get("decks", []):
+        if digest not in DECK_STORE:
+            raw_cards = read_stored_deck(digest)
+            if raw_cards is not None:
+                decks[digest] = raw_cards
+    return version, state, decks
+
+
+def load_stored_deck(digest: str, raw_cards: Optional[List[Dict]] = None) -> Optional[SharedDeck]:
+    deck = DECK_STORE.get(digest)
+    if deck is None:
+        if raw_cards is None:
+            raw_cards = read_stored_deck(digest)
+        if raw_cards is None:
+            return None
+        deck = shared_deck_from_dicts(digest, raw_cards)
+    return register_shared_deck(deck)
+
+
+def restore_game(chat_id: int, state: Dict, decks: Optional[Dict[str, List[Dict]]] = None) -> ChatGame:
+    game = ChatGame(chat_id=chat_id, host_id=state["host_id"])
+    game.players = [Player(**player) for player in state.get("players", [])]
+    rebuild_player_index(game)
+    game.current_idx = state.get("current_idx", -1)
+    game.in_progress = state.get("in_progress", False)
+    game.scores = {user_id: score for user_id, score in state.get("scores", [])}
+    game.dealt_in_cycle = state.get("dealt_in_cycle", 0)
+    game.settings = GameSettings.from_dict(state.get("settings", {}))
+    turn = state.get("current_turn")
+    game.current_turn = Turn(**turn) if turn else None
+    for digest in state.get("decks", []):
+        deck = load_stored_deck(digest, decks.get(digest) if decks else None)
+        if deck is not None:
+            game.extra_decks.append(deck)
+    for kind, queue_state in state.get("deal_queues", {}).items():
+        game.deck_cache[kind] = deal_queue_from_state(queue_state)
+    game.lobby_message_id = state.get("lobby_message_id")
+    game.settings_message_id = state.get("settings_message_id")
+    game.panel_message_id = state.get("panel_message_id")
+    game.rounds_played = state.get("rounds_played", 0)
+    game.virtual_counter = state.get("virtual_counter", 0)
+    game.player_menu_message_id = state.get("player_menu_message_id")
+    game.player_menu_state = state.get("player_menu_state", "root")
+    for entry in state.get("history", []):
+        push_round(game, *entry)
+    return game
+
+
+def load_game(
+    chat_id: int, loaded: Optional[Tuple[int, Dict, Dict[str, List[Dict]]]] = None
+) -> Optional[ChatGame]:
+    """Поднять игру из базы после рестарта; таймер хода не восстанавливается.
+
+    loaded — уже прочитанный read_stored_game результат; без него хранилище
+    читается прямо из цикла событий.
+    """
+    if STATE_STORE is None or chat_id in DELETED_GAMES:
+        return None
+    try:
+        if loaded is None:
+            loaded = read_stored_game(chat_id)
+        if loaded is None:
+            return None
+        version, state, decks = loaded
+        game = restore_game(chat_id, state, decks)
+    except Exception:
+        logger.exception("Не удалось восстановить игру %s", chat_id)
+        return None
+    game.version = version
+    GAMES[chat_id] = game
+    restore_pending(chat_id, state.get("pending"))
+    game.saved_digest = state_digest(serialize_stored_game(game))
+    GAME_CACHE_STATS["rehydrations"] += 1
+    return game
+
+
+def drop_cached_game(game: ChatGame):
+    """Убрать локальную копию игры: следующее обращение прочитает её из хранилища."""
+    chat_id = game.chat_id
+    DIRTY_GAMES.discard(chat_id)
+    if GAMES.get(chat_id) is not game:
+        return
+    if game.timer_task is not None:
+        game.timer_task.cancel()
+    GAMES.pop(chat_id)
+    PENDING_BY_CHAT.pop(chat_id, None)
+    release_shared_decks(game)
+
+
+async def prepare_chat_game(chat_id: int):
+    """Подготовить игру чата до хендлера, читая хранилище в его потоке.
+
+    Игры нет в памяти — она читается и поднимается, чтобы ensure_game в хендлере
+    не ждал базу в цикле событий. С общим хранилищем локальная копия сбрасывается
+    и читается заново, если другая реплика уже записала новую версию.
+    """
+    if STATE_STORE is None or chat_id in DELETED_GAMES:
+        return
+    loop = asyncio.get_running_loop()
+    game = GAMES.get(chat_id)
+    if game is not None:
+        if not STATE_STORE.shared or chat_id in SAVING_GAMES:
+            return
+        try:
+            version = await loop.run_in_executor(STATE_STORE.executor, STATE_STORE.game_version, chat_id)
+        except Exception:
+            logger.exception("Не удалось проверить версию игры %s", chat_id)
+            return
+        # пока шло чтение, игру могли изменить и начать записывать
+        if GAMES.get(chat_id) is not game or chat_id in SAVING_GAMES or version == game.version:
+            return
+        GAME_CACHE_STATS["invalidations"] += 1
+        drop_cached_game(game)
+    try:
+        loaded = await loop.run_in_executor(STATE_STORE.executor, read_stored_game, chat_id)
+    except Exception:
+        logger.exception("Не удалось восстановить игру %s", chat_id)
+        return
+    if loaded is not None and chat_id not in GAMES:
+        load_game(chat_id, loaded)
+
+
+def touch_game(game: ChatGame):
+    """Отметить обращение: GAMES упорядочен от давно не используемых к свежим."""
+    game.last_active = time.monotonic()
+    chat_id = game.chat_id
+    if GAMES.get(chat_id) is game:
+        GAMES[chat_id] = GAMES.pop(chat_id)
+
+
+def is_game_busy(game: ChatGame) -> bool:
+    timer_running = game.timer_task is not None and not game.timer_task.done()
+    return timer_running or game.chat_id in DECK_IMPORTS_IN_PROGRESS
+
+
+def pick_games_to_evict() -> List[ChatGame]:
+    now = time.monotonic()
+    candidates: List[ChatGame] = []
+    excess = len(GAMES) - GAME_CACHE_LIMIT
+    for game in GAMES.values():
+        idle = now - game.last_active
+        if idle < GAME_EVICT_MIN_IDLE:
+            break
+        if idle < GAME_IDLE_TIMEOUT and excess <= len(candidates):
+            break
+        if not is_game_busy(game):
+            candidates.append(game)
+    return candidates
+
+
+async def evict_idle_games():
+    """Сохранить простаивающие игры и убрать их из памяти вместе с колодами."""
+    if STATE_STORE is None:
+        return
+    candidates = pick_games_to_evict()
+    if not candidates:
+        return
+    seen = {game.chat_id: game.last_active for game in candidates}
+    for game in candidates:
+        DIRTY_GAMES.add(game.chat_id)
+    await flush_game_state()
+    for game in candidates:
+        chat_id = game.chat_id
+        # пока шла запись, игру могли тронуть — тогда она остаётся в памяти
+        if (
+            GAMES.get(chat_id) is not game
+            or game.last_active != seen[chat_id]
+            or chat_id in DIRTY_GAMES
+            or is_game_busy(game)
+        ):
+            continue
+        GAMES.pop(chat_id)
+        release_shared_decks(game)
+        GAME_CACHE_STATS["evictions"] += 1
+
+
+def serialize_stored_game(game: ChatGame, *, saved_at: Optional[float] = None) -> str:
+    state = serialize_game(game)
+    state["pending"] = pending_state(game.chat_id)
+    if saved_at is not None:
+        # по нему восстановление из журнала понимает, что новее — запись или журнал
+        state["saved_at"] = saved_at
+    return json.dumps(state, ensure_ascii=False)
+
+
+def state_digest(state_json: str) -> bytes:
+    return hashlib.blake2b(state_json.encode(), digest_size=16).digest()
+
+
+async def flush_game_state():
+    if STATE_STORE is None or not (DIRTY_GAMES or DELETED_GAMES):
+        return
+    # игра, чья запись ещё не завершилась, ждёт следующего сброса: её версия пока старая
+    ready = [chat_id for chat_id in DIRTY_GAMES if chat_id not in SAVING_GAMES]
+    DIRTY_GAMES.difference_update(ready)
+    # любое обновление чата помечает игру, но пишется только то, что действительно изменилось
+    dirty: List[ChatGame] = []
+    rows = []
+    digests: Dict[int, bytes] = {}
+    for chat_id in ready:
+        game = GAMES.get(chat_id)
+        if game is None:
+            continue
+        state_json = serialize_stored_game(game)
+        digest = state_digest(state_json)
+        if digest == game.saved_digest:
+            GAME_CACHE_STATS["unchanged"] += 1
+            continue
+        dirty.append(game)
+        digests[chat_id] = digest
+        state_json = serialize_stored_game(game, saved_at=round(time.time(), 3))
+        rows.append((chat_id, game.version, state_json, tuple(game.extra_decks)))
+    deleted = list(DELETED_GAMES)
+    if not dirty and not deleted:
+        return
+    saving = [game.chat_id for game in dirty]
+    SAVING_GAMES.update(saving)
+    try:
+        written = await asyncio.get_running_loop().run_in_executor(
+            STATE_STORE.executor, STATE_STORE.write_batch, rows, deleted
+        )
+    except Exception:
+        logger.exception("Не удалось сохранить состояние игр")
+        for game in dirty:
+            mark_game_dirty(game)
+        return
+    finally:
+        SAVING_GAMES.difference_update(saving)
+    DELETED_GAMES.difference_update(deleted)
+    for game in dirty:
+        version = written.get(game.chat_id)
+        if version is not None:
+            game.version = version
+            game.saved_digest = digests[game.chat_id]
+            continue
+        # игру успела записать другая реплика: её версия побеждает
+        GAME_CACHE_STATS["conflicts"] += 1
+        logger.warning("Игра %s изменена другой репликой, локальная копия сброшена", game.chat_id)
+        drop_cached_game(game)
+
+
+async def state_flush_loop():
+    while True:
+        await asyncio.sleep(STATE_FLUSH_INTERVAL)
+        await flush_game_state()
+        await flush_leaderboards()
+        await evict_idle_games()
+
+
+@dp.update.outer_middleware()
+async def track_game_changes(handler, event, data):
+    chat = data.get("event_chat")
+    # игра читается до хендлера в потоке хранилища; с общим хранилищем она ещё
+    # сверяется с ним до хендлера и пишется сразу после
+    shared = STATE_STORE is not None and STATE_STORE.shared
+    if chat is not None:
+        await prepare_chat_game(chat.id)
+    try:
+        return await handler(event, data)
+    finally:
+        game = GAMES.get(chat.id) if chat is not None else None
+        if game is not None:
+            touch_game(game)
+            # игра не изменилась — flush_game_state сверит хэш и ничего не запишет
+            mark_game_dirty(game)
+            if shared:
+                await flush_game_state()
+
+
+# ===========================
+# РЕКОРДЫ
+# ===========================
+#
+# Очки за всё время копятся по чатам (scope = chat_id) и в общем зачёте
+# (scope = GLOBAL_SCOPE) только для настоящих игроков: виртуальные id живут
+# в пределах одной партии. Изменения суммируются в PENDING_POINTS и пишутся
+# пачкой вместе с остальным состоянием. Для показа держится топ каждого
+# scope (TopK), который обновляется на месте при каждом очке.
+
+GLOBAL_SCOPE = 0
+# без хранилища игр рекорды живут в памяти процесса
+LEADERBOARD_STORE: StateStore = STATE_STORE if STATE_STORE is not None else MemoryStore()
+
+
+@dataclass(slots=True)
+class Leaderboard:
+    top: TopK
+    names: Dict[int, str]
+    loaded_at: float
+
+
+LEADERBOARDS: Dict[int, Leaderboard] = {}
+# (scope, user_id) -> [имя, изменение]: ещё не записано и записывается сейчас
+PENDING_POINTS: Dict[Tuple[int, int], List] = {}
+FLUSHING_POINTS: Dict[Tuple[int, int], List] = {}
+
+
+def unsaved_points(scope: int, user_id: int) -> int:
+    total = 0
+    for pending in (PENDING_POINTS, FLUSHING_POINTS):
+        entry = pending.get((scope, user_id))
+        if entry is not None:
+            total += entry[1]
+    return total
+
+
+def read_leaderboard(scope: int, limit: int, user_ids: Set[int]) -> Tuple[List[Tuple[int, str, int]], Dict[int, int]]:
+    """Топ scope и очки user_ids вне его — для потока executor."""
+    rows = LEADERBOARD_STORE.top_points(scope, limit)
+    listed = {user_id for user_id, _, _ in rows}
+    stored = {
+        user_id: LEADERBOARD_STORE.user_points(scope, user_id) for user_id in user_ids if user_id not in listed
+    }
+    return rows, stored
+
+
+async def load_leaderboard(scope: int) -> Leaderboard:
+    board = LEADERBOARDS.get(scope)
+    if board is not None and time.monotonic() - board.loaded_at < LEADERBOARD_TTL:
+        return board
+    loop = asyncio.get_running_loop()
+    while True:
+        unsaved = {
+            user_id: entry
+            for pending in (FLUSHING_POINTS, PENDING_POINTS)
+            for (entry_scope, user_id), entry in pending.items()
+            if entry_scope == scope
+        }
+        # с запасом на тех, кто ещё может опуститься из-за незаписанных штрафов
+        limit = SCOREBOARD_SIZE + len(unsaved)
+        # чтение стоит в том же потоке, что и запись очков: незаписанные очки
+        # считаются после него, когда записанная пачка уже убрана из FLUSHING_POINTS
+        rows, stored = await loop.run_in_executor(
+            LEADERBOARD_STORE.executor, read_leaderboard, scope, limit, set(unsaved)
+        )
+        points = {user_id: score for user_id, _, score in rows}
+        points.update(stored)
+        fresh = {
+            user_id: entry
+            for pending in (FLUSHING_POINTS, PENDING_POINTS)
+            for (entry_scope, user_id), entry in pending.items()
+            if entry_scope == scope
+        }
+        # пока шло чтение, очки появились у новых игроков — их очков в базе мы не знаем
+        if set(fresh) <= set(points):
+            break
+    names = {user_id: name for user_id, name, _ in rows}
+    for user_id, (name, _) in fresh.items():
+        points[user_id] += unsaved_points(scope, user_id)
+        names[user_id] = name
+    top = heapq.nlargest(SCOREBOARD_SIZE, points.items(), key=lambda kv: (kv[1], -kv[0]))
+    board = Leaderboard(
+        top=TopK(SCOREBOARD_SIZE, top, complete=len(rows) < limit),
+        names={user_id: names[user_id] for user_id, _ in top},
+        loaded_at=time.monotonic(),
+    )
+    LEADERBOARDS[scope] = board
+    return board
+
+
+def record_points(game: ChatGame, user_id: int, delta: int):
+    player = get_player(game, user_id)
+    if player is None or player.is_virtual:
+        return
+    for scope in (game.chat_id, GLOBAL_SCOPE):
+        entry = PENDING_POINTS.setdefault((scope, user_id), [player.name, 0])
+        entry[0] = player.name
+        entry[1] += delta
+        board = LEADERBOARDS.get(scope)
+        if board is None:
+            continue
+        score = board.top.scores.get(user_id)
+        if score is None:
+            if delta < 0:
+                # вне топа и стал ещё ниже — топ не меняется
+                board.top.complete = False
+                continue
+            # очков игрока вне топа в памяти нет: топ перечитается в потоке хранилища при показе
+            LEADERBOARDS.pop(scope)
+            continue
+        if board.top.offer(user_id, score + delta):
+            if user_id in board.top.scores:
+                board.names[user_id] = player.name
+        else:
+            LEADERBOARDS.pop(scope)
+
+
+async def flush_leaderboards():
+    if not PENDING_POINTS or FLUSHING_POINTS:
+        return
+    FLUSHING_POINTS.update(PENDING_POINTS)
+    PENDING_POINTS.clear()
+    rows = [(scope, user_id, name, delta) for (scope, user_id), (name, delta) in FLUSHING_POINTS.items() if delta]
+    try:
+        await asyncio.get_running_loop().run_in_executor(
+            LEADERBOARD_STORE.executor, LEADERBOARD_STORE.add_points, rows
+        )
+    except Exception:
+        logger.exception("Не удалось сохранить рекорды")
+        for key, (name, delta) in FLUSHING_POINTS.items():
+            entry = PENDING_POINTS.setdefault(key, [name, 0])
+            entry[1] += delta
+    finally:
+        FLUSHING_POINTS.clear()
+    now = time.monotonic()
+    for scope in [scope for scope, board in LEADERBOARDS.items() if now - board.loaded_at >= LEADERBOARD_TTL]:
+        del LEADERBOARDS[scope]
+
+
+async def format_leaderboard(scope: int) -> str:
+    try:
+        board = await load_leaderboard(scope)
+    except Exception:
+        logger.exception("Не удалось прочитать рекорды")
+        return ""
+    lines = []
+    for position, (user_id, score) in enumerate(board.top.rows(), start=1):
+        name = board.names.get(user_id) or f"Игрок {user_id}"
+        lines.append(format_score_line(position, mention_html(user_id, name), score))
+    return "\n".join(lines)
+
+
+# ===========================
+# ЖУРНАЛ СОБЫТИЙ
+# ===========================
+#
+# Каждое изменение игры дописывается в журнал короткой JSON-строкой
+# {"t": время, "c": чат, "e": событие, ...}. Строки копятся в памяти и раз в
+# JOURNAL_FLUSH_INTERVAL секунд уходят на диск одной записью с одним fsync.
+# Сегменты journal-NNNNNNNN.log закрываются по размеру; закрытые сегменты
+# периодически сворачиваются в snapshot-NNNNNNNN.json — состояние всех игр
+# в формате serialize_game — и удаляются. Колоды импортов лежат отдельно в
+# decks/<digest>.json и пишутся один раз. Идентификаторы сообщений и порядок
+# перемешанных колод в журнал не попадают: это состояние интерфейса, а колода
+# после восстановления просто перемешивается заново.
+
+JOURNAL_SEGMENT_PATTERN = re.compile(r"journal-(\d{8})\.log")
+JOURNAL_SNAPSHOT_PATTERN = re.compile(r"snapshot-(\d{8})\.json")
+
+
+def write_file_durably(path: str, data: str):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as fh:
+        fh.write(data)
+        fh.flush()
+        os.fsync(fh.fileno())
+    os.replace(tmp_path, path)
+
+
+class GameJournal:
+    """Сегментированный журнал: запись и свёртка — каждая в своём потоке."""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.decks_dir = os.path.join(directory, "decks")
+        os.makedirs(self.decks_dir, exist_ok=True)
+        self.pending: List[str] = []
+        self.pending_decks: Dict[str, SharedDeck] = {}
+        self.saved_decks: Set[str] = {
+            name[:-5] for name in os.listdir(self.decks_dir) if name.endswith(".json")
+        }
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="journal-write")
+        self.compactor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="journal-compact")
+        self.compaction = None
+        segments = self.list_files(JOURNAL_SEGMENT_PATTERN)
+        snapshots = self.list_files(JOURNAL_SNAPSHOT_PATTERN)
+        # после рестарта пишем в новый сегмент: хвост старого мог оборваться
+        self.segment_seq = max(segments + snapshots, default=0) + 1
+        self.segment = None
+        self.segment_size = 0
+
+    def list_files(self, pattern: re.Pattern) -> List[int]:
+        seqs = []
+        for name in os.listdir(self.directory):
+            match = pattern.fullmatch(name)
+            if match:
+                seqs.append(int(match.group(1)))
+        return sorted(seqs)
+
+    def segment_path(self, seq: int) -> str:
+        return os.path.join(self.directory, f"journal-{seq:08d}.log")
+
+    def snapshot_path(self, seq: int) -> str:
+        return os.path.join(self.directory, f"snapshot-{seq:08d}.json")
+
+    def append(self, record: Dict):
+        self.pending.append(json.dumps(record, ensure_ascii=False, separators=(",", ":")))
+
+    def note_deck(self, deck: SharedDeck):
+        if deck.digest not in self.saved_decks:
+            self.pending_decks[deck.digest] = deck
+
+    def write_batch(self, lines: Sequence[str], decks: Sequence[SharedDeck]):
+        """Дописать пачку событий одним fsync (поток записи)."""
+        # колода должна лечь на диск раньше события, которое на неё ссылается
+        for deck in decks:
+            cards = json.dumps([card_to_dict(card) for card in deck.cards], ensure_ascii=False)
+            write_file_durably(os.path.join(self.decks_dir, f"{deck.digest}.json"), cards)
+        if self.segment is None:
+            self.segment = open(self.segment_path(self.segment_seq), "ab")
+            self.segment_size = self.segment.tell()
+        data = ("\n".join(lines) + "\n").encode("utf-8")
+        self.segment.write(data)
+        self.segment.flush()
+        os.fsync(self.segment.fileno())
+        self.segment_size += len(data)
+        if self.segment_size >= JOURNAL_SEGMENT_BYTES:
+            self.segment.close()
+            self.segment = None
+            self.segment_seq += 1
+
+    def load_deck(self, digest: str) -> Optional[List[Dict]]:
+        try:
+            with open(os.path.join(self.decks_dir, f"{digest}.json"), encoding="utf-8") as fh:
+                return json.load(fh)
+        except FileNotFoundError:
+            return None
+
+    def read_snapshot(self) -> Tuple[int, Dict[int, Dict]]:
+        snapshots = self.list_files(JOURNAL_SNAPSHOT_PATTERN)
+        if not snapshots:
+            return 0, {}
+        with open(self.snapshot_path(snapshots[-1]), encoding="utf-8") as fh:
+            raw = json.load(fh)
+        return snapshots[-1], {int(chat_id): state for chat_id, state in raw.items()}
+
+    def replay(
+        self,
+        states: Dict[int, Dict],
+        after: int,
+        upto: Optional[int] = None,
+        seen: Optional[Dict[int, float]] = None,
+    ) -> int:
+        """Прогнать сегменты с номерами из (after, upto] через apply_journal_event.
+
+        В seen, если передан, попадает время последнего события каждого чата.
+        """
+        last = after
+        for seq in self.list_files(JOURNAL_SEGMENT_PATTERN):
+            if seq <= after or (upto is not None and seq > upto):
+                continue
+            with open(self.segment_path(seq), encoding="utf-8") as fh:
+                for line in fh:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # оборванная при сбое последняя строка сегмента
+                        continue
+                    apply_journal_event(states, record)
+                    if seen is not None:
+                        seen[record["c"]] = record["t"]
+            last = seq
+        return last
+
+    def compact(self) -> int:
+        """Свернуть закрытые сегменты в новый снимок (поток свёртки)."""
+        snapshot_seq, states = self.read_snapshot()
+        last = self.replay(states, snapshot_seq, upto=self.segment_seq - 1)
+        if last == snapshot_seq:
+            return 0
+        payload = json.dumps({str(chat_id): state for chat_id, state in states.items()}, ensure_ascii=False)
+        write_file_durably(self.snapshot_path(last), payload)
+        folded = 0
+        for seq in self.list_files(JOURNAL_SEGMENT_PATTERN):
+            if seq <= last:
+                os.remove(self.segment_path(seq))
+                folded += 1
+        for seq in self.list_files(JOURNAL_SNAPSHOT_PATTERN):
+            if seq < last:
+                os.remove(self.snapshot_path(seq))
+        # на колоду ссылаются и события текущего сегмента, ещё не свёрнутые в снимок
+        self.replay(states, last)
+        self.drop_unused_decks({digest for state in states.values() for digest in state["decks"]})
+        return folded
+
+    def drop_unused_decks(self, referenced: Set[str]):
+        """Удалить файлы колод, на которые не ссылается ни одна живая игра.
+
+        Свежие файлы не трогаем: поток записи кладёт колоду на диск раньше
+        события import, которое на неё сошлётся.
+        """
+        cutoff = time.time() - JOURNAL_DECK_GRACE
+        for name in os.listdir(self.decks_dir):
+            digest = name[:-5]
+            if not name.endswith(".json") or digest in referenced:
+                continue
+            path = os.path.join(self.decks_dir, name)
+            try:
+                if os.path.getmtime(path) > cutoff:
+                    continue
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self.saved_decks.discard(digest)
+
+    def closed_segments(self) -> int:
+        return sum(1 for seq in self.list_files(JOURNAL_SEGMENT_PATTERN) if seq < self.segment_seq)
+
+
+JOURNAL: Optional[GameJournal] = (
+    GameJournal(JOURNAL_DIR) if JOURNAL_DIR and not IS_SHARD_FRONT else None
+)
+
+
+def journal_event(chat_id: int, kind: str, **fields):
+    if JOURNAL is None:
+        return
+    record = {"t": round(time.time(), 3), "c": chat_id, "e": kind}
+    record.update(fields)
+    JOURNAL.append(record)
+
+
+def journal_decks(game: ChatGame, decks: Sequence[SharedDeck]):
+    if JOURNAL is None or not decks:
+        return
+    for deck in decks:
+        JOURNAL.note_deck(deck)
+    journal_event(game.chat_id, "import", d=[deck.digest for deck in decks])
+
+
+def journal_settings(game: ChatGame, *, reset_deck: bool = False):
+    journal_event(game.chat_id, "settings", s=game.settings.to_dict(), r=reset_deck)
+
+
+def reset_state_deck(state: Dict):
+    state["dealt_in_cycle"] = 0
+    state["deal_queues"] = {}
+
+
+def set_state_score(state: Dict, user_id: int, score: int):
+    for pair in state["scores"]:
+        if pair[0] == user_id:
+            pair[1] = score
+            return
+    state["scores"].append([user_id, score])
+
+
+def apply_journal_event(states: Dict[int, Dict], record: Dict):
+    """Применить событие журнала к состояниям игр в формате serialize_game."""
+    chat_id = record["c"]
+    kind = record["e"]
+    if kind == "new":
+        states[chat_id] = serialize_game(ChatGame(chat_id=chat_id, host_id=record["h"]))
+        return
+    if kind == "end":
+        states.pop(chat_id, None)
+        return
+    state = states.get(chat_id)
+    if state is None:
+        return
+
+    if kind == "join":
+        state["players"].append({"user_id": record["u"], "name": record["n"], "is_virtual": record["v"]})
+        if not any(pair[0] == record["u"] for pair in state["scores"]):
+            state["scores"].append([record["u"], 0])
+        if record["v"]:
+            state["virtual_counter"] = min(state["virtual_counter"], record["u"])
+    elif kind == "drop":
+        user_id = record["u"]
+        state["players"] = [p for p in state["players"] if p["user_id"] != user_id]
+        state["scores"] = [pair for pair in state["scores"] if pair[0] != user_id]
+        turn = state["current_turn"]
+        if turn and turn["player_id"] == user_id:
+            state["current_turn"] = None
+        state["current_idx"] = record["i"]
+    elif kind == "rename":
+        for player in state["players"]:
+            if player["user_id"] == record["u"]:
+                player["name"] = record["n"]
+    elif kind == "move":
+        players = state["players"]
+        idx = next(i for i, p in enumerate(players) if p["user_id"] == record["u"])
+        new_idx = idx + record["o"]
+        players[idx], players[new_idx] = players[new_idx], players[idx]
+        state["current_idx"] = -1
+    elif kind in ("start", "stop"):
+        player_ids = {p["user_id"] for p in state["players"]}
+        state["scores"] = [pair for pair in state["scores"] if pair[0] in player_ids]
+        state["in_progress"] = kind == "start"
+        state["current_idx"] = -1
+        state["current_turn"] = None
+        state["rounds_played"] = 0
+        reset_state_deck(state)
+    elif kind == "turn":
+        state["current_idx"] = record["i"]
+        state["current_turn"] = asdict(Turn(player_id=record["u"], started_at=record.get("a", 0.0)))
+    elif kind == "deal":
+        turn = state["current_turn"]
+        if turn is not None:
+            turn["type"] = record["k"]
+            turn["card_id"] = record["card"]
+            turn["rerolled"] = record["r"]
+            turn["started_at"] = record.get("a", 0.0)
+        state["dealt_in_cycle"] = record["n"]
+    elif kind in ("done", "skip"):
+        if record.get("s") is not None:
+            set_state_score(state, record["u"], record["s"])
+        turn = state["current_turn"]
+        if turn is not None and "o" in record:
+            history = state.setdefault("history", [])
+            history.append([turn["player_id"], turn["card_id"], turn["type"], record["o"], record["d"]])
+            del history[:-HISTORY_SIZE]
+        state["rounds_played"] += 1
+        state["current_turn"] = None
+    elif kind == "settings":
+        state["settings"] = record["s"]
+        if record.get("r"):
+            reset_state_deck(state)
+    elif kind == "import":
+        state["decks"].extend(record["d"])
+        reset_state_deck(state)
+
+
+def rebuild_games_from_journal(seen: Optional[Dict[int, float]] = None) -> Dict[int, Dict]:
+    """Состояния всех игр по снимку и всем сегментам, включая текущий."""
+    if JOURNAL is None:
+        return {}
+    snapshot_seq, states = JOURNAL.read_snapshot()
+    JOURNAL.replay(states, snapshot_seq, seen=seen)
+    return states
+
+
+# Поля сохранённого состояния, которых журнал не ведёт: при восстановлении они
+# берутся из хранилища, а очередь раздачи начинается заново
+JOURNAL_UNTRACKED_FIELDS = (
+    "lobby_message_id",
+    "settings_message_id",
+    "panel_message_id",
+    "player_menu_message_id",
+    "player_menu_state",
+    "pending",
+)
+
+
+def journal_comparable(state: Dict) -> Dict:
+    """Та часть состояния игры, которую восстанавливает журнал."""
+    view = {
+        key: value
+        for key, value in state.items()
+        if key not in JOURNAL_UNTRACKED_FIELDS and key not in ("deal_queues", "saved_at")
+    }
+    view["scores"] = sorted(view.get("scores", []))
+    view.setdefault("history", [])
+    if view.get("current_turn"):
+        view["current_turn"] = dict(view["current_turn"], message_id=None)
+    return view
+
+
+def recovered_deck(digest: str) -> Optional[SharedDeck]:
+    deck = DECK_STORE.get(digest)
+    if deck is not None:
+        return deck
+    raw_cards = JOURNAL.load_deck(digest)
+    if raw_cards is None:
+        raw_cards = STATE_STORE.load_deck(digest)
+    return shared_deck_from_dicts(digest, raw_cards) if raw_cards is not None else None
+
+
+def recover_games_from_journal() -> Tuple[int, int]:
+    """Догнать хранилище по журналу после сбоя; вызывается до приёма апдейтов.
+
+    Журнал сбрасывается на диск чаще хранилища, поэтому после падения в нём
+    могут быть ходы, которые не успели записаться. Игра перезаписывается, если
+    её последнее событие в журнале новее записи и состояние расходится; игры,
+    закрытые по журналу, удаляются. Возвращает (восстановлено, удалено).
+    """
+    if JOURNAL is None or STATE_STORE is None:
+        return 0, 0
+    seen: Dict[int, float] = {}
+    states = rebuild_games_from_journal(seen)
+    rows = []
+    deleted = []
+    for chat_id in set(states) | set(seen):
+        if SHARD_INDEX is not None and shard_for_chat(chat_id, SHARD_WORKERS) != int(SHARD_INDEX):
+            continue  # чат теперь живёт в другом шарде: его журнал там
+        loaded = STATE_STORE.load_game(chat_id)
+        version, stored = loaded if loaded is not None else (0, None)
+        state = states.get(chat_id)
+        if stored is not None and stored.get("saved_at", 0) >= seen.get(chat_id, 0):
+            continue  # запись не старше журнала (или игра только в снимке)
+        if state is None:
+            if stored is not None:
+                deleted.append(chat_id)
+            continue
+        if stored is not None:
+            if journal_comparable(stored) == journal_comparable(state):
+                continue
+            for key in JOURNAL_UNTRACKED_FIELDS:
+                state[key] = stored.get(key)
+            stored_turn = stored.get("current_turn")
+            if state["current_turn"] and stored_turn and stored_turn["player_id"] == state["current_turn"]["player_id"]:
+                state["current_turn"]["message_id"] = stored_turn.get("message_id")
+        decks = [deck for deck in map(recovered_deck, state["decks"]) if deck is not None]
+        state["saved_at"] = round(time.time(), 3)
+        rows.append((chat_id, version, json.dumps(state, ensure_ascii=False), decks))
+    if rows or deleted:
+        STATE_STORE.write_batch(rows, deleted)
+    return len(rows), len(deleted)
+
+
+async def flush_journal():
+    if JOURNAL is None or not JOURNAL.pending:
+        return
+    lines, JOURNAL.pending = JOURNAL.pending, []
+    decks = list(JOURNAL.pending_decks.values())
+    JOURNAL.pending_decks.clear()
+    try:
+        await asyncio.get_running_loop().run_in_executor(
+            JOURNAL.executor, JOURNAL.write_batch, lines, decks
+        )
+    except Exception:
+        logger.exception("Не удалось записать журнал событий")
+        JOURNAL.pending[:0] = lines
+        for deck in decks:
+            JOURNAL.pending_decks.setdefault(deck.digest, deck)
+        return
+    JOURNAL.saved_decks.update(deck.digest for deck in decks)
+
+
+def maybe_compact_journal():
+    if JOURNAL is None:
+        return
+    compaction = JOURNAL.compaction
+    if compaction is not None:
+        if not compaction.done():
+            return
+        JOURNAL.compaction = None
+        if compaction.exception() is not None:
+            logger.error("Не удалось свернуть журнал событий", exc_info=compaction.exception())
+    if JOURNAL.closed_segments() >= JOURNAL_COMPACT_SEGMENTS:
+        JOURNAL.compaction = JOURNAL.compactor.submit(JOURNAL.compact)
+
+
+async def journal_flush_loop():
+    while True:
+        await asyncio.sleep(JOURNAL_FLUSH_INTERVAL)
+        await flush_journal()
+        maybe_compact_journal()
+
+
 def ensure_game(chat_id: int) -> Optional[ChatGame]:
-    return GAMES.get(chat_id)
+    game = GAMES.get(chat_id)
+    if game is None:
+        game = load_game(chat_id)
+    if game is not None:
+        touch_game(game)
+    return game
+
+
+@dataclass(slots=True)
+class PanelRenderer:
+    """Отложенная отрисовка панели одного чата: помнит только последнее желаемое состояние."""
+
+    game: ChatGame
+    text: str = ""
+    reply_markup: Optional[InlineKeyboardMarkup] = None
+    transient: bool = False
+    dirty: bool = False
+    # ждут доставки этого или более нового состояния
+    waiters: List[asyncio.Future] = field(default_factory=list)
+    last_edit: float = 0.0
+    task: Optional[asyncio.Task] = None
+    # растёт при каждом discard_panel_render: доставка, начатая раньше, не шлёт новую панель
+    generation: int = 0
+
+
+# Рендереры живут, пока есть что отправить или не истёк интервал после последней правки
+PANEL_RENDERERS: Dict[int, PanelRenderer] = {}
+PANEL_RENDER_STATS = {"requested": 0, "delivered": 0, "superseded": 0}
 
 
 async def update_panel_message(
@@ -1717,25 +5108,117 @@ async def update_panel_message(
     text: str,
     *,
     reply_markup: Optional[InlineKeyboardMarkup] = None,
+    transient: bool = False,
+) -> Optional[int]:
+    """Поставить панель на отрисовку не чаще раза в PANEL_EDIT_INTERVAL.
+
+    Возвращает id панели после доставки этого состояния или того, что его сменило;
+    None — состояние отброшено или не доставлено из-за ошибки.
+    transient — кадр, который можно потерять (спиннер): доставки не ждём.
+    """
+    renderer = PANEL_RENDERERS.get(game.chat_id)
+    if renderer is None:
+        renderer = PANEL_RENDERERS[game.chat_id] = PanelRenderer(game)
+    PANEL_RENDER_STATS["requested"] += 1
+    if renderer.dirty:
+        PANEL_RENDER_STATS["superseded"] += 1
+    renderer.game = game
+    renderer.text = text
+    renderer.reply_markup = reply_markup
+    renderer.transient = transient
+    renderer.dirty = True
+    if renderer.task is None:
+        renderer.task = asyncio.create_task(run_panel_renderer(renderer))
+    if transient:
+        return game.panel_message_id
+    waiter = asyncio.get_running_loop().create_future()
+    renderer.waiters.append(waiter)
+    return await waiter
+
+
+def discard_panel_render(chat_id: int):
+    """Забыть недоставленное состояние панели — например, перед её удалением."""
+    renderer = PANEL_RENDERERS.get(chat_id)
+    if renderer is None:
+        return
+    renderer.generation += 1
+    if not renderer.dirty:
+        return
+    renderer.dirty = False
+    waiters, renderer.waiters = renderer.waiters, []
+    for waiter in waiters:
+        if not waiter.done():
+            waiter.set_result(None)
+
+
+async def run_panel_renderer(renderer: PanelRenderer):
+    chat_id = renderer.game.chat_id
+    try:
+        while True:
+            delay = renderer.last_edit + PANEL_EDIT_INTERVAL - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+            if not renderer.dirty:
+                break
+            game, waiters = renderer.game, renderer.waiters
+            renderer.dirty = False
+            renderer.waiters = []
+            try:
+                with outbound_priority(PRIORITY_BACKGROUND if renderer.transient else PRIORITY_GAME):
+                    message_id = await deliver_panel_message(
+                        game, renderer.text, renderer.reply_markup, renderer=renderer
+                    )
+            except Exception:
+                # ошибка не доходит до ждущих: ход игры и ответ на кнопку важнее панели
+                EDIT_STATS["abandoned"] += 1
+                logger.exception("Не удалось обновить панель в чате %s", chat_id)
+                for waiter in waiters:
+                    if not waiter.done():
+                        waiter.set_result(None)
+            else:
+                PANEL_RENDER_STATS["delivered"] += 1
+                for waiter in waiters:
+                    if not waiter.done():
+                        waiter.set_result(message_id)
+            renderer.last_edit = time.monotonic()
+    finally:
+        if PANEL_RENDERERS.get(chat_id) is renderer:
+            del PANEL_RENDERERS[chat_id]
+        for waiter in renderer.waiters:
+            waiter.cancel()
+
+
+async def deliver_panel_message(
+    game: ChatGame,
+    text: str,
+    reply_markup: Optional[InlineKeyboardMarkup],
+    *,
+    renderer: Optional[PanelRenderer] = None,
 ) -> Optional[int]:
     message_id = game.panel_message_id
-    if message_id:
-        try:
-            await bot.edit_message_text(
-                text,
-                chat_id=game.chat_id,
-                message_id=message_id,
-                reply_markup=reply_markup,
-            )
-            return message_id
-        except TelegramBadRequest as exc:
-            if is_message_not_modified(exc):
-                return message_id
-        except Exception:
-            pass
+    generation = renderer.generation if renderer else 0
+    key = render_key(text, reply_markup)
+    if already_rendered(game, "panel", message_id, key):
+        return message_id
+    if message_id and await edit_with_retry(
+        lambda: bot.edit_message_text(
+            text,
+            chat_id=game.chat_id,
+            message_id=message_id,
+            reply_markup=reply_markup,
+        )
+    ):
+        remember_render(game, "panel", message_id, key)
+        return message_id
+    # панель удалили, пока шла правка (игра закончилась) — новую не присылаем
+    if renderer and renderer.generation != generation:
+        return None
 
     sent = await bot.send_message(game.chat_id, text, reply_markup=reply_markup)
     game.panel_message_id = sent.message_id
+    remember_render(game, "panel", sent.message_id, key)
+    mark_game_dirty(game)
     return sent.message_id
 
 async def cancel_timer(game: ChatGame):
@@ -1757,6 +5240,7 @@ async def start_timer(game: ChatGame, seconds: int, on_expire):
             await on_expire()
         except asyncio.CancelledError:
             return
+        mark_game_dirty(game)
     game.timer_task = asyncio.create_task(_job())
 
 def next_index(game: ChatGame) -> int:
@@ -1768,7 +5252,7 @@ def next_index(game: ChatGame) -> int:
 
 
 async def start_new_game_session(chat_id: int, host_id: int, host_name: str):
-    existing = GAMES.get(chat_id)
+    existing = ensure_game(chat_id)
     if existing:
         await end_game_session(
             existing,
@@ -1780,6 +5264,7 @@ async def start_new_game_session(chat_id: int, host_id: int, host_name: str):
     clear_pending_additions(chat_id)
     clear_pending_renames(chat_id)
     game = ChatGame(chat_id=chat_id, host_id=host_id)
+    journal_event(chat_id, "new", h=host_id)
     register_player(game, host_id, host_name)
     GAMES[chat_id] = game
 
@@ -1793,10 +5278,24 @@ async def start_new_game_session(chat_id: int, host_id: int, host_name: str):
 
 async def send_scoreboard(chat_id: int):
     game = ensure_game(chat_id)
-    if not game or not game.scores:
+    parts = []
+    if game and game.scores:
+        parts.append("📊 <b>Текущий счёт</b>:\n" + format_scores(game))
+    records = await format_leaderboard(chat_id)
+    if records:
+        parts.append("🏅 <b>Рекорды чата</b>:\n" + records)
+    if not parts:
         await bot.send_message(chat_id, "Пока нет очков.")
         return
-    await bot.send_message(chat_id, "📊 <b>Текущий счёт</b>:\n" + format_scores(game))
+    await bot.send_message(chat_id, "\n\n".join(parts))
+
+
+async def send_global_leaderboard(chat_id: int):
+    records = await format_leaderboard(GLOBAL_SCOPE)
+    if not records:
+        await bot.send_message(chat_id, "Пока нет очков.")
+        return
+    await bot.send_message(chat_id, "🌍 <b>Общий зачёт</b>:\n" + records)
 
 
 async def open_settings_interface(
@@ -1857,7 +5356,7 @@ async def finish_game_by_host(
             return
         await callback.answer()
     else:
-        END_CONFIRMATIONS.pop((chat_id, user_id), None)
+        clear_end_confirmation(chat_id, user_id)
     await end_game_session(game, "🏁 Игра завершена. Спасибо за игру!")
 
 
@@ -1870,7 +5369,7 @@ async def send_help_text(chat_id: int):
         "Когда готовы — ведущий жмёт «Старт». Каждый ход игрок выбирает <b>Правда</b> или <b>Действие</b>.\n"
         "После выполнения ведущий отмечает результат кнопками «Выполнено» или «Пропуск».\n\n"
         "Таймер (0, 20, 30, 45 или 60 секунд), возраст и активные категории (можно несколько) можно менять через меню настроек на том же устройстве.\n"
-        "Команда /score показывает счёт, /end завершает игру с итогами.",
+        "Команда /score показывает счёт и рекорды чата, /top — общий зачёт, /history [N] — последние раунды, /end завершает игру с итогами.",
     )
 
 # ===========================
@@ -1891,6 +5390,24 @@ async def cmd_score(m: Message):
     await send_scoreboard(m.chat.id)
 
 
+@dp.message(Command("top"))
+async def cmd_top(m: Message):
+    await send_global_leaderboard(m.chat.id)
+
+
+@dp.message(Command("history"))
+async def cmd_history(m: Message):
+    game = ensure_game(m.chat.id)
+    if not game:
+        await m.answer("Игра не найдена. Сначала /newgame")
+        return
+    parts = (m.text or "").split(maxsplit=1)
+    limit = HISTORY_DEFAULT_LIMIT
+    if len(parts) > 1 and parts[1].strip().isdigit():
+        limit = min(max(int(parts[1]), 1), HISTORY_SIZE)
+    await m.answer(format_history(game, limit))
+
+
 @dp.message(Command("settings"))
 async def cmd_settings(m: Message):
     await open_settings_interface(m.chat.id, m.from_user.id)
@@ -1930,6 +5447,92 @@ async def on_main_menu_button(call: CallbackQuery):
         await call.answer()
 
 
+async def import_deck_document(m: Message, game: ChatGame, document: Document):
+    """Потоковый импорт колоды из файла: читаем кусками, коммитим пачками."""
+    file_name = (document.file_name or "").lower()
+    if not file_name.endswith(DECK_FILE_EXTENSIONS):
+        await m.answer("❌ Поддерживаются файлы .json и .ndjson.")
+        return
+    if document.file_size and document.file_size > DECK_MAX_FILE_BYTES:
+        await m.answer("❌ Файл слишком большой: лимит Telegram для ботов — 20 МБ.")
+        return
+
+    if game.chat_id in DECK_IMPORTS_IN_PROGRESS:
+        await m.answer(message("DECK_IMPORT_BUSY"))
+        return
+    DECK_IMPORTS_IN_PROGRESS.add(game.chat_id)
+    try:
+        await stream_deck_document(m, game, document, file_name)
+    finally:
+        DECK_IMPORTS_IN_PROGRESS.discard(game.chat_id)
+
+
+async def stream_deck_document(m: Message, game: ChatGame, document: Document, file_name: str):
+    progress = await m.answer("⏳ Загружаем колоду...")
+    parser = DeckStreamParser(ndjson=not file_name.endswith(".json"))
+    # пока идёт импорт, другие импорты в чат (файлом или текстом) отклоняются,
+    # так что снимок колод актуален
+    existing = tuple(game.extra_decks)
+    batch_ids: Set[str] = set()
+    prepared: List[SharedDeck] = []
+    pending: List[object] = []
+    added = 0
+    skipped = 0
+    received = 0
+    last_report = time.monotonic()
+
+    async def prepare(items: List[object]):
+        nonlocal added, skipped
+        deck, batch_added, batch_skipped = await prepare_deck_batch_async(existing, items, batch_ids)
+        if deck is not None:
+            prepared.append(deck)
+        added += batch_added
+        skipped += batch_skipped
+
+    error: Optional[str] = None
+    try:
+        file = await bot.get_file(document.file_id)
+        url = bot.session.api.file_url(BOT_TOKEN, file.file_path)
+        async for chunk in bot.session.stream_content(url=url, chunk_size=DECK_IMPORT_CHUNK):
+            received += len(chunk)
+            if received > DECK_MAX_FILE_BYTES:
+                raise DeckFormatError("файл больше 20 МБ")
+            pending.extend(await run_deck_job(parser.feed, chunk))
+            while len(pending) >= DECK_IMPORT_BATCH:
+                await prepare(pending[:DECK_IMPORT_BATCH])
+                pending = pending[DECK_IMPORT_BATCH:]
+            if time.monotonic() - last_report >= DECK_PROGRESS_INTERVAL:
+                last_report = time.monotonic()
+                try:
+                    await progress.edit_text(
+                        f"⏳ Импорт колоды: проверено <b>{added}</b>, пропущено <b>{skipped}</b>..."
+                    )
+                except TelegramBadRequest:
+                    pass
+        pending.extend(await run_deck_job(parser.feed, b"", final=True))
+        if pending:
+            await prepare(pending)
+    except DeckFormatError as exc:
+        error = f"❌ Ошибка в файле колоды: {exc}"
+    except Exception as exc:
+        error = f"❌ Не удалось загрузить файл: {exc}"
+
+    if GAMES.get(game.chat_id) is not game:
+        error = error or "❌ Игра закрыта во время импорта, колода не добавлена."
+        prepared.clear()
+        added = 0
+    commit_prepared_decks(game, prepared)
+    summary = f"✅ Импортировано карточек: <b>{added}</b>"
+    if skipped:
+        summary += f"\n⚠️ Пропущено: <b>{skipped}</b> (дубли или ошибки формата)"
+    if error:
+        summary = f"{error}\n{summary}"
+    try:
+        await progress.edit_text(summary)
+    except TelegramBadRequest:
+        await m.answer(summary)
+
+
 @dp.message(Command("import_deck"))
 async def cmd_import_deck(m: Message):
     chat_id = m.chat.id
@@ -1940,11 +5543,20 @@ async def cmd_import_deck(m: Message):
     if not is_host(game, m.from_user.id):
         await m.answer("Импортировать колоду может только создатель игры.")
         return
+    # Файл колоды: команда в подписи к документу или ответом на сообщение с ним
+    document = m.document or (m.reply_to_message.document if m.reply_to_message else None)
+    if document:
+        await import_deck_document(m, game, document)
+        return
+    # файл ещё загружается: он проверяет дубли по снимку колод, взятому до этой команды
+    if chat_id in DECK_IMPORTS_IN_PROGRESS:
+        await m.answer(message("DECK_IMPORT_BUSY"))
+        return
     # Ожидаем JSON прямо в тексте сообщения после команды
     # Пример: /import_deck { "meta":..., "items":[...] }
-    args_text = m.text.partition(" ")[2].strip()
+    args_text = (m.text or "").partition(" ")[2].strip()
     if not args_text:
-        await m.answer("Пришли JSON после команды. Пример:\n"
+        await m.answer("Пришли JSON после команды или файл .json/.ndjson с подписью /import_deck. Пример:\n"
                        "/import_deck {\"meta\":{\"lang\":\"ru\",\"version\":1},\"items\":[{...}]}")
         return
     try:
@@ -1954,54 +5566,8 @@ async def cmd_import_deck(m: Message):
             await m.answer("❌ Неверный формат: поле items должно быть списком.")
             return
 
-        existing_ids = {card.get("id") for card in DEFAULT_DECK + game.extra_deck}
-        added = 0
-        skipped = 0
-        batch_ids: Set[str] = set()
-
-        for raw in items:
-            if not isinstance(raw, dict):
-                skipped += 1
-                continue
-            if not all(key in raw for key in ("id", "type", "category", "age", "text")):
-                skipped += 1
-                continue
-
-            card_id = str(raw["id"]).strip()
-            card_type = str(raw["type"]).strip()
-            category = raw["category"]
-            age = raw["age"]
-            text = str(raw["text"]).strip()
-
-            if (
-                not card_id
-                or card_type not in {"truth", "dare"}
-                or category not in CATEGORY_INFO
-                or age not in AGE_LEVELS
-                or not text
-                or card_id in existing_ids
-                or card_id in batch_ids
-            ):
-                skipped += 1
-                continue
-
-            tags = raw.get("tags")
-            card = {
-                "id": card_id,
-                "type": card_type,
-                "category": category,
-                "age": age,
-                "tags": tags if isinstance(tags, list) else [],
-                "text": text,
-            }
-            apply_safety_note([card])
-            game.extra_deck.append(card)
-            existing_ids.add(card_id)
-            batch_ids.add(card_id)
-            added += 1
-
-        if added:
-            reset_deck_cache(game, clear_used=True)
+        deck, added, skipped = prepare_deck_batch(tuple(game.extra_decks), items, set())
+        commit_prepared_decks(game, [deck] if deck else [])
         summary = f"✅ Импортировано карточек: <b>{added}</b>"
         if skipped:
             summary += f"\n⚠️ Пропущено: <b>{skipped}</b> (дубли или ошибки формата)"
@@ -2012,16 +5578,16 @@ async def cmd_import_deck(m: Message):
 
 @dp.message(F.text)
 async def handle_pending_player_name(m: Message):
-    key = (m.chat.id, m.from_user.id)
+    chat_id, user_id = m.chat.id, m.from_user.id
     text = (m.text or "").strip()
     if not text:
         return
 
     lowered = text.lower()
-    rename_pending = PENDING_PLAYER_RENAMES.get(key)
+    rename_pending = get_pending_rename(chat_id, user_id)
     if rename_pending:
         if lowered in {"отмена", "/cancel"}:
-            PENDING_PLAYER_RENAMES.pop(key, None)
+            pop_pending_rename(chat_id, user_id)
             await m.answer(message("RENAME_CANCELLED"))
             game = ensure_game(m.chat.id)
             if game and game.player_menu_message_id:
@@ -2034,34 +5600,34 @@ async def handle_pending_player_name(m: Message):
 
         game = ensure_game(m.chat.id)
         if not game:
-            PENDING_PLAYER_RENAMES.pop(key, None)
+            pop_pending_rename(chat_id, user_id)
             await m.answer(message("GAME_NOT_FOUND"))
             return
 
         player = get_player(game, rename_pending.player_id)
         if not player:
-            PENDING_PLAYER_RENAMES.pop(key, None)
+            pop_pending_rename(chat_id, user_id)
             await m.answer(message("PLAYER_NOT_FOUND"))
             if game.player_menu_message_id:
                 await show_player_menu(game, menu="rename")
             return
 
         new_name = prepare_player_name(game, text, exclude_id=player.user_id)
-        player.name = new_name
-        PENDING_PLAYER_RENAMES.pop(key, None)
+        rename_player(game, player, new_name)
+        pop_pending_rename(chat_id, user_id)
         await m.answer(message("RENAME_DONE", name=html.escape(new_name)))
         await refresh_lobby(game)
         if game.player_menu_message_id:
             await show_player_menu(game, menu="rename")
         return
 
-    pending = PENDING_PLAYER_ADDITIONS.get(key)
+    pending = get_pending_addition(chat_id, user_id)
     if not pending:
         return
 
     if lowered in {"отмена", "/cancel"}:
-        prompt_id = getattr(pending, "message_id", None)
-        PENDING_PLAYER_ADDITIONS.pop(key, None)
+        prompt_id = pending.message_id
+        pop_pending_addition(chat_id, user_id)
         await m.answer(message("NAME_CANCELLED"))
         await safe_delete_message(m.chat.id, prompt_id)
         game = ensure_game(m.chat.id)
@@ -2075,23 +5641,23 @@ async def handle_pending_player_name(m: Message):
 
     game = ensure_game(m.chat.id)
     if not game:
-        prompt_id = getattr(pending, "message_id", None)
-        PENDING_PLAYER_ADDITIONS.pop(key, None)
+        prompt_id = pending.message_id
+        pop_pending_addition(chat_id, user_id)
         await m.answer(message("GAME_NOT_FOUND"))
         await safe_delete_message(m.chat.id, prompt_id)
         return
 
     if game.in_progress:
-        prompt_id = getattr(pending, "message_id", None)
-        PENDING_PLAYER_ADDITIONS.pop(key, None)
+        prompt_id = pending.message_id
+        pop_pending_addition(chat_id, user_id)
         await m.answer(message("ADD_LOBBY_ONLY"))
         await safe_delete_message(m.chat.id, prompt_id)
         return
 
     new_id = allocate_virtual_id(game)
     player = register_player(game, new_id, text, is_virtual=True)
-    prompt_id = getattr(pending, "message_id", None)
-    PENDING_PLAYER_ADDITIONS.pop(key, None)
+    prompt_id = pending.message_id
+    pop_pending_addition(chat_id, user_id)
 
     if not player:
         await m.answer(message("NAME_ADD_FAILED"))
@@ -2120,15 +5686,14 @@ async def cb_add_player(c: CallbackQuery):
         await c.answer(message("ADD_LOBBY_ONLY"), show_alert=True)
         return
 
-    key = (chat_id, c.from_user.id)
-    pending = PENDING_PLAYER_ADDITIONS.get(key)
+    pending = get_pending_addition(chat_id, c.from_user.id)
     if pending:
         await c.message.answer(message("NAME_PENDING"))
         await c.answer()
         return
 
     pending_entry = PendingPlayerAddition(chat_id=chat_id, host_id=c.from_user.id)
-    PENDING_PLAYER_ADDITIONS[key] = pending_entry
+    put_pending_addition(pending_entry)
     await refresh_lobby(game)
     cancel_markup = InlineKeyboardMarkup(
         inline_keyboard=[[InlineKeyboardButton(text="🚫 Отменить ввод", callback_data="cancel_add")]]
@@ -2144,20 +5709,19 @@ async def cb_add_player(c: CallbackQuery):
 @dp.callback_query(F.data == "cancel_add")
 async def cb_cancel_add(c: CallbackQuery):
     chat_id = c.message.chat.id
-    entry = get_pending_addition(chat_id)
+    pending = get_pending_addition(chat_id)
     game = ensure_game(chat_id)
 
-    if not entry:
+    if not pending:
         await c.answer(message("CANCEL_NOT_EXPECTED"), show_alert=True)
         return
 
-    key, pending = entry
     if pending.host_id != c.from_user.id:
         await c.answer(message("CANCEL_HOST_ONLY"), show_alert=True)
         return
 
-    PENDING_PLAYER_ADDITIONS.pop(key, None)
-    await safe_delete_message(chat_id, getattr(pending, "message_id", None))
+    pop_pending_addition(chat_id, pending.host_id)
+    await safe_delete_message(chat_id, pending.message_id)
     await c.answer(message("INPUT_CANCELLED"))
     if game:
         await refresh_lobby(game)
@@ -2219,14 +5783,15 @@ async def cb_player_menu(c: CallbackQuery):
             if game.player_menu_message_id:
                 await show_player_menu(game, menu="rename")
             return
-        key = (chat_id, c.from_user.id)
-        PENDING_PLAYER_RENAMES[key] = PendingPlayerRename(
+        rename_entry = PendingPlayerRename(
             chat_id=chat_id, host_id=c.from_user.id, player_id=player_id
         )
+        put_pending_rename(rename_entry)
         await c.answer()
-        await c.message.answer(
+        prompt = await c.message.answer(
             message("RENAME_PROMPT", name=html.escape(player.name))
         )
+        rename_entry.message_id = prompt.message_id
         return
 
     if action == "move" and len(parts) > 3:
@@ -2238,7 +5803,8 @@ async def cb_player_menu(c: CallbackQuery):
             return
 
         players = game.players
-        target_index = next((i for i, p in enumerate(players) if p.user_id == player_id), None)
+        target = get_player(game, player_id)
+        target_index = players.index(target) if target else None
         if target_index is None:
             await c.answer(message("PLAYER_NOT_FOUND"), show_alert=True)
             return
@@ -2274,10 +5840,9 @@ async def cb_player_menu(c: CallbackQuery):
             return
         removed, removed_current = drop_player(game, player_id)
         if removed:
-            rename_key = (chat_id, c.from_user.id)
-            info = PENDING_PLAYER_RENAMES.get(rename_key)
+            info = get_pending_rename(chat_id, c.from_user.id)
             if info and info.player_id == player_id:
-                PENDING_PLAYER_RENAMES.pop(rename_key, None)
+                pop_pending_rename(chat_id, c.from_user.id)
             await refresh_lobby(game, force_new=True)
             if game.player_menu_message_id:
                 await show_player_menu(game, menu="delete")
@@ -2318,6 +5883,7 @@ async def cb_start(c: CallbackQuery):
     reset_deck_cache(game, clear_used=True)
     game.rounds_played = 0
     cleanup_scores(game)
+    journal_event(chat_id, "start")
     await close_settings_menu(game)
     await close_player_menu(game)
 
@@ -2357,14 +5923,17 @@ async def next_turn(game: ChatGame):
         return
 
     names = [p.name for p in game.players]
-    await update_panel_message(game, "🎯 Выбираем следующего игрока...")
+    # кадры спиннера не ждут доставки: при частых правках до Telegram дойдут лишь некоторые
+    await update_panel_message(game, "🎯 Выбираем следующего игрока...", transient=True)
     for _ in range(SPINNER_STEPS):
         nm = html.escape(random.choice(names))
         await asyncio.sleep(SPINNER_DELAY)
-        await update_panel_message(game, f"🎯 Выбираем... <b>{nm}</b>")
+        await update_panel_message(game, f"🎯 Выбираем... <b>{nm}</b>", transient=True)
+    if not game.in_progress:
+        return
 
-    categories_text = describe_categories(get_selected_categories(game))
-    timer_text = describe_timer(game.settings.get("timer", 0))
+    categories_text = describe_categories(game.settings.categories)
+    timer_text = describe_timer(game.settings.timer)
     players_count = len(game.players)
     prompt = (
         f"👉 Ход игрока: <b>{html.escape(pl.name)}</b> ({players_count} игроков)\n"
@@ -2373,7 +5942,8 @@ async def next_turn(game: ChatGame):
     )
     keyboard = turn_choice_keyboard(game, show_end=True)
     await update_panel_message(game, prompt, reply_markup=keyboard)
-    game.current_turn = Turn(player_id=pl.user_id, message_id=game.panel_message_id)
+    game.current_turn = Turn(player_id=pl.user_id, message_id=game.panel_message_id, started_at=time.time())
+    journal_event(game.chat_id, "turn", u=pl.user_id, i=game.current_idx, a=game.current_turn.started_at)
 
 @dp.callback_query(F.data.in_({"truth","dare"}))
 async def cb_pick_type(c: CallbackQuery):
@@ -2396,16 +5966,19 @@ async def cb_pick_type(c: CallbackQuery):
     if restarted:
         await bot.send_message(chat_id, "📦 Колода исчерпана — перемешиваем и продолжаем!")
 
-    game.used_ids.add(card["id"])
     turn.type = kind
-    turn.card_id = card["id"]
+    turn.card_id = card.id
+    turn.started_at = time.time()
+    journal_event(
+        chat_id, "deal", k=kind, card=card.id, r=turn.rerolled, n=game.dealt_in_cycle, a=turn.started_at
+    )
 
     # Показ задания
     await update_panel_message(
         game,
         f"👉 <b>Ход:</b> {get_player_display(game, turn.player_id)}\n"
         f"{'🟦 Правда' if kind=='truth' else '🟥 Действие'}:\n"
-        f"{card['text']}",
+        f"{card.text}",
         reply_markup=task_keyboard(game, for_host=True, allow_reroll=not turn.rerolled),
     )
     turn.message_id = game.panel_message_id
@@ -2413,8 +5986,8 @@ async def cb_pick_type(c: CallbackQuery):
     # Запускаем таймер на выполнение
     async def on_expire():
         # если к этому моменту голосование/завершение не произошло — автопропуск
-        await handle_skip(chat_id, reason="⏱️ Время вышло — пропуск.")
-    await start_timer(game, game.settings["timer"], on_expire)
+        await handle_skip(chat_id, reason="⏱️ Время вышло — пропуск.", timed_out=True)
+    await start_timer(game, game.settings.timer, on_expire)
     await c.answer()
 
 
@@ -2439,10 +6012,8 @@ async def cb_reroll(c: CallbackQuery):
 
     previous_card_id = turn.card_id
     if previous_card_id:
-        queue = game.deck_cache.setdefault(turn.type, [])
-        if previous_card_id not in queue:
-            queue.insert(0, previous_card_id)
-        game.used_ids.discard(previous_card_id)
+        get_deal_queue(game, turn.type).push_bottom(previous_card_id)
+        game.dealt_in_cycle = max(0, game.dealt_in_cycle - 1)
 
     card, restarted = pick_card(
         game,
@@ -2456,24 +6027,27 @@ async def cb_reroll(c: CallbackQuery):
     if restarted:
         await bot.send_message(chat_id, "📦 Колода исчерпана — перемешиваем и продолжаем!")
 
-    turn.card_id = card["id"]
+    turn.card_id = card.id
     turn.rerolled = True
-    game.used_ids.add(card["id"])
+    turn.started_at = time.time()
+    journal_event(
+        chat_id, "deal", k=turn.type, card=card.id, r=True, n=game.dealt_in_cycle, a=turn.started_at
+    )
 
     await cancel_timer(game)
     await update_panel_message(
         game,
         f"👉 <b>Ход:</b> {get_player_display(game, turn.player_id)}\n"
         f"{'🟦 Правда' if turn.type=='truth' else '🟥 Действие'}:\n"
-        f"{card['text']}",
+        f"{card.text}",
         reply_markup=task_keyboard(game, for_host=True, allow_reroll=False),
     )
 
     async def on_expire():
-        await handle_skip(chat_id, reason="⏱️ Время вышло — пропуск.")
+        await handle_skip(chat_id, reason="⏱️ Время вышло — пропуск.", timed_out=True)
 
-    await start_timer(game, game.settings["timer"], on_expire)
-    if previous_card_id and card["id"] == previous_card_id:
+    await start_timer(game, game.settings.timer, on_expire)
+    if previous_card_id and card.id == previous_card_id:
         await c.answer(message("CARD_REROLL_NO_OPTIONS"))
     else:
         await c.answer(message("CARD_REROLL_OK"))
@@ -2483,16 +6057,25 @@ async def cb_skip(c: CallbackQuery):
     await c.answer()
     await handle_skip(c.message.chat.id, reason="🔁 Пропуск.")
 
-async def handle_skip(chat_id: int, reason: str):
+async def handle_skip(chat_id: int, reason: str, *, timed_out: bool = False):
     game = ensure_game(chat_id)
     if not game: return
     await cancel_timer(game)
     # штраф при настройке
     penalty_note = ""
-    if game.settings["skip_penalty"] == -1 and game.settings["points"] and game.current_turn:
-        uid = game.current_turn.player_id
-        game.scores[uid] = game.scores.get(uid, 0) - 1
+    uid = game.current_turn.player_id if game.current_turn else None
+    score = None
+    if game.settings.skip_penalty == -1 and game.settings.points and uid is not None:
+        score = game.scores.get(uid, 0) - 1
+        set_score(game, uid, score)
+        record_points(game, uid, -1)
         penalty_note = " (−1 очко)"
+    if game.current_turn:
+        outcome = "timeout" if timed_out else "skip"
+        tenths = record_round(game, game.current_turn, outcome)
+        journal_event(chat_id, "skip", u=uid, s=score, o=outcome, d=tenths)
+    else:
+        journal_event(chat_id, "skip", u=uid, s=score)
     game.rounds_played += 1
     game.current_turn = None
     note = f"{reason}{penalty_note}\n\n▶️ Подбираем следующего игрока..."
@@ -2517,12 +6100,16 @@ async def finalize_task(chat_id: int, success: bool, by: str):
     turn = game.current_turn
 
     # Очки
-    if game.settings["points"] and turn.player_id:
-        game.scores.setdefault(turn.player_id, 0)
+    if game.settings.points and turn.player_id:
+        set_score(game, turn.player_id, game.scores.get(turn.player_id, 0) + int(success))
         if success:
-            game.scores[turn.player_id] += 1
+            record_points(game, turn.player_id, 1)
+    score = game.scores.get(turn.player_id) if game.settings.points else None
+    outcome = "done" if success else "fail"
+    tenths = record_round(game, turn, outcome)
+    journal_event(chat_id, "done", u=turn.player_id, ok=success, s=score, o=outcome, d=tenths)
 
-    if not game.settings["points"]:
+    if not game.settings.points:
         points_text = "Очки отключены."
     else:
         points_text = "Очко начислено!" if success else "Очки без изменений."
@@ -2594,30 +6181,35 @@ async def cb_settings_router(c: CallbackQuery):
             if val not in TIMER_OPTIONS:
                 await c.answer("Такой таймер недоступен", show_alert=True)
                 return
-            game.settings["timer"] = val
+            game.settings.timer = val
+            journal_settings(game)
             await c.answer("Таймер обновлён")
             await show_settings_menu(game, menu="timer", message=c.message)
             return
         if target == "age" and value in AGE_LEVELS:
-            game.settings["age_level"] = value
+            game.settings.age_level = value
             reset_deck_cache(game, clear_used=True)
+            journal_settings(game, reset_deck=True)
+            sync_deck_index(game)
             await c.answer("Возрастной уровень изменён")
             await show_settings_menu(game, menu="age", message=c.message)
             return
     if action == "toggle" and len(parts) >= 3:
         toggle_target = parts[2]
         if toggle_target == "points":
-            game.settings["points"] = not game.settings.get("points", True)
+            game.settings.points = not game.settings.points
+            journal_settings(game)
             await c.answer("Настройка очков изменена")
         elif toggle_target == "penalty":
-            game.settings["skip_penalty"] = -1 if game.settings.get("skip_penalty", 0) == 0 else 0
+            game.settings.skip_penalty = -1 if game.settings.skip_penalty == 0 else 0
+            journal_settings(game)
             await c.answer("Штраф обновлён")
         elif toggle_target == "category" and len(parts) >= 4:
             value = parts[3]
             if value not in CATEGORY_INFO:
                 await c.answer("Неизвестная категория", show_alert=True)
                 return
-            selected = set(get_selected_categories(game))
+            selected = set(game.settings.categories)
             if value in selected and len(selected) == 1:
                 await c.answer("Нужна хотя бы одна категория", show_alert=True)
                 return
@@ -2625,8 +6217,10 @@ async def cb_settings_router(c: CallbackQuery):
                 selected.remove(value)
             else:
                 selected.add(value)
-            game.settings["categories"] = set(selected)
+            game.settings.categories = frozenset(selected)
             reset_deck_cache(game, clear_used=True)
+            journal_settings(game, reset_deck=True)
+            sync_deck_index(game)
             await c.answer("Категории обновлены")
             await show_settings_menu(game, menu="category", message=c.message)
             return
@@ -2635,13 +6229,219 @@ async def cb_settings_router(c: CallbackQuery):
 
     await c.answer()
 
+# ===========================
+# ШАРДИРОВАНИЕ
+# ===========================
+#
+# В режиме SHARD_WORKERS > 0 основной процесс только принимает апдейты
+# (polling или webhook) и раскладывает их по воркерам: чат всегда попадает
+# в воркер chat_id % SHARD_WORKERS. Каждый воркер — отдельный процесс со своим
+# Bot, Dispatcher, GAMES, таймерами и исходящими лимитами; апдейты приходят
+# в него пачками JSON через pipe. Воркеры делят базу состояния, журнал у
+# каждого свой.
+
+ALLOWED_UPDATES = ["message", "callback_query"]
+
+
+def update_chat_id(raw: Dict) -> Optional[int]:
+    message = raw.get("message")
+    if message is None:
+        message = (raw.get("callback_query") or {}).get("message")
+    if message is None:
+        return None
+    return message["chat"]["id"]
+
+
+def shard_for_chat(chat_id: Optional[int], workers: int) -> int:
+    return 0 if chat_id is None else chat_id % workers
+
+
+class ShardRouter:
+    """Процессы-воркеры и раздача им апдейтов по chat_id."""
+
+    def __init__(self, workers: int, *, target=None):
+        context = multiprocessing.get_context("spawn")
+        self.processes = []
+        self.pipes = []
+        for index in range(workers):
+            receiver, sender = context.Pipe(duplex=False)
+            # воркер читает свой номер из окружения при импорте модуля
+            os.environ["SHARD_INDEX"] = str(index)
+            try:
+                process = context.Process(
+                    target=target or shard_worker_main,
+                    args=(receiver,),
+                    name=f"shard-{index}",
+                    daemon=True,
+                )
+                process.start()
+            finally:
+                os.environ.pop("SHARD_INDEX", None)
+            receiver.close()
+            self.processes.append(process)
+            self.pipes.append(sender)
+
+    def route(self, updates: Iterable[Dict]):
+        """Отправить апдейты воркерам: по одной записи в pipe на воркер."""
+        batches: Dict[int, List[Dict]] = {}
+        workers = len(self.pipes)
+        for raw in updates:
+            batches.setdefault(shard_for_chat(update_chat_id(raw), workers), []).append(raw)
+        for index, batch in batches.items():
+            self.pipes[index].send_bytes(json.dumps(batch, ensure_ascii=False).encode("utf-8"))
+
+    def close(self, timeout: float = 30.0):
+        # закрытый pipe — сигнал воркеру доделать апдейты и сохранить состояние
+        for pipe in self.pipes:
+            pipe.close()
+        for process in self.processes:
+            process.join(timeout)
+            if process.is_alive():
+                process.terminate()
+
+
+async def handle_shard_update(update: Update):
+    try:
+        await dp.feed_update(bot, update)
+    except Exception:
+        logger.exception("Ошибка обработки апдейта %s", update.update_id)
+
+
+async def consume_shard_updates(conn):
+    """Цикл воркера: апдейты из pipe обрабатываются задачами, как при polling."""
+    loop = asyncio.get_running_loop()
+    inbox: asyncio.Queue = asyncio.Queue()
+    fd = conn.fileno()
+
+    def on_readable():
+        try:
+            inbox.put_nowait(conn.recv_bytes())
+        except EOFError:
+            loop.remove_reader(fd)
+            inbox.put_nowait(None)
+
+    loop.add_reader(fd, on_readable)
+    in_flight: Set[asyncio.Task] = set()
+    while True:
+        data = await inbox.get()
+        if data is None:
+            break
+        for raw in json.loads(data):
+            update = Update.model_validate(raw, context={"bot": bot})
+            task = asyncio.create_task(handle_shard_update(update))
+            in_flight.add(task)
+            task.add_done_callback(in_flight.discard)
+    if in_flight:
+        await asyncio.gather(*in_flight)
+
+
+def shard_worker_main(conn):
+    asyncio.run(run_bot(consume_shard_updates(conn)))
+
+
+async def poll_updates_to_shards(router: ShardRouter):
+    offset = None
+    while True:
+        try:
+            updates = await bot.get_updates(
+                offset=offset, timeout=30, allowed_updates=ALLOWED_UPDATES
+            )
+        except Exception:
+            logger.exception("Не удалось получить апдейты")
+            await asyncio.sleep(1.0)
+            continue
+        if not updates:
+            continue
+        offset = updates[-1].update_id + 1
+        router.route(update.model_dump(mode="json", exclude_unset=True) for update in updates)
+
+
+async def serve_webhook_to_shards(router: ShardRouter):
+    from aiohttp import web
+
+    async def receive(request: web.Request) -> web.Response:
+        if WEBHOOK_SECRET and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+            return web.Response(status=401)
+        router.route([await request.json()])
+        return web.Response()
+
+    app = web.Application()
+    app.router.add_post(WEBHOOK_PATH, receive)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+    await bot.set_webhook(
+        WEBHOOK_URL,
+        secret_token=WEBHOOK_SECRET or None,
+        allowed_updates=ALLOWED_UPDATES,
+    )
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+
+async def run_shard_front():
+    if STATE_BACKEND == "sqlite" and STATE_DB_PATH:
+        # схему готовит фронт, до запуска воркеров: им остаётся только проверить её
+        conn = connect_state_db(STATE_DB_PATH)
+        try:
+            migrate_state_db(conn)
+        finally:
+            conn.close()
+    router = ShardRouter(SHARD_WORKERS)
+    print(f"✅ Bot is running: {SHARD_WORKERS} воркеров, приём через {SHARD_INTAKE}...")
+    try:
+        if SHARD_INTAKE == "webhook":
+            await serve_webhook_to_shards(router)
+        else:
+            await poll_updates_to_shards(router)
+    finally:
+        router.close()
+        await bot.session.close()
+
 # ===========================
 # MAIN
 # ===========================
 
+async def run_bot(intake):
+    """Фоновые задачи состояния вокруг приёма апдейтов (polling или pipe шарда)."""
+    # модули aiogram/pydantic и стоковая колода живут до конца процесса: замораживаем
+    # их один раз, предварительно собрав мусор, чтобы не закрепить навсегда циклы.
+    # Импортированные колоды не замораживаются — иначе выгрузка игр не вернула бы память
+    # (bench/import_lag.py: p99 задержки цикла при импорте ~113 мс без заморозки, ~15 мс с ней)
+    gc.collect()
+    gc.freeze()
+    if SHARD_INDEX is None:
+        print("✅ Bot is running...")
+    else:
+        print(f"✅ Shard {SHARD_INDEX} is running...")
+    if JOURNAL is not None and STATE_STORE is not None:
+        recovered, dropped = await asyncio.get_running_loop().run_in_executor(
+            STATE_STORE.executor, recover_games_from_journal
+        )
+        if recovered or dropped:
+            logger.warning("По журналу восстановлено игр: %s, удалено: %s", recovered, dropped)
+    bot.session.middleware(OUTBOUND)
+    flush_task = asyncio.create_task(state_flush_loop())
+    journal_task = asyncio.create_task(journal_flush_loop())
+    sweeper_task = asyncio.create_task(pending_sweeper())
+    try:
+        await intake
+    finally:
+        sweeper_task.cancel()
+        journal_task.cancel()
+        flush_task.cancel()
+        await flush_journal()
+        await flush_game_state()
+        await flush_leaderboards()
+
+
 async def main():
-    print("✅ Bot is running...")
-    await dp.start_polling(bot, allowed_updates=["message", "callback_query"])
+    if IS_SHARD_FRONT:
+        await run_shard_front()
+    else:
+        await run_bot(dp.start_polling(bot, allowed_updates=ALLOWED_UPDATES))
 
 if __name__ == "__main__":
     asyncio.run(main())
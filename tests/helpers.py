@@ -0,0 +1,70 @@
+"""Общее для тестов: свежая копия bot.py с заданным окружением.
+
+bot.py читает настройки при импорте, поэтому каждый тестовый модуль грузит
+свою копию. Запуск из корня репозитория:
+    python -m pytest -q tests
+"""
+
+import datetime
+import importlib.util
+import os
+import sys
+
+from aiogram.client.session.base import BaseSession
+from aiogram.methods import SendMessage
+from aiogram.types import Chat, Message
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+BASE_ENV = {
+    "BOT_TOKEN": "123456:test",
+    "STATE_BACKEND": "sqlite",
+    "STATE_DB_PATH": "",
+    "JOURNAL_DIR": "",
+}
+
+
+def load_bot(**env):
+    """Загрузить bot.py с окружением BASE_ENV + env; окружение процесса потом возвращается."""
+    overrides = {**BASE_ENV, **env}
+    saved = {key: os.environ.get(key) for key in overrides}
+    os.environ.update(overrides)
+    try:
+        spec = importlib.util.spec_from_file_location("bot", os.path.join(ROOT, "bot.py"))
+        module = importlib.util.module_from_spec(spec)
+        sys.modules["bot"] = module  # dataclasses ищут свой модуль в sys.modules
+        spec.loader.exec_module(module)
+    finally:
+        for key, value in saved.items():
+            if value is None:
+                os.environ.pop(key, None)
+            else:
+                os.environ[key] = value
+    return module
+
+
+class OfflineSession(BaseSession):
+    """Bot API без сети: запоминает вызовы, на sendMessage отвечает новым сообщением."""
+
+    def __init__(self):
+        super().__init__()
+        self.calls = []
+        self.sent = 0
+
+    async def make_request(self, bot, method, timeout=None):
+        self.calls.append(method)
+        if isinstance(method, SendMessage):
+            self.sent += 1
+            return Message(
+                message_id=self.sent,
+                date=datetime.datetime.now(),
+                chat=Chat(id=method.chat_id, type="group"),
+                text=method.text,
+            ).as_(bot)
+        return True
+
+    async def close(self):
+        pass
+
+    async def stream_content(self, *args, **kwargs):
+        yield b""
@@ -0,0 +1,199 @@
+"""Заменитель Redis для тестов: RESP2 и команды, которые использует RedisStore.
+
+Строки, множества, sorted set, хэши и WATCH/MULTI/EXEC. Сервер работает в своём
+потоке; drop_clients() рвёт все соединения, как рестарт Redis, а paused
+заставляет его молчать, как зависший сервер.
+"""
+
+import asyncio
+import threading
+
+
+def encode(value) -> bytes:
+    if value is None:
+        return b"$-1\r\n"
+    if isinstance(value, bool):
+        raise TypeError(value)
+    if isinstance(value, int):
+        return b":%d\r\n" % value
+    if isinstance(value, str):
+        return b"+" + value.encode("utf-8") + b"\r\n"
+    if isinstance(value, bytes):
+        return b"$%d\r\n%s\r\n" % (len(value), value)
+    if isinstance(value, Exception):
+        return b"-ERR " + str(value).encode("utf-8") + b"\r\n"
+    if isinstance(value, list):
+        return b"*%d\r\n" % len(value) + b"".join(encode(item) for item in value)
+    raise TypeError(value)
+
+
+class Store:
+    def __init__(self):
+        self.data = {}
+        # номер изменения ключа — для WATCH
+        self.mods = {}
+
+    def touch(self, key):
+        self.mods[key] = self.mods.get(key, 0) + 1
+
+    def run(self, command, args):
+        data = self.data
+        if command == "PING":
+            return "PONG"
+        if command in ("SELECT", "AUTH"):
+            return "OK"
+        if command == "GET":
+            return data.get(args[0])
+        if command == "MGET":
+            return [data.get(key) if isinstance(data.get(key), bytes) else None for key in args]
+        if command == "SET":
+            data[args[0]] = args[1]
+            self.touch(args[0])
+            return "OK"
+        if command == "DEL":
+            removed = 0
+            for key in args:
+                if key in data:
+                    del data[key]
+                    self.touch(key)
+                    removed += 1
+            return removed
+        if command == "EXISTS":
+            return sum(1 for key in args if key in data)
+        if command == "INCR":
+            value = int(data.get(args[0], b"0")) + 1
+            data[args[0]] = str(value).encode("utf-8")
+            self.touch(args[0])
+            return value
+        if command == "SADD":
+            members = data.setdefault(args[0], set())
+            before = len(members)
+            members.update(args[1:])
+            self.touch(args[0])
+            return len(members) - before
+        if command == "SREM":
+            members = data.get(args[0], set())
+            before = len(members)
+            members.difference_update(args[1:])
+            if not members:
+                data.pop(args[0], None)
+            self.touch(args[0])
+            return before - len(members)
+        if command == "SCARD":
+            return len(data.get(args[0], ()))
+        if command == "SMEMBERS":
+            return sorted(data.get(args[0], ()))
+        if command == "ZINCRBY":
+            scores = data.setdefault(args[0], {})
+            scores[args[2]] = scores.get(args[2], 0.0) + float(args[1])
+            self.touch(args[0])
+            return repr(scores[args[2]]).encode("utf-8")
+        if command == "ZSCORE":
+            score = data.get(args[0], {}).get(args[1])
+            return None if score is None else repr(score).encode("utf-8")
+        if command == "ZREVRANGE":
+            start, stop = int(args[1]), int(args[2])
+            items = sorted(data.get(args[0], {}).items(), key=lambda kv: (kv[1], kv[0]), reverse=True)
+            reply = []
+            for member, score in items[start:stop + 1 if stop >= 0 else None]:
+                reply.append(member)
+                if len(args) > 3:
+                    reply.append(repr(score).encode("utf-8"))
+            return reply
+        if command == "HSET":
+            fields = data.setdefault(args[0], {})
+            added = 0
+            for i in range(1, len(args), 2):
+                added += args[i] not in fields
+                fields[args[i]] = args[i + 1]
+            self.touch(args[0])
+            return added
+        if command == "HMGET":
+            fields = data.get(args[0], {})
+            return [fields.get(name) for name in args[1:]]
+        return Exception(f"unknown command {command}")
+
+
+class RespServer:
+    def __init__(self):
+        self.store = Store()
+        self.commands = 0
+        self.paused = False
+        self.loop = None
+        self.writers = set()
+
+    async def handle(self, reader, writer):
+        self.writers.add(writer)
+        watched = {}
+        queue = None
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                args = []
+                for _ in range(int(line[1:-2])):
+                    size = int((await reader.readline())[1:-2])
+                    args.append((await reader.readexactly(size + 2))[:-2])
+                while self.paused:
+                    await asyncio.sleep(0.01)
+                command, args = args[0].decode("utf-8").upper(), args[1:]
+                self.commands += 1
+                if command == "WATCH":
+                    watched.update((key, self.store.mods.get(key, 0)) for key in args)
+                    reply = "OK"
+                elif command == "UNWATCH":
+                    watched = {}
+                    reply = "OK"
+                elif command == "MULTI":
+                    queue = []
+                    reply = "OK"
+                elif command == "EXEC":
+                    if any(self.store.mods.get(key, 0) != mod for key, mod in watched.items()):
+                        writer.write(b"*-1\r\n")
+                        await writer.drain()
+                        queue, watched = None, {}
+                        continue
+                    reply = [self.store.run(queued, queued_args) for queued, queued_args in queue]
+                    queue, watched = None, {}
+                elif queue is not None:
+                    queue.append((command, args))
+                    reply = "QUEUED"
+                else:
+                    reply = self.store.run(command, args)
+                writer.write(encode(reply))
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self.writers.discard(writer)
+            writer.close()
+
+    def drop_clients(self):
+        """Закрыть все соединения клиентов, как при рестарте Redis."""
+        def close_all():
+            for writer in list(self.writers):
+                writer.transport.abort()
+        self.loop.call_soon_threadsafe(close_all)
+        # дождаться, пока сервер обработает закрытие
+        asyncio.run_coroutine_threadsafe(asyncio.sleep(0.05), self.loop).result()
+
+
+def start_server():
+    """Запустить сервер в потоке-демоне; возвращает (сервер, порт)."""
+    server = RespServer()
+    ready = threading.Event()
+    box = {}
+
+    def run():
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        server.loop = loop
+        listener = loop.run_until_complete(asyncio.start_server(server.handle, "127.0.0.1", 0))
+        box["port"] = listener.sockets[0].getsockname()[1]
+        ready.set()
+        loop.run_forever()
+
+    threading.Thread(target=run, daemon=True).start()
+    ready.wait()
+    return server, box["port"]
@@ -0,0 +1,87 @@
+"""OutboundLimiter против поддельного Bot API, который считает нарушения окон Telegram."""
+
+import asyncio
+import collections
+import random
+import time
+
+from helpers import OfflineSession, load_bot
+
+bot = load_bot()
+
+
+class FloodAPI(OfflineSession):
+    """Считает запросы, на которые Telegram ответил бы 429.
+
+    Окна: 30 в секунду на бота, 2 в секунду на чат, 20 в минуту на группу.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.sent_at = []
+        self.by_chat = collections.defaultdict(list)
+        self.violations = 0
+        self.order = []
+
+    async def make_request(self, bot_, method, timeout=None):
+        chat_id = getattr(method, "chat_id", None)
+        if chat_id is not None:
+            now = time.monotonic()
+            total = sum(1 for sent in self.sent_at if now - sent < 1.0)
+            in_chat = sum(1 for sent in self.by_chat[chat_id] if now - sent < 1.0)
+            in_group = sum(1 for sent in self.by_chat[chat_id] if now - sent < 60.0) if chat_id < 0 else 0
+            if total >= 30 or in_chat >= 2 or in_group >= 20:
+                self.violations += 1
+            self.sent_at.append(now)
+            self.by_chat[chat_id].append(now)
+            self.order.append((chat_id, getattr(method, "text", None)))
+        await asyncio.sleep(0.005)
+        return await super().make_request(bot_, method, timeout)
+
+
+def use_limiter(**limits):
+    api = FloodAPI()
+    limiter = bot.OutboundLimiter(**limits)
+    api.middleware(limiter)
+    bot.bot.session = api
+    return api, limiter
+
+
+async def send(chat_id, text, priority):
+    with bot.outbound_priority(priority):
+        await bot.bot.send_message(chat_id, text)
+
+
+def test_flood_without_429_and_game_first():
+    async def scenario():
+        api, limiter = use_limiter()
+        random.seed(1)
+        chats = [-(1000 + i) for i in range(20)] + [i + 1 for i in range(10)]
+        jobs = [
+            send(chat_id, f"m{k}", random.choice(range(len(bot.PRIORITY_NAMES))))
+            for chat_id in chats
+            for k in range(6)
+        ]
+        random.shuffle(jobs)
+        await asyncio.gather(*jobs)
+        assert api.violations == 0
+        classes = limiter.stats()["classes"]
+        assert classes["game"]["avg_wait"] < classes["background"]["avg_wait"]
+        assert not limiter.waiting and limiter.task is None
+
+    asyncio.run(scenario())
+
+
+def test_game_request_overtakes_queued_background():
+    async def scenario():
+        api, _ = use_limiter()
+        await send(1, "first", bot.PRIORITY_NORMAL)
+        # корзина чата пуста: обе отправки встают в очередь, фоновая — раньше
+        background = asyncio.create_task(send(1, "background", bot.PRIORITY_BACKGROUND))
+        await asyncio.sleep(0)
+        game = asyncio.create_task(send(1, "game", bot.PRIORITY_GAME))
+        await asyncio.gather(background, game)
+        assert [text for _, text in api.order] == ["first", "game", "background"]
+        assert api.violations == 0
+
+    asyncio.run(scenario())
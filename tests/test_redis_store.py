@@ -0,0 +1,149 @@
+"""RedisStore против заменителя Redis: две реплики, обрывы соединения, таймауты."""
+
+import asyncio
+import json
+import threading
+import time
+
+import pytest
+
+from helpers import OfflineSession, load_bot
+from resp_server import start_server
+
+SERVER, PORT = start_server()
+bot = load_bot(
+    STATE_BACKEND="redis",
+    REDIS_URL=f"redis://127.0.0.1:{PORT}/0",
+    REDIS_TIMEOUT="0.3",
+)
+bot.bot.session = OfflineSession()
+
+
+def other_replica():
+    return bot.RedisStore(bot.REDIS_URL, bot.REDIS_PREFIX)
+
+
+async def new_game(chat_id):
+    await bot.start_new_game_session(chat_id, 1, "Хост")
+    game = bot.GAMES[chat_id]
+    bot.mark_game_dirty(game)
+    await bot.flush_game_state()
+    return game
+
+
+def test_replicas_resolve_conflicts():
+    async def scenario():
+        replica = other_replica()
+        game = await new_game(7)
+        deck, _, _ = bot.prepare_deck_batch(game.extra_decks, [
+            {"id": f"r-{i}", "type": "truth", "category": "Лёгкое", "age": "0+", "tags": [], "text": f"Вопрос {i}"}
+            for i in range(4)
+        ], set())
+        bot.commit_prepared_decks(game, [deck])
+        bot.mark_game_dirty(game)
+        await bot.flush_game_state()
+        assert replica.game_version(7) == game.version
+        assert replica.load_deck(deck.digest) is not None
+
+        # другая реплика пишет поверх: локальная запись отклоняется, копия сбрасывается
+        version, state = replica.load_game(7)
+        state["settings"]["timer"] = 0
+        written = replica.write_batch([(7, version, json.dumps(state), [deck])], [])
+        game.settings.points = False
+        bot.mark_game_dirty(game)
+        await bot.flush_game_state()
+        assert 7 not in bot.GAMES
+        restored = bot.ensure_game(7)
+        assert restored.settings.timer == 0 and restored.version == written[7]
+
+        # свежая версия в Redis — копия перечитывается перед следующим апдейтом
+        version, state = replica.load_game(7)
+        state["settings"]["timer"] = 60
+        replica.write_batch([(7, version, json.dumps(state), [deck])], [])
+        await bot.prepare_chat_game(7)
+        assert bot.GAMES[7].settings.timer == 60
+
+        # удаление игры освобождает колоду
+        await bot.end_game_session(bot.GAMES[7], "bye", keep_game=False)
+        await bot.flush_game_state()
+        assert replica.load_game(7) is None and replica.load_deck(deck.digest) is None
+
+    asyncio.run(scenario())
+
+
+def test_reads_before_handler_run_in_store_thread():
+    async def scenario():
+        game = await new_game(8)
+        bot.drop_cached_game(game)
+        threads = []
+        store = bot.STATE_STORE
+        original = store.load_game
+
+        def load_game(chat_id):
+            threads.append(threading.current_thread())
+            return original(chat_id)
+
+        store.load_game = load_game
+        try:
+            await bot.prepare_chat_game(8)
+            assert 8 in bot.GAMES
+            bot.ensure_game(8)
+        finally:
+            del store.load_game
+        assert len(threads) == 1 and threads[0] is not threading.main_thread()
+
+    asyncio.run(scenario())
+
+
+def test_reconnects_after_connection_drop():
+    async def scenario():
+        game = await new_game(9)
+        SERVER.drop_clients()
+        # чтение повторяется на новом соединении
+        assert bot.STATE_STORE.game_version(9) == game.version
+        game.rounds_played = 3
+        bot.mark_game_dirty(game)
+        await bot.flush_game_state()
+        if bot.DIRTY_GAMES:
+            # запись на разорванном соединении не повторяется: игра ждёт следующего сброса
+            await bot.flush_game_state()
+        assert not bot.DIRTY_GAMES
+        assert other_replica().load_game(9)[1]["rounds_played"] == 3
+
+    asyncio.run(scenario())
+
+
+def test_socket_timeout():
+    client = bot.RespClient(bot.REDIS_URL)
+    SERVER.paused = True
+    started = time.monotonic()
+    try:
+        with pytest.raises(OSError):
+            client.call("GET", "missing")
+    finally:
+        SERVER.paused = False
+    assert time.monotonic() - started < 2
+    assert client.call("PING") == "PONG"
+
+
+def test_leaderboard_reads_stored_and_unsaved_points():
+    async def scenario():
+        game = await new_game(10)
+        bot.register_player(game, 2, "Гость")
+        bot.record_points(game, 1, 3)
+        await bot.flush_leaderboards()
+        bot.record_points(game, 2, 5)
+        records = await bot.format_leaderboard(10)
+        assert records.index("Гость") < records.index("Хост")
+        assert "<b>5</b>" in records and "<b>3</b>" in records
+
+    asyncio.run(scenario())
+
+
+def test_store_without_all_methods_fails_on_creation():
+    class PartialStore(bot.StateStore):
+        def load_game(self, chat_id):
+            return None
+
+    with pytest.raises(TypeError):
+        PartialStore()